@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the compressed backlog: compression ratio and speed of the
+chunk codec (delta + zlib) against plain zlib, on synthetic music (a chord
+every quarter of second over a light noise) and on true silence.
+
+    python benchmarks/backlog.py --seconds 60 --noise 0.01
+"""
+
+import os
+import sys
+import time
+import zlib
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.backlog import pack, unpack, CHUNK_SECONDS, LEVEL
+
+RATE = 44100
+
+def music(seconds, noise, seed=0):
+    """ Return seconds of stereo 16 bits music-like PCM """
+    rng = numpy.random.RandomState(seed)
+    time_ = numpy.arange(int(seconds * RATE)) / RATE
+    signal = noise * rng.standard_normal(len(time_))
+    for start in range(0, len(time_), RATE // 4):
+        chord = time_[start:start + RATE // 4]
+        for frequency in rng.uniform(100, 2000, 3):
+            signal[start:start + len(chord)] += numpy.sin(2 * numpy.pi * frequency * chord) / 3
+    # Slightly different channels, as a stereo mix
+    left = (signal * 12000).astype('<i2')
+    right = (numpy.roll(signal, 7) * 11000).astype('<i2')
+    return numpy.stack((left, right), axis=1).tobytes()
+
+def measure(data, chunk_bytes):
+    """ Return the ratio and the MB/s of packing and unpacking data by chunks,
+    and the ratio of plain zlib """
+    chunks = [data[start:start + chunk_bytes] for start in range(0, len(data), chunk_bytes)]
+    start = time.perf_counter()
+    packed = [pack(chunk) for chunk in chunks]
+    pack_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for chunk in packed:
+        unpack(chunk)
+    unpack_seconds = time.perf_counter() - start
+    plain = sum(len(zlib.compress(chunk, LEVEL)) for chunk in chunks)
+    megabytes = len(data) / 1e6
+    return {
+        'ratio': len(data) / sum(len(chunk) for chunk in packed),
+        'zlib_ratio': len(data) / plain,
+        'pack_mb_per_second': megabytes / pack_seconds,
+        'unpack_mb_per_second': megabytes / unpack_seconds
+    }
+
+def main():
+    """ Parse options, run the benchmark and print the results """
+    arg_parser = argparse.ArgumentParser(description="Compressed backlog benchmark")
+    arg_parser.add_argument(
+        "--seconds", type=float, default=60, help="Audio length (default: %(default)s)")
+    arg_parser.add_argument(
+        "--noise", type=float, default=0.01,
+        help="Noise level relative to the chords (default: %(default)s)")
+    options = arg_parser.parse_args()
+
+    chunk_bytes = CHUNK_SECONDS * RATE * 4
+    cases = [
+        ("music", music(options.seconds, options.noise)),
+        ("silence", bytes(int(options.seconds * RATE) * 4))
+    ]
+    print("{:>8} {:>8} {:>11} {:>12} {:>14}".format(
+        "case", "ratio", "zlib ratio", "pack MB/s", "unpack MB/s"))
+    for name, data in cases:
+        result = measure(data, chunk_bytes)
+        print("{:>8} {:>8.2f} {:>11.2f} {:>12.0f} {:>14.0f}".format(
+            name, result['ratio'], result['zlib_ratio'],
+            result['pack_mb_per_second'], result['unpack_mb_per_second']))
+
+if __name__ == "__main__":
+    main()
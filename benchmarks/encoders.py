@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the encoders: encoding wall time, CPU time of the encoder
+processes, size and compression ratio of a synthetic song.
+
+Opus is measured both from a raw file and streamed while the song is written,
+as the recorder does. Encoders whose binary is not installed are reported as such.
+
+    python benchmarks/encoders.py --seconds 120
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+from fingerprint import song
+
+CHUNK = 2 * 2 * 44100 // 10 # Bytes written at once when streaming, as the loader does
+BINARIES = {
+    Mp3LameEncoder: "/usr/bin/lame",
+    FlacEncoder: "/usr/bin/flac",
+    OpusEncoder: "/usr/bin/opusenc"
+}
+
+def children_cpu():
+    """ Return the CPU time (user + system) used by the terminated children """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def encode_file(encoder, basename, output):
+    """ Encode basename.raw to output """
+    encoder.encode(basename, {}, output)
+
+def encode_stream(encoder, basename, output):
+    """ Stream basename.raw, chunk by chunk, to the encoder """
+    process = encoder.open_stream(basename, {}, output)
+    with open("{}.raw".format(basename), 'rb') as raw_file:
+        for chunk in iter(lambda: raw_file.read(CHUNK), b""):
+            process.stdin.write(chunk)
+    encoder.close_stream(process)
+
+def main():
+    """ Parse options, run the benchmark and print the results """
+    arg_parser = argparse.ArgumentParser(description="Encoders benchmark")
+    arg_parser.add_argument(
+        "--seconds", type=float, default=60, help="Song length (default: %(default)s)")
+    options = arg_parser.parse_args()
+
+    cases = [
+        ("mp3", Mp3LameEncoder, encode_file),
+        ("flac", FlacEncoder, encode_file),
+        ("opus", OpusEncoder, encode_file),
+        ("opus (streamed)", OpusEncoder, encode_stream)
+    ]
+    workdir = tempfile.mkdtemp(prefix="streamrecord-encoders-")
+    try:
+        basename = os.path.join(workdir, "song")
+        with open("{}.raw".format(basename), 'wb') as raw_file:
+            raw_file.write(song(options.seconds))
+        raw_size = os.path.getsize("{}.raw".format(basename))
+        print("{:>16} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+            "encoder", "wall (s)", "cpu (s)", "size (kB)", "ratio", "speed"))
+        for name, encoder_class, method in cases:
+            if not os.path.exists(BINARIES[encoder_class]):
+                print("{:>16} not installed".format(name))
+                continue
+            encoder = encoder_class(keep_raw=True)
+            output = os.path.join(workdir, "encoded")
+            cpu_start = children_cpu()
+            start = time.perf_counter()
+            method(encoder, basename, output)
+            wall = time.perf_counter() - start
+            cpu = children_cpu() - cpu_start
+            size = os.path.getsize(encoder.get_output(basename, {}, output))
+            os.unlink(encoder.get_output(basename, {}, output))
+            print("{:>16} {:>10.2f} {:>10.2f} {:>10.0f} {:>8.1f} {:>7.0f}x".format(
+                name, wall, cpu, size / 1e3, raw_size / size, options.seconds / wall))
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the audio fingerprints: hashing time of a song, and lookup time
+in an index growing to tens of thousands of songs.
+
+Indexed songs are random hashes, only the searched song is real audio.
+
+    python benchmarks/fingerprint.py --songs 1000,10000,50000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.fingerprint import Fingerprinter, FingerprintIndex
+
+def song(seconds, seed=0):
+    """ Return seconds of a stereo 16 bits song: a new chord every quarter of second """
+    rng = numpy.random.RandomState(seed)
+    time_axis = numpy.arange(int(seconds * 44100)) / 44100
+    signal = 0.05 * rng.standard_normal(len(time_axis))
+    for start in range(0, len(time_axis), 44100 // 4):
+        chord = time_axis[start:start + 44100 // 4]
+        for frequency in rng.uniform(200, 3000, 3):
+            signal[start:start + len(chord)] += numpy.sin(2 * numpy.pi * frequency * chord)
+    samples = (signal / numpy.abs(signal).max() * 16000).astype('<i2')
+    return numpy.repeat(samples, 2).tobytes()
+
+def main():
+    """ Parse options, run the benchmark and print the results """
+    arg_parser = argparse.ArgumentParser(description="Fingerprint index benchmark")
+    arg_parser.add_argument(
+        "--songs", default="1000,10000,30000",
+        help="Comma separated index sizes (default: %(default)s)")
+    arg_parser.add_argument(
+        "--lookups", type=int, default=100, help="Lookups per index size")
+    options = arg_parser.parse_args()
+
+    data = song(30)
+    start = time.perf_counter()
+    fingerprinter = Fingerprinter()
+    fingerprinter.update(data)
+    indexed = fingerprinter.indexed_hashes()
+    searched = fingerprinter.searched_hashes()
+    print("Hashing: {:.1f} ms per song".format((time.perf_counter() - start) * 1e3))
+
+    rng = numpy.random.RandomState(0)
+    index = FingerprintIndex()
+    index.add("searched", indexed)
+    print("{:>10} {:>12} {:>10}".format("songs", "lookup (ms)", "found"))
+    for size in sorted(int(size) for size in options.songs.split(",")):
+        while len(index) < size:
+            index.add(len(index), rng.randint(0, 2 ** 32, len(indexed)).astype(numpy.uint32))
+        start = time.perf_counter()
+        for _ in range(options.lookups):
+            found = index.match(searched)
+        lookup = (time.perf_counter() - start) / options.lookups
+        print("{:>10} {:>12.3f} {:>10}".format(len(index), lookup * 1e3, found))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the recording pipeline.
+
+A synthetic playlist with known track boundaries is replayed through the real
+StreamLoader/SongWriter/encoder pipeline, faster than real time, using the
+replay capture source and scripted title changes. Reports per-stage
+throughput, cut accuracy against the ground truth, peak memory and CPU time.
+
+    python benchmarks/pipeline.py --tracks 6 --speed 20
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import array
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import functools
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.recording import Recording
+from streamrecord.replay import FileCaptureSource, ScriptedAppInspector
+from streamrecord.encoder import DebugEncoder, Mp3LameEncoder, FlacEncoder, OpusEncoder
+from streamrecord.metrics import registry
+from streamrecord.tracing import tracer
+
+ONE_SECOND = 2 * 2 * 44100 # Number of bytes in one second
+TITLE_REGEX = r"(?P<title>.+) - (?P<artist>.+) - .*"
+ENCODERS = {
+    'debug': DebugEncoder,
+    'mp3': functools.partial(Mp3LameEncoder, keep_raw=True),
+    'flac': functools.partial(FlacEncoder, keep_raw=True),
+    'opus': OpusEncoder
+}
+
+def generate_playlist(path, tracks, track_length, gap_length, seed=0):
+    """ Write a looping playlist of noisy tracks separated by silences in path.
+    As a recorder stops once the first track has been played twice, the playlist is
+    played once, then its first track again, then the beginning of the second one.
+    return the ground truth boundaries (in bytes, middle of the gaps) and the
+    script of title changes (in seconds) """
+    rng = random.Random(seed)
+    noise = array.array('h', (rng.randint(-8000, 8000) for _ in range(2 * 44100))).tobytes()
+    silence = bytes(int(gap_length * 44100) * 2 * 2)
+    lengths = [
+        int(track_length * rng.uniform(0.8, 1.2) * 44100) * 2 * 2 for _ in range(tracks)
+    ]
+    played = list(range(tracks)) + [0, 1]
+
+    boundaries = []
+    script = []
+    position = 0
+    with open(path, 'wb') as raw_file:
+        for number, index in enumerate(played):
+            title = "Track {} - Artist {} - Benchmark".format(index, index)
+            if number == 0:
+                script.append((0, title))
+            else:
+                # Titles change in the middle of the previous gap
+                boundary = position - (len(silence) // 8) * 4
+                boundaries.append(boundary)
+                script.append((boundary / ONE_SECOND, title))
+            # Only the beginning of the last track is needed
+            length = lengths[index] if number < len(played) - 1 else 5 * ONE_SECOND
+            written = 0
+            while written < length:
+                chunk = noise[rng.randrange(0, 1000) * 4:][:length - written]
+                raw_file.write(chunk)
+                written += len(chunk)
+            raw_file.write(silence)
+            position += length + len(silence)
+    return boundaries, script
+
+def stage_durations():
+    """ Sum the traced durations per stage """
+    durations = collections.Counter()
+    for event in tracer.events:
+        if event['ph'] == "X":
+            durations[event['name']] += event['dur'] / 1e6
+    return durations
+
+def run(options):
+    """ Run the benchmark and return its report """
+    workdir = tempfile.mkdtemp(prefix="streamrecord-bench-")
+    raw_path = os.path.join(workdir, "playlist.capture")
+    boundaries, script = generate_playlist(
+        raw_path, options.tracks, options.track_length, options.gap, options.seed)
+    audio_bytes = os.path.getsize(raw_path)
+
+    registry.clear()
+    tracer.events = []
+    tracer.enable()
+    audio_encoder = ENCODERS[options.encoder]()
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        cpu_start = os.times()
+        wall_start = time.time()
+        recording = Recording(
+            0,
+            re.compile(TITLE_REGEX),
+            audio_encoder,
+            functools.partial(ScriptedAppInspector, script=script, speed=options.speed),
+            capture_source=functools.partial(
+                FileCaptureSource, path=raw_path, speed=options.speed),
+            compress_backlog=options.compress_backlog)
+        recording.start()
+        recording.end_event.wait()
+        recording.join()
+        wall = time.time() - wall_start
+        cpu_end = os.times()
+    finally:
+        os.chdir(previous_dir)
+
+    # Cuts are the cumulated sizes of the written songs
+    written = [
+        audio_encoder.encoded[task_id].st_size
+        for task_id in sorted(audio_encoder.encoded)
+    ] if isinstance(audio_encoder, DebugEncoder) else []
+    cuts = [sum(written[:i]) for i in range(1, len(written))]
+    # The last song is cut at the end of the recording, not on a gap
+    errors = [
+        abs(cut - boundary) / ONE_SECOND
+        for cut, boundary in zip(cuts, boundaries[:len(cuts)])
+    ]
+    if isinstance(audio_encoder, DebugEncoder):
+        os.chdir(workdir)
+        audio_encoder.clear()
+        os.chdir(previous_dir)
+
+    durations = stage_durations()
+    captured = sum(registry.counters.get("streamrecord_capture_bytes_total", {}).values())
+    report = {
+        'audio_seconds': audio_bytes / ONE_SECOND,
+        'wall_seconds': wall,
+        'speed': (audio_bytes / ONE_SECOND) / wall,
+        'songs': len(written),
+        'throughput_mb_per_second': {
+            'capture': captured / wall / 1e6,
+        },
+        'stage_seconds': dict(durations),
+        'cut_error_seconds': {
+            'mean': sum(errors) / len(errors) if errors else None,
+            'max': max(errors) if errors else None,
+            'boundaries': len(errors)
+        },
+        'peak_memory_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'cpu_seconds': {
+            'self': (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system),
+            'children': ((cpu_end.children_user - cpu_start.children_user) +
+                         (cpu_end.children_system - cpu_start.children_system))
+        }
+    }
+    for stage in ("write_main_part", "analyze", "break_search", "write_song_end", "encode"):
+        if durations[stage] > 0:
+            report['throughput_mb_per_second'][stage] = audio_bytes / durations[stage] / 1e6
+    os.unlink(raw_path)
+    os.rmdir(workdir)
+    return report
+
+def main():
+    """ Parse options, run the benchmark, print the report and check the gates """
+    arg_parser = argparse.ArgumentParser(description="End-to-end pipeline benchmark")
+    arg_parser.add_argument("--tracks", type=int, default=5, help="Tracks in the playlist")
+    arg_parser.add_argument(
+        "--track-length", type=float, default=30, help="Mean track length in seconds")
+    arg_parser.add_argument("--gap", type=float, default=0.5, help="Gap length in seconds")
+    arg_parser.add_argument("--speed", type=float, default=10, help="Replay speed factor")
+    arg_parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    arg_parser.add_argument(
+        "--encoder", choices=sorted(ENCODERS), default="debug",
+        help="Encoder to use, 'debug' only measures the cuts (default: %(default)s)")
+    arg_parser.add_argument(
+        "--compress-backlog", type=float, metavar="SECONDS",
+        help="Compress the audio buffered for more than SECONDS (see CompressedBacklog)")
+    arg_parser.add_argument("--output", help="Also write the JSON report in this file")
+    arg_parser.add_argument(
+        "--max-cut-error", type=float,
+        help="Fail if the mean cut error exceeds this many seconds")
+    arg_parser.add_argument(
+        "--min-speed", type=float,
+        help="Fail if the pipeline processes audio slower than this factor")
+    arg_parser.add_argument("--debug", "-d", action="store_true", help="Show debug info")
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.debug else logging.WARNING,
+        format="## %(levelname)s ## %(threadName)s ## %(message)s"
+    )
+
+    report = run(options)
+    print(json.dumps(report, indent=2))
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    failed = False
+    mean_error = report['cut_error_seconds']['mean']
+    if options.max_cut_error is not None and (
+            mean_error is None or mean_error > options.max_cut_error):
+        print("Mean cut error {} s exceeds {} s".format(mean_error, options.max_cut_error))
+        failed = True
+    if options.min_speed is not None and report['speed'] < options.min_speed:
+        print("Speed {:.1f}x is below {}x".format(report['speed'], options.min_speed))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the retagging: files per second of a library of synthetic MP3
+and FLAC songs, when the new tags fit in the padding (rewritten in place)
+and when they do not (audio data moved after larger tags).
+
+    python benchmarks/retag.py --songs 2000 --jobs 8
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.retag import Retagger, write_tags
+
+SONG_BYTES = 4 * 1024 * 1024 # About 4 minutes of MP3 at 128 kbit/s
+
+def make_library(directory, songs):
+    """ Write songs tagged files, half MP3, half FLAC, with padded tags """
+    audio = os.urandom(SONG_BYTES)
+    for index in range(songs):
+        path = os.path.join(directory, "{}.{}".format(index, "mp3" if index % 2 else "flac"))
+        with open(path, 'wb') as song_file:
+            if path.endswith(".flac"):
+                # STREAMINFO only, the tags are added by write_tags
+                song_file.write(b"fLaC\x80" + (34).to_bytes(3, 'big') + bytes(34))
+            song_file.write(audio)
+        write_tags(path, {'title': "Artist {}".format(index), 'artist': "Title {}".format(index)})
+
+def main():
+    """ Parse options, run the benchmark and print the results """
+    arg_parser = argparse.ArgumentParser(description="Retagging benchmark")
+    arg_parser.add_argument(
+        "--songs", type=int, default=1000, help="Number of songs (default: %(default)s)")
+    arg_parser.add_argument(
+        "--jobs", type=int, help="Number of threads (default: the executor's default)")
+    options = arg_parser.parse_args()
+
+    cases = [
+        ("in place", lambda infos: dict(
+            infos, title=infos['artist'], artist=infos['title'])),
+        ("moved", lambda infos: dict(infos, comment="x" * 4096))
+    ]
+    workdir = tempfile.mkdtemp(prefix="streamrecord-retag-")
+    try:
+        make_library(workdir, options.songs)
+        print("{:>10} {:>10} {:>12}".format("case", "wall (s)", "files/s"))
+        for name, change in cases:
+            start = time.perf_counter()
+            report = Retagger(change, rename=False).run([workdir], options.jobs)
+            wall = time.perf_counter() - start
+            if report['failed']:
+                print("{:>10} {} failures".format(name, len(report['failed'])))
+            print("{:>10} {:>10.2f} {:>12.0f}".format(name, wall, options.songs / wall))
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
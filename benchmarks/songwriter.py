@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks of the songwriter hot paths on synthetic PCM.
+
+Each function is run on several sizes (a 2 seconds tail, a 5 minutes song,
+a 1 hour session) and signal shapes (true silence gap, low noise floor gap,
+no gap). Operations per second and memory allocations are reported and
+compared to a stored baseline. A buffered backlog of 30 seconds songs is
+also written one song at a time and in one batch.
+
+    python benchmarks/songwriter.py                       # compare to the baseline
+    python benchmarks/songwriter.py --save-baseline       # record a new baseline
+    python benchmarks/songwriter.py --sizes song,session --no-allocations
+
+Pure Python paths are slow on long sizes (about ten minutes for a session),
+and allocations tracking slows them further: skip it on long sizes. The
+baseline holds every size, the long ones without allocations, the tail being
+recorded last for round_on_sample to keep its allocations:
+
+    python benchmarks/songwriter.py --sizes song,session --no-allocations --save-baseline
+    python benchmarks/songwriter.py --save-baseline
+"""
+
+import os
+import sys
+import json
+import time
+import array
+import random
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamrecord.songwriter import (
+    SongWriter, round_on_sample, find_longest_silence, find_breaking_byte,
+    CUT_CANDIDATES)
+from streamrecord.clock import VirtualClock
+
+ONE_SECOND = 2 * 2 * 44100 # Number of bytes in one second
+BACKLOG_SONG_SECONDS = 30 # Length of the songs of the backlog benchmarks
+SIZES = {
+    'tail': 2,
+    'song': 5 * 60,
+    'session': 60 * 60
+}
+SHAPES = ('silence', 'noise_floor', 'no_gap')
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "songwriter_baseline.json")
+
+def generate(seconds, shape, seed=0):
+    """ Return seconds of stereo 16 bits PCM, as the bytearray the song writer
+    handles, with a 0.5 second gap in the middle for 'silence' and 'noise_floor' """
+    rng = random.Random(seed)
+    loud = array.array('h', (rng.randint(-8000, 8000) for _ in range(2 * 44100))).tobytes()
+    quiet = array.array('h', (rng.randint(-12, 12) for _ in range(2 * 44100))).tobytes()
+    gap = {
+        'silence': bytes(ONE_SECOND // 2),
+        'noise_floor': quiet[:ONE_SECOND // 2],
+        'no_gap': loud[:ONE_SECOND // 2]
+    }[shape]
+    half = (int(seconds * ONE_SECOND) - len(gap)) // 2
+    half -= half % 4
+    def _loud(length):
+        return (loud * (length // len(loud) + 1))[:length]
+    return bytearray(_loud(half) + gap + _loud(half))
+
+class WriteDataBench:
+    """ Callable running SongWriter.write_data on a fresh copy of the data.
+    The buffer holds exactly the song, its last 2 seconds being searched for a gap. """
+    def __init__(self, data, seconds):
+        self.data = data
+        self.seconds = seconds
+        self.directory = tempfile.mkdtemp(prefix="streamrecord-bench-")
+        self.song_writer = None
+
+    def setup(self):
+        """ Untimed: refill the buffer """
+        synchronization = {
+            'start': threading.Barrier(1),
+            'end': threading.Event(),
+            'tasks': None
+        }
+        self.song_writer = SongWriter(
+            synchronization,
+            {'raw_data': bytearray(self.data), 'lock': threading.Lock()},
+            None,
+            VirtualClock())
+
+    def __call__(self):
+        self.song_writer.write_data(os.path.join(self.directory, "bench"), self.seconds)
+
+    def cleanup(self):
+        """ Remove the written file """
+        os.unlink(os.path.join(self.directory, "bench.raw"))
+        os.rmdir(self.directory)
+
+class BacklogBench:
+    """ Callable writing a backlog of songs of BACKLOG_SONG_SECONDS, fully buffered,
+    one at a time (SongWriter.write_data) or in one batch (SongWriter.write_batch) """
+    def __init__(self, data, batch):
+        self.data = data
+        self.batch = batch
+        self.directory = tempfile.mkdtemp(prefix="streamrecord-bench-")
+        self.count = len(data) // (BACKLOG_SONG_SECONDS * ONE_SECOND)
+        self.song_writer = None
+
+    def setup(self):
+        """ Untimed: refill the buffer """
+        self.cleanup_files()
+        synchronization = {
+            'start': threading.Barrier(1),
+            'end': threading.Event(),
+            'tasks': None
+        }
+        self.song_writer = SongWriter(
+            synchronization,
+            {'raw_data': bytearray(self.data), 'lock': threading.Lock()},
+            None,
+            VirtualClock(),
+            batch=self.batch)
+
+    def __call__(self):
+        names = [os.path.join(self.directory, str(i)) for i in range(self.count)]
+        if self.batch:
+            self.song_writer.write_batch(
+                [{'id': name, 'length': BACKLOG_SONG_SECONDS} for name in names],
+                [{'skip': False, 'stream': None, 'analyzers': ()} for _ in names], 0)
+            return
+        remaining_length = 0
+        for name in names:
+            length = BACKLOG_SONG_SECONDS + remaining_length
+            remaining_length = length - self.song_writer.write_data(name, length)
+
+    def cleanup_files(self):
+        """ Remove the written files """
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+
+    def cleanup(self):
+        """ Remove the written files and their directory """
+        self.cleanup_files()
+        os.rmdir(self.directory)
+
+def measure(function, setup=None, min_time=0.5, max_runs=1000, allocations=True):
+    """ Return the operations per second of function, and its allocations """
+    runs = 0
+    elapsed = 0.0
+    while runs < max_runs and (elapsed < min_time or runs == 0):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+        runs += 1
+    result = {'ops_per_second': runs / elapsed}
+    if not allocations:
+        return result
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    function()
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    result['peak_allocated_kb'] = peak / 1024
+    result['live_blocks'] = blocks
+    return result
+
+def run(sizes, min_time, allocations=True):
+    """ Run all the benchmarks and return the results, by case name """
+    results = {}
+    results['round_on_sample'] = measure(
+        lambda: [round_on_sample(index) for index in range(10000, 11000)],
+        min_time=min_time, allocations=allocations)
+    for size in sizes:
+        seconds = SIZES[size]
+        for shape in SHAPES:
+            data = generate(seconds, shape)
+            case = "{}/{}".format(size, shape)
+            print("Running {}...".format(case), file=sys.stderr)
+            results["find_longest_silence/{}".format(case)] = measure(
+                lambda: find_longest_silence(data),
+                min_time=min_time, allocations=allocations)
+            results["find_breaking_byte/{}".format(case)] = measure(
+                lambda: find_breaking_byte(data),
+                min_time=min_time, allocations=allocations)
+            results["find_breaking_byte_confirmed/{}".format(case)] = measure(
+                lambda: find_breaking_byte(data, candidates=CUT_CANDIDATES),
+                min_time=min_time, allocations=allocations)
+            bench = WriteDataBench(data, seconds)
+            results["write_data/{}".format(case)] = measure(
+                bench, bench.setup, min_time=min_time, allocations=allocations)
+            bench.cleanup()
+            if seconds < 2 * BACKLOG_SONG_SECONDS:
+                continue
+            for batch in (False, True):
+                bench = BacklogBench(data, batch)
+                results["{}/{}".format("write_batch" if batch else "write_backlog", case)] = (
+                    measure(bench, bench.setup, min_time=min_time, allocations=allocations))
+                bench.cleanup()
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Print the comparison to the baseline, return the regressed cases """
+    regressions = []
+    print("{:<45} {:>14} {:>14} {:>8}".format("case", "ops/s", "baseline", "ratio"))
+    for case, result in sorted(results.items()):
+        reference = baseline.get(case)
+        if reference is None:
+            print("{:<45} {:>14.2f} {:>14} {:>8}".format(
+                case, result['ops_per_second'], "-", "-"))
+            continue
+        ratio = result['ops_per_second'] / reference['ops_per_second']
+        print("{:<45} {:>14.2f} {:>14.2f} {:>8.2f}".format(
+            case, result['ops_per_second'], reference['ops_per_second'], ratio))
+        if ratio < 1 - tolerance:
+            regressions.append(case)
+    return regressions
+
+def main():
+    """ Parse options, run the benchmarks and compare or save them """
+    arg_parser = argparse.ArgumentParser(description="Songwriter micro-benchmarks")
+    arg_parser.add_argument(
+        "--sizes", default="tail",
+        help="Comma separated sizes among {} (default: %(default)s)".format(", ".join(SIZES)))
+    arg_parser.add_argument(
+        "--min-time", type=float, default=0.5,
+        help="Minimal measuring time per case, in seconds (default: %(default)s)")
+    arg_parser.add_argument(
+        "--no-allocations", action="store_false", dest="allocations",
+        help="Do not track allocations (much faster on long sizes)")
+    arg_parser.add_argument(
+        "--baseline", default=BASELINE, help="Baseline file (default: %(default)s)")
+    arg_parser.add_argument(
+        "--save-baseline", action="store_true", help="Store the results as the new baseline")
+    arg_parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="Accepted slow down ratio before reporting a regression (default: %(default)s)")
+    options = arg_parser.parse_args()
+
+    results = run(options.sizes.split(","), options.min_time, options.allocations)
+
+    baseline = {}
+    if os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline, options.tolerance)
+
+    if options.save_baseline:
+        baseline.update(results)
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(options.baseline))
+        return 0
+    if regressions:
+        print("Regressions: {}".format(", ".join(regressions)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
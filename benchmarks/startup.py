@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the command line startup: wall time of `streamrecord --help`
+and its imports, as reported by `python -X importtime`.
+
+Lists the slowest top level imports and fails if the heavy dependencies
+(numpy, Xlib, slugify, notify2) are loaded, or if the import time exceeds --budget.
+
+    python benchmarks/startup.py --runs 10 --budget 0.15
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMAND = ["-m", "streamrecord", "--help"]
+HEAVY_MODULES = ("numpy", "Xlib", "slugify", "notify2", "dbus")
+
+def parse_importtime(output):
+    """ Return the (module, self seconds, cumulative seconds, depth) imported,
+    from the stderr of python -X importtime """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_time) / 1e6, int(cumulative) / 1e6, depth))
+    return imports
+
+def run(python):
+    """ Start the command once, return its wall time and its imports """
+    start = time.perf_counter()
+    process = subprocess.run(
+        [python, "-X", "importtime"] + COMMAND, cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    return time.perf_counter() - start, parse_importtime(process.stderr)
+
+def main():
+    """ Parse options, run the benchmark and print the results """
+    arg_parser = argparse.ArgumentParser(description="Command line startup benchmark")
+    arg_parser.add_argument(
+        "--runs", type=int, default=5, help="Number of starts (default: %(default)s)")
+    arg_parser.add_argument(
+        "--top", type=int, default=10, help="Slowest imports shown (default: %(default)s)")
+    arg_parser.add_argument(
+        "--budget", type=float, help="Maximal median import time, in seconds")
+    options = arg_parser.parse_args()
+
+    walls, totals = [], []
+    for _ in range(options.runs):
+        wall, imports = run(sys.executable)
+        walls.append(wall)
+        totals.append(sum(self_time for _, self_time, _, _ in imports))
+    import_time = statistics.median(totals)
+    print("Startup: {:.1f} ms wall, {:.1f} ms importing ({} modules)".format(
+        statistics.median(walls) * 1e3, import_time * 1e3, len(imports)))
+    print("{:>12} {}".format("cumul. (ms)", "module"))
+    top_level = sorted((entry for entry in imports if entry[3] == 0), key=lambda entry: -entry[2])
+    for name, _, cumulative, _ in top_level[:options.top]:
+        print("{:>12.1f} {}".format(cumulative * 1e3, name))
+
+    status = 0
+    heavy = sorted(set(
+        name for name, _, _, _ in imports if name.split(".")[0] in HEAVY_MODULES))
+    if heavy:
+        print("Heavy modules imported at startup: {}".format(", ".join(heavy)))
+        status = 1
+    if options.budget is not None and import_time > options.budget:
+        print("Import time over the budget ({:.1f} ms)".format(options.budget * 1e3))
+        status = 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
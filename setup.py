@@ -48,11 +48,18 @@ setup(
         'python-slugify',
         'python-xlib',
         'dbus-python',
-        'notify2'
+        'notify2',
+        'numpy'
     ],
     python_requires='>=3',
     entry_points={
-        'console_scripts': ['streamrecord=streamrecord.__main__:main']
+        'console_scripts': [
+            'streamrecord=streamrecord.__main__:main',
+            'streamrecord-daemon=streamrecord.daemon:main',
+            'streamrecord-ctl=streamrecord.client:main',
+            'streamrecord-transcode=streamrecord.transcode:main',
+            'streamrecord-retag=streamrecord.retag:main'
+        ]
     },
     zip_safe=True,
     tests_require=['pytest'],
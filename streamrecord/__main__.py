@@ -9,28 +9,32 @@ It's first intended to work with Deezer, feel free to adapt it to your
 needs!
 """
 
-import os
 import re
-import queue
+import sys
 import logging
 import argparse
-import threading
+import functools
 import subprocess
 
-import notify2
-
+# Only the light modules are imported here, to start fast (see benchmarks/startup.py).
+# The recording pipeline (numpy) and the optional features are imported by main
+# once the options are parsed, Xlib and slugify by the code using them.
 if __package__ == "":
-    from pulseaudiomanager import PulseAudioManager
     from appinspector import PollAppInspector, NotifyAppInspector
-    from streamloader import StreamLoader
-    from songwriter import SongWriter
-    from encoder import Mp3LameEncoder, FlacEncoder
+    from pollschedule import PollSchedule, AdaptivePollSchedule, CPU_BUDGET
+    from encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from library import Library, DEFAULT_PATH as DEFAULT_LIBRARY_PATH
+    from rules import DropRules
+    from metrics import MetricsExporter
+    from tracing import tracer
 elif __package__ == "streamrecord":
-    from streamrecord.pulseaudiomanager import PulseAudioManager
     from streamrecord.appinspector import PollAppInspector, NotifyAppInspector
-    from streamrecord.streamloader import StreamLoader
-    from streamrecord.songwriter import SongWriter
-    from streamrecord.encoder import Mp3LameEncoder, FlacEncoder
+    from streamrecord.pollschedule import PollSchedule, AdaptivePollSchedule, CPU_BUDGET
+    from streamrecord.encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from streamrecord.library import Library, DEFAULT_PATH as DEFAULT_LIBRARY_PATH
+    from streamrecord.rules import DropRules
+    from streamrecord.metrics import MetricsExporter
+    from streamrecord.tracing import tracer
 
 def get_x_win_id():
     """ Ask the user to click on the window to record and returns its X id """
@@ -45,6 +49,19 @@ def get_x_win_id():
         if winid_matching:
             return winid_matching.group(1)
 
+def notify_end():
+    """ Show a desktop notification telling that the recording is over """
+    try:
+        import notify2
+        notify2.init("Stream Record")
+        notify2.Notification(
+            "End of record",
+            "Stream Record has finished to record songs.",
+            "dialog-information"
+        ).show()
+    except Exception as error: # No D-Bus session or notification daemon
+        logging.warning("Unable to notify the end of the record: %s", error)
+
 def main():
     """ Main function, creating interprocess ressources, threads, and launching everything """
     arg_parser = argparse.ArgumentParser()
@@ -65,6 +82,13 @@ def main():
         default=Mp3LameEncoder,
         const=FlacEncoder
     )
+    arg_parser.add_argument(
+        "--opus",
+        help="Use the Opus encoder, which encodes while recording (no raw files)",
+        action="store_const",
+        dest="encoder",
+        const=OpusEncoder
+    )
     arg_parser.add_argument(
         "--poll",
         help="Use polling for window title change detection",
@@ -73,6 +97,20 @@ def main():
         const=PollAppInspector,
         dest="app_inspector"
     )
+    arg_parser.add_argument(
+        "--poll-interval",
+        help="With --poll, poll at this fixed interval instead of polling "
+        "faster near the expected end of the tracks",
+        type=float,
+        metavar="SECONDS"
+    )
+    arg_parser.add_argument(
+        "--poll-budget",
+        help="With --poll, maximal fraction of the time spent polling (default: %(default)s)",
+        type=float,
+        default=CPU_BUDGET,
+        metavar="FRACTION"
+    )
     arg_parser.add_argument(
         "--debug", "-d",
         help="Show debug info",
@@ -85,6 +123,151 @@ def main():
         help="Record infinitely",
         action="store_true"
     )
+    arg_parser.add_argument(
+        "--sink-input",
+        help="Index of the PulseAudio sink input to record "
+        "(matched against the window's process if not set)",
+        type=int
+    )
+    arg_parser.add_argument(
+        "--skip-existing",
+        help="Do not write nor encode again the songs already recorded, "
+        "according to the library index",
+        action="store_true"
+    )
+    arg_parser.add_argument(
+        "--library",
+        help="Library index used by --skip-existing (default: %(default)s)",
+        default=DEFAULT_LIBRARY_PATH
+    )
+    arg_parser.add_argument(
+        "--dedupe",
+        help="Recognize the already recorded songs from their audio fingerprint "
+        "and do not encode them again. Stop when the playlist loops (unless --continuous)",
+        action="store_true"
+    )
+    arg_parser.add_argument(
+        "--fingerprints",
+        help="Fingerprints index used by --dedupe "
+        "(default: the one of the current directory)"
+    )
+    arg_parser.add_argument(
+        "--drop-rules",
+        help="JSON file of rules recognizing the segments not to record (ads, jingles...), "
+        "which are dropped without being written nor encoded",
+        metavar="FILE"
+    )
+    arg_parser.add_argument(
+        "--noise-floor-half-life",
+        help="Follow the noise floor of the last SECONDS of audio to detect gaps, "
+        "instead of the whole session's one",
+        type=float,
+        metavar="SECONDS"
+    )
+    arg_parser.add_argument(
+        "--rate",
+        help="Sampling rate of the capture (default: the one of the recorded stream, "
+        "not to resample it)",
+        type=int
+    )
+    arg_parser.add_argument(
+        "--channels",
+        help="Number of captured channels, 1 to record in mono "
+        "(default: the one of the recorded stream)",
+        type=int
+    )
+    arg_parser.add_argument(
+        "--bits",
+        help="Bits per captured sample (default: 16)",
+        type=int,
+        choices=[16, 24]
+    )
+    arg_parser.add_argument(
+        "--pulse-backend",
+        help="Talk to PulseAudio through libpulse ('native') or through pactl and parec "
+        "('subprocess') (default: native if libpulse is installed)",
+        choices=["native", "subprocess"]
+    )
+    arg_parser.add_argument(
+        "--no-scheduling",
+        help="Do not isolate the capture from the encoders (see the options below)",
+        action="store_false",
+        dest="scheduling"
+    )
+    arg_parser.add_argument(
+        "--capture-cpu",
+        help="CPU reserved to the capture, the encoders running on the other ones "
+        "(default: the last CPU, -1 not to pin anything)",
+        type=int
+    )
+    arg_parser.add_argument(
+        "--capture-realtime",
+        help="Run the capture with the real time scheduler at this priority (1-99), "
+        "if permitted",
+        type=int,
+        metavar="PRIORITY"
+    )
+    arg_parser.add_argument(
+        "--encoder-nice",
+        help="Nice value of the encoder processes (default: %(default)s)",
+        type=int,
+        default=10
+    )
+    arg_parser.add_argument(
+        "--encoder-ionice",
+        help="I/O scheduling class of the encoder processes, "
+        "idle, best-effort or realtime, with an optional level (default: %(default)s)",
+        default="best-effort:7",
+        metavar="CLASS[:LEVEL]"
+    )
+    arg_parser.add_argument(
+        "--no-supervisor",
+        help="Do not restart the stalled capture, inspector and encoders",
+        action="store_false",
+        dest="supervise"
+    )
+    arg_parser.add_argument(
+        "--encode-timeout",
+        help="Kill an encoding lasting more than SECONDS, keeping its raw file",
+        type=float,
+        metavar="SECONDS"
+    )
+    arg_parser.add_argument(
+        "--compress-backlog",
+        help="Compress in memory (losslessly) the audio buffered for more than SECONDS, "
+        "to hold a longer backlog when the encoders fall behind",
+        type=float,
+        metavar="SECONDS"
+    )
+    arg_parser.add_argument(
+        "--metrics",
+        help="File periodically rewritten with pipeline metrics "
+        "(JSON if it ends with '.json', Prometheus text format otherwise)"
+    )
+    arg_parser.add_argument(
+        "--metrics-interval",
+        help="Seconds between two metrics exports (default: %(default)s)",
+        type=float,
+        default=5
+    )
+    arg_parser.add_argument(
+        "--trace",
+        help="Trace the pipeline stages and write them at exit to this file, "
+        "in Chrome trace-event format (open it with https://ui.perfetto.dev)"
+    )
+    arg_parser.add_argument(
+        "--profile",
+        help="Profile every component thread and write one stats file per "
+        "component in this directory at exit",
+        metavar="DIR"
+    )
+    arg_parser.add_argument(
+        "--profile-sampling",
+        help="With --profile, sample stacks every SECONDS instead of "
+        "using cProfile (lower overhead, writes collapsed stacks)",
+        type=float,
+        metavar="SECONDS"
+    )
     options = arg_parser.parse_args()
     title_regex = re.compile(options.regex)
     if not options.winid:
@@ -97,97 +280,93 @@ def main():
     logging.info("Options parsed")
     logging.debug("Debug output activated")
 
-    # Create shared ressources
-    parec_pipe_read_end, parec_pipe_write_end = os.pipe() # create a pipe
-    parec_pipe_read_end = os.fdopen(parec_pipe_read_end, 'rb')
-    parec_pipe_write_end = os.fdopen(parec_pipe_write_end, 'wb')
-    start_barrier = threading.Barrier(4) # A barrier to synchronize thread
-    end_event = threading.Event() # Event set when all data are processed
-    task_queue = queue.Queue() # Thread safe queue for interprocess communication
-    raw_data = list() # Container of the raw data ...
-    raw_data_lock = threading.Lock() # ... and its lock
-    audio_encoder = options.encoder()
-    logging.info("Shared ressources initialized")
-
-    # Create threads
-    browser_recorder = PulseAudioManager(
-        {
-            'start': start_barrier,
-            'end': end_event
-        },
-        parec_pipe_write_end)
-
-    browser_inspector = options.app_inspector(
-        {
-            'start': start_barrier,
-            'tasks': task_queue,
-            'end': end_event
-        }, {
-            'raw_data' : raw_data,
-            'lock': raw_data_lock
-        }, {
-            'win_id': options.winid,
-            'title_regex': title_regex
-        },
-        options.continuous)
-
-    stream_loader = StreamLoader(
-        {
-            'start': start_barrier,
-            'end': end_event
-        },
-        parec_pipe_read_end,
-        {
-            'raw_data' : raw_data,
-            'lock': raw_data_lock
-        })
+    if __package__ == "":
+        from recording import Recording
+    elif __package__ == "streamrecord":
+        from streamrecord.recording import Recording
 
-    song_writer = SongWriter(
-        {
-            'start': start_barrier,
-            'tasks': task_queue,
-            'end': end_event
-        }, {
-            'raw_data' : raw_data,
-            'lock': raw_data_lock
-        },
-        audio_encoder
-        )
+    scheduling = None
+    if options.scheduling:
+        if __package__ == "":
+            from scheduling import default_policies, parse_ionice
+        elif __package__ == "streamrecord":
+            from streamrecord.scheduling import default_policies, parse_ionice
+        scheduling = default_policies(
+            options.capture_cpu, capture_realtime=options.capture_realtime,
+            encoder_nice=options.encoder_nice,
+            encoder_ionice=parse_ionice(options.encoder_ionice))
 
-    logging.info("Threads initialized. Ready for launching")
+    library = Library(options.library) if options.skip_existing else None
+    app_inspector = options.app_inspector
+    if app_inspector is PollAppInspector:
+        if options.poll_interval:
+            schedule = PollSchedule(options.poll_interval)
+        else:
+            schedule = AdaptivePollSchedule(
+                known_length=library and library.duration, cpu_budget=options.poll_budget)
+        app_inspector = functools.partial(PollAppInspector, schedule=schedule)
 
-    browser_recorder.start()
-    browser_inspector.start()
-    stream_loader.start()
-    song_writer.start()
+    fingerprints = None
+    if options.dedupe:
+        if __package__ == "":
+            from fingerprint import FingerprintIndex, DEFAULT_PATH
+        elif __package__ == "streamrecord":
+            from streamrecord.fingerprint import FingerprintIndex, DEFAULT_PATH
+        options.fingerprints = options.fingerprints or DEFAULT_PATH
+        fingerprints = FingerprintIndex.load(options.fingerprints)
+    recording = Recording(
+        options.winid,
+        title_regex,
+        options.encoder(),
+        app_inspector,
+        options.continuous,
+        options.sink_input,
+        noise_floor_half_life=options.noise_floor_half_life,
+        library=library,
+        fingerprints=fingerprints,
+        rate=options.rate,
+        channels=options.channels,
+        sample_width=options.bits // 8 if options.bits else None,
+        drop_rules=DropRules.load(options.drop_rules) if options.drop_rules else None,
+        pulse_backend=options.pulse_backend,
+        scheduling=scheduling,
+        supervise=options.supervise,
+        encode_timeout=options.encode_timeout,
+        compress_backlog=options.compress_backlog)
+    if options.trace:
+        tracer.enable()
+    metrics_exporter = None
+    if options.metrics:
+        metrics_exporter = MetricsExporter(options.metrics, options.metrics_interval)
+        metrics_exporter.start()
+    profiler = None
+    if options.profile:
+        if __package__ == "":
+            from profiling import Profiler
+        elif __package__ == "streamrecord":
+            from streamrecord.profiling import Profiler
+        profiler = Profiler(options.profile, options.profile_sampling)
+        recording.profile(profiler)
+    recording.start()
 
     try:
-        end_event.wait()
+        recording.end_event.wait()
     except KeyboardInterrupt:
-        end_event.set()
+        recording.stop()
 
-    browser_recorder.join()
-    logging.info("%s joined", repr(browser_recorder))
-    parec_pipe_write_end.close()
-
-    stream_loader.join()
-    logging.info("%s joined", repr(stream_loader))
-    parec_pipe_read_end.close()
-
-    browser_inspector.join()
-    logging.info("%s joined", repr(browser_inspector))
-
-    song_writer.join()
-    logging.info("%s joined", repr(song_writer))
+    recording.join()
+    if fingerprints is not None:
+        fingerprints.save(options.fingerprints)
+    if metrics_exporter is not None:
+        metrics_exporter.stop()
+    if options.trace:
+        tracer.export(options.trace)
+    if profiler is not None:
+        profiler.stop()
 
     logging.info("Exit")
-
-    notify2.init("Stream Record")
-    notify2.Notification(
-        "End of record",
-        "Stream Record has finished to record songs.",
-        "dialog-information"
-    ).show()
+    notify_end()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
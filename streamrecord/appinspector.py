@@ -6,17 +6,48 @@ Implementation of the class watching the playing application
 import json
 import time
 import select
+import socket
 import logging
 import threading
 import subprocess
 
-import Xlib.display
-import Xlib.X
-import Xlib.Xatom
+if __package__ == "":
+    from tracing import tracer
+    from clock import Clock
+    from metrics import registry
+    from pollschedule import PollSchedule
+elif __package__ == "streamrecord":
+    from streamrecord.tracing import tracer
+    from streamrecord.clock import Clock
+    from streamrecord.metrics import registry
+    from streamrecord.pollschedule import PollSchedule
+
+XWININFO_TIMEOUT = 5 # Seconds, a stuck xwininfo fails the detection
+
+def get_x_win_pid(win_id):
+    """ Return the PID of the process owning a window (from its _NET_WM_PID property),
+    or None if the window manager does not provide it """
+    import Xlib.display # Slow to import, only loaded when needed
+    import Xlib.X
+    if isinstance(win_id, str):
+        win_id = int(win_id, 16)
+    display = Xlib.display.Display()
+    try:
+        window = display.create_resource_object('window', win_id)
+        pid_property = window.get_full_property(
+            display.intern_atom('_NET_WM_PID'),
+            Xlib.X.AnyPropertyType
+        )
+        if pid_property and len(pid_property.value):
+            return int(pid_property.value[0])
+        return None
+    finally:
+        display.close()
 
 class AppInspector(threading.Thread):
     """ Inspect the Application title to detect song change """
-    def __init__(self, synchronization, data, x_info, continuous=False):
+    def __init__(self, synchronization, data, x_info, continuous=False, clock=None,
+                 rules=None):
         super(AppInspector, self).__init__(name="Application Inspector")
         self.thread_start = synchronization['start']
         self.thread_end = synchronization['end']
@@ -29,6 +60,9 @@ class AppInspector(threading.Thread):
                 16)
         self.title_regex = x_info['title_regex']
         self.continuous = continuous
+        self.clock = Clock() if clock is None else clock
+        self.rules = rules # If given, DropRules of the segments not to write
+        self.heartbeat = None # time.monotonic() of the last detection, see Supervisor
 
     def get_x_win_title(self):
         """ Get the title of the application's window """
@@ -38,17 +72,26 @@ class AppInspector(threading.Thread):
             ],
             stdout=subprocess.PIPE
             )
-        stdout = xwininfo_process.communicate()[0].decode()
+        try:
+            stdout = xwininfo_process.communicate(timeout=XWININFO_TIMEOUT)[0].decode()
+        except subprocess.TimeoutExpired:
+            xwininfo_process.kill()
+            xwininfo_process.wait()
+            raise
         return stdout.splitlines()[1].split('"')[1]
 
     def detect_changes(self, previous_name, previous_time):
         raise NotImplementedError()
 
+    def reconnect(self):
+        """ Recover from a failure of detect_changes: nothing to do by default,
+        each detection querying the window anew """
+
     def run(self):
         logging.info("Start barrier reached")
         self.thread_start.wait()
 
-        previous_time = time.time()
+        previous_time = self.clock.time()
         initial_name = self.get_x_win_title()
         previous_name = initial_name
         recording_initial = False
@@ -59,7 +102,7 @@ class AppInspector(threading.Thread):
         else:
             logging.info("Recording infinitely")
 
-        time.sleep(1)
+        self.clock.sleep(1)
 
         while ((self.continuous and not self.thread_end.is_set()) or
                 (not self.continuous and (
@@ -67,7 +110,16 @@ class AppInspector(threading.Thread):
                 ))
             ):
 
-            current_name, new_time = self.detect_changes(previous_name, previous_time)
+            self.heartbeat = time.monotonic()
+            try:
+                current_name, new_time = self.detect_changes(previous_name, previous_time)
+            except Exception:
+                # The task queue and the buffer are untouched: the song is still cut
+                logging.exception("Title change detection failed, reconnecting")
+                self.clock.sleep(1)
+                self.reconnect()
+                continue
+            tracer.instant("title_change", new_time, song=new_time, title=current_name)
             logging.info("Song changed => '%s'", current_name)
 
             # We're back to the first song. Let's record it from the beginning
@@ -84,6 +136,7 @@ class AppInspector(threading.Thread):
                 'id': new_time,
                 'length': new_time-previous_time,
                 'hard_length': isinstance(self, NotifyAppInspector),
+                'window_title': previous_name,
                 'infos': {
                     'title': matching.group('title'),
                     'artist': matching.group('artist')
@@ -102,39 +155,91 @@ class AppInspector(threading.Thread):
         logging.info("Exit")
 
     def launch_task(self, task):
+        rule = self.rules.match(task) if self.rules is not None else None
+        if rule is not None:
+            # Still queued: the song writer drops its data from the buffer
+            logging.info("'%s' matches the drop rule %s", task['window_title'], rule.name)
+            task['drop'] = rule.name
         logging.debug("Adding a 'writing' task")
         self.task_queue.put(task)
+        tracer.instant("task_queued", song=task['id'], queue_depth=self.task_queue.qsize())
 
 
 class PollAppInspector(AppInspector):
     """ Detect title changes using a polling technique """
 
+    def __init__(self, *args, schedule=None, **kargs):
+        """ schedule: PollSchedule of the polls, every second by default """
+        super().__init__(*args, **kargs)
+        self.schedule = PollSchedule() if schedule is None else schedule
+
     def detect_changes(self, previous_name, previous_time):
+        matching = self.title_regex.match(previous_name)
+        self.schedule.track_started(previous_time, matching and {
+            'title': matching.group('title'),
+            'artist': matching.group('artist')
+        })
+        last_poll = None
         while True:
+            self.heartbeat = time.monotonic()
+            poll_start = time.perf_counter()
             current_name = self.get_x_win_title()
+            self.schedule.polled(time.perf_counter() - poll_start)
+            registry.inc("streamrecord_title_polls_total")
+            now = self.clock.time()
             # Song has changed
             if previous_name != current_name and self.title_regex.match(current_name):
-                return current_name, time.time()
+                return current_name, self.schedule.change_time(last_poll, now)
             else:
-                time.sleep(1)
+                last_poll = now
+                self.clock.sleep(self.schedule.next_interval(now))
 
 class NotifyAppInspector(AppInspector):
     """ Detect title changes subscribing to XServer events notification. """
 
     def __init__(self, *args, **kargs):
         super().__init__(*args, **kargs)
+        self.connect()
+
+    def connect(self):
+        """ Open the connection to the X server """
+        # Xlib is slow to import and not needed when polling: it is only loaded here
+        import Xlib.display
         self.display = Xlib.display.Display()
         self.window = self.display.create_resource_object(
             'window',
             self.browser_x_winid
         )
 
+    def reconnect(self):
+        """ Replace the failed connection to the X server """
+        try:
+            self.display.close()
+        except Exception:
+            pass # Already broken
+        self.connect()
+
+    def interrupt(self):
+        """ Shut the connection to the X server down, from another thread, for
+        the stalled detect_changes to fail and the inspector to reconnect """
+        try:
+            self.display.display.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def detect_changes(self, previous_name, previous_time):
+        import Xlib.X
+        import Xlib.Xatom
         self.window.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
         while True:
+            self.heartbeat = time.monotonic()
+            if not self.display.pending_events():
+                # Wake up regularly to beat, instead of blocking in next_event
+                select.select([self.display], [], [], 1)
+                continue
             event = self.display.next_event()
             if event.atom == Xlib.Xatom.WM_NAME:
-                new_time = time.time()
+                new_time = self.clock.time()
                 new_name = self.get_x_win_title()
                 if new_name != previous_name:
                     self.window.change_attributes(event_mask=Xlib.X.NoEventMask)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Format of the captured raw audio, shared by the capture source, the
+analysis of the stream and the encoders
+"""
+
+import re
+
+class AudioFormat:
+    """ Raw audio made of interleaved frames of signed little endian samples """
+    PULSE_FORMATS = {2: "s16le", 3: "s24le"} # Supported sample widths, in bytes
+
+    def __init__(self, rate=44100, channels=2, sample_width=2):
+        """
+        rate: Number of frames per second
+        channels: Number of samples per frame
+        sample_width: Number of bytes per sample (see PULSE_FORMATS)
+        """
+        if sample_width not in self.PULSE_FORMATS:
+            raise ValueError("Unsupported sample width: {}".format(sample_width))
+        self.rate = int(rate)
+        self.channels = int(channels)
+        self.sample_width = int(sample_width)
+        self.frame_bytes = self.channels * self.sample_width
+        self.bytes_per_second = self.rate * self.frame_bytes
+
+    def __eq__(self, other):
+        return (isinstance(other, AudioFormat) and
+                (self.rate, self.channels, self.sample_width) ==
+                (other.rate, other.channels, other.sample_width))
+
+    def __repr__(self):
+        return "AudioFormat({}, {}, {})".format(self.rate, self.channels, self.sample_width)
+
+    def __str__(self):
+        return "{} {}ch {}Hz".format(self.pulse_format, self.channels, self.rate)
+
+    @property
+    def pulse_format(self):
+        """ Return the PulseAudio name of the sample format """
+        return self.PULSE_FORMATS[self.sample_width]
+
+    @property
+    def bits(self):
+        """ Return the number of bits per sample """
+        return 8 * self.sample_width
+
+    @classmethod
+    def from_sample_spec(cls, sample_spec, sample_width=2):
+        """ Return the format of a PulseAudio sample spec ("float32le 2ch 48000Hz"),
+        with samples of sample_width bytes whatever the spec format is, or None
+        if the spec cannot be parsed """
+        matching = re.search(r"(\d+)ch (\d+)Hz", sample_spec or "")
+        if not matching:
+            return None
+        return cls(int(matching.group(2)), int(matching.group(1)), sample_width)
+
+    def round(self, byte_index):
+        """ Return the greatest index not after byte_index on a frame boundary """
+        byte_index = int(byte_index)
+        return byte_index - byte_index % self.frame_bytes
+
+    def samples(self, data):
+        """ Return the whole frames of data as a (frames, channels) numpy array,
+        scaled to 16 bits samples (not copied for 16 bits samples) """
+        import numpy # Not needed to start, see benchmarks/startup.py
+        data = bytes(data[:self.round(len(data))])
+        if self.sample_width == 2:
+            return numpy.frombuffer(data, dtype='<i2').reshape(-1, self.channels)
+        # 24 bits samples: padded to 32 bits, the sign being given by the highest byte
+        padded = numpy.zeros((len(data) // 3, 4), dtype=numpy.uint8)
+        padded[:, 1:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+        return (padded.view('<i4')[:, 0] / 65536.0).reshape(-1, self.channels)
+
+DEFAULT_FORMAT = AudioFormat() # CD quality, parec default
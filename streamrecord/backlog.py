@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Buffer of the captured audio keeping its old part losslessly compressed in
+memory, so that a long backlog (encoders falling behind) fits in less memory
+"""
+
+import zlib
+import logging
+import threading
+import collections
+
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+CHUNK_SECONDS = 10 # Audio compressed at once
+COMPRESS_AFTER = 60 # Seconds of the most recent audio which are never compressed
+LEVEL = 1 # zlib compression level: the ratio hardly improves with higher levels
+
+def pack(data, audio_format=DEFAULT_FORMAT, level=LEVEL):
+    """ Return data compressed: with 16 bits whole frames, the samples are
+    replaced by their difference with the previous sample of their channel,
+    and the low and high bytes of the differences are grouped, before zlib """
+    if audio_format.sample_width != 2 or len(data) % audio_format.frame_bytes:
+        return b"z" + zlib.compress(data, level)
+    import numpy # Not needed to start, see benchmarks/startup.py
+    samples = numpy.frombuffer(data, dtype='<i2').reshape(-1, audio_format.channels)
+    delta = numpy.empty_like(samples)
+    delta[:1] = samples[:1]
+    numpy.subtract(samples[1:], samples[:-1], out=delta[1:]) # Wraps around, as cumsum
+    planes = delta.view(numpy.uint8).reshape(-1, 2).T
+    return b"d" + zlib.compress(planes.tobytes(), level)
+
+def unpack(packed, audio_format=DEFAULT_FORMAT):
+    """ Return the data compressed by pack """
+    data = zlib.decompress(packed[1:])
+    if packed[:1] == b"z":
+        return data
+    import numpy
+    planes = numpy.frombuffer(data, dtype=numpy.uint8).reshape(2, -1)
+    delta = numpy.ascontiguousarray(planes.T).view('<i2').reshape(-1, audio_format.channels)
+    return numpy.cumsum(delta, axis=0, dtype='<i2').tobytes()
+
+class Chunk:
+    """ Part of a CompressedBacklog, held raw or packed. The beginning of a
+    packed chunk is skipped once cut, instead of decompressing it. """
+    __slots__ = ('raw', 'packed', 'start', 'length')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.packed = None
+        self.start = 0 # Bytes of the packed data cut from the buffer
+        self.length = len(raw)
+
+class CompressedBacklog:
+    """ Buffer of raw audio usable as the raw data list of the stream loader
+    and the song writer: it is extended at its end, read by slices and
+    deleted from its beginning (the callers holding the raw data lock).
+    Full chunks older than compress_after seconds are compressed by a
+    background thread (see start), and decompressed when read. """
+    def __init__(self, audio_format=DEFAULT_FORMAT, compress_after=COMPRESS_AFTER,
+                 chunk_seconds=CHUNK_SECONDS, level=LEVEL):
+        """
+        audio_format: AudioFormat of the buffered audio
+        compress_after: Seconds of audio after which it is compressed
+        chunk_seconds: Seconds of audio compressed at once
+        level: zlib compression level
+        """
+        self.audio_format = audio_format
+        self.compress_after = audio_format.round(compress_after * audio_format.bytes_per_second)
+        self.chunk_bytes = max(
+            audio_format.round(chunk_seconds * audio_format.bytes_per_second),
+            audio_format.frame_bytes)
+        self.level = level
+        self.chunks = collections.deque() # Full chunks, from the oldest
+        self.tail = bytearray() # Newest data, not filling a chunk yet
+        self.length = 0
+        self.lock = threading.Lock() # Guards the chunks against the compressor thread
+        self.wakeup = threading.Condition(self.lock)
+        self.sealed = False # Were chunks filled since the last compression?
+        self.closed = False
+        self.compressor = threading.Thread(target=self.run, name="Backlog Compressor",
+                                           daemon=True)
+
+    def __len__(self):
+        return self.length
+
+    def __bytes__(self):
+        return self[0:self.length]
+
+    def extend(self, data):
+        """ Append data at the end of the buffer """
+        with self.lock:
+            self.tail.extend(data)
+            self.length += len(data)
+            if len(self.tail) < self.chunk_bytes:
+                return
+            while len(self.tail) >= self.chunk_bytes:
+                self.chunks.append(Chunk(bytes(self.tail[:self.chunk_bytes])))
+                del self.tail[:self.chunk_bytes]
+            self.sealed = True
+            self.wakeup.notify()
+
+    def __getitem__(self, index):
+        """ Return the bytes of a slice of the buffer """
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("CompressedBacklog only supports contiguous slices")
+        start, stop, _ = index.indices(self.length)
+        parts = [] # Raw or packed data of each chunk, and the bounds of the slice in it
+        with self.lock:
+            offset = 0
+            for chunk in self.chunks:
+                if offset >= stop:
+                    break
+                if offset + chunk.length > start:
+                    parts.append((
+                        chunk.raw, chunk.packed,
+                        chunk.start + max(start - offset, 0), chunk.start + stop - offset))
+                offset += chunk.length
+            if offset < stop:
+                parts.append((bytes(self.tail[max(start - offset, 0):stop - offset]),
+                              None, 0, stop))
+        # Chunks data are never modified but replaced: they are decompressed
+        # without the lock, for the capture not to wait for it
+        return b"".join(
+            (raw if raw is not None else unpack(packed, self.audio_format))[begin:end]
+            for raw, packed, begin, end in parts)
+
+    def __delitem__(self, index):
+        """ Delete the beginning of the buffer """
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError("CompressedBacklog only supports contiguous slices")
+        start, stop, _ = index.indices(self.length)
+        if start != 0:
+            raise ValueError("Only the beginning of a CompressedBacklog can be deleted")
+        with self.lock:
+            remaining = stop
+            while self.chunks and remaining >= self.chunks[0].length:
+                remaining -= self.chunks.popleft().length
+            if self.chunks and remaining:
+                chunk = self.chunks[0]
+                if chunk.raw is not None:
+                    chunk.raw = chunk.raw[remaining:]
+                else:
+                    chunk.start += remaining
+                chunk.length -= remaining
+            elif remaining:
+                del self.tail[:remaining]
+            self.length -= stop
+
+    def memory(self):
+        """ Return the number of bytes used by the buffered data """
+        with self.lock:
+            return len(self.tail) + sum(
+                chunk.length if chunk.raw is not None else len(chunk.packed)
+                for chunk in self.chunks)
+
+    def compress_old_chunks(self):
+        """ Compress the full chunks older than compress_after, return their number.
+        The compression runs without the lock: the buffer stays usable meanwhile. """
+        compressed = 0
+        while True:
+            with self.lock:
+                newer = len(self.tail) # Bytes after the examined chunk
+                candidate = None
+                for chunk in reversed(self.chunks):
+                    if newer >= self.compress_after and chunk.raw is not None:
+                        # Cut chunks are not compressed
+                        if chunk.length == self.chunk_bytes:
+                            candidate = chunk
+                    newer += chunk.length
+                if candidate is None:
+                    return compressed
+                raw = candidate.raw
+            packed = pack(raw, self.audio_format, self.level) # zlib releases the GIL
+            with self.lock:
+                if candidate.raw is raw: # Not cut meanwhile
+                    candidate.raw, candidate.packed = None, packed
+                    compressed += 1
+
+    def run(self):
+        """ Compress the old chunks as they age """
+        while True:
+            with self.lock:
+                while not (self.sealed or self.closed):
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+                self.sealed = False
+            self.compress_old_chunks()
+
+    def start(self):
+        """ Start the compressor thread """
+        self.compressor.start()
+        logging.info("Compressing the audio buffered for more than %ds",
+                     self.compress_after // self.audio_format.bytes_per_second)
+
+    def close(self):
+        """ Stop the compressor thread """
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        if self.compressor.ident is not None: # Started
+            self.compressor.join()
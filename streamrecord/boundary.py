@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Scoring of the candidate cut points between two songs by their spectral
+discontinuity, to tell a gap between songs from a quiet passage of a song
+"""
+
+import numpy
+
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+FRAME_SECONDS = 0.025 # Short-time spectra frames, rounded down to a power of 2 samples
+CONTEXT_SECONDS = 0.3 # Audio compared on each side of a candidate
+
+def spectral_flux_scores(raw_data, spans, audio_format=DEFAULT_FORMAT,
+                         context_seconds=CONTEXT_SECONDS):
+    """ Return the spectral discontinuity across each candidate gap of raw_data.
+    spans: (start, end) frame numbers of the candidate gaps
+    The score is the spectral flux (L1 distance) between the normalized mean power
+    spectra of the context_seconds before and after the gap: close to 0 when both
+    sides sound alike, whatever their loudness, and up to 2 for disjoint spectra.
+    Contexts are cut at the data boundaries; a gap without context scores 0.
+    The spectra of all the contexts are computed in one batched FFT. """
+    spans = numpy.asarray(spans, dtype=numpy.int64).reshape(-1, 2)
+    frame_frames = 1 << int(numpy.log2(FRAME_SECONDS * audio_format.rate))
+    # Channels are mixed, the scale does not matter as spectra are normalized
+    samples = audio_format.samples(raw_data)
+    mono = samples[:, 0].astype(numpy.float32)
+    for channel in range(1, audio_format.channels):
+        mono += samples[:, channel]
+    count = len(mono) // frame_frames # Number of (not overlapping) spectra frames
+    if count < 1:
+        return numpy.zeros(len(spans))
+    context = max(int(context_seconds * audio_format.rate) // frame_frames, 1)
+    # Spectra frames fully before the gap start, and fully after the gap end
+    before_end = numpy.clip(spans[:, 0] // frame_frames, 0, count)
+    after_start = numpy.clip(-(-spans[:, 1] // frame_frames), 0, count)
+    offsets = numpy.arange(context)
+    frames = numpy.concatenate(
+        (before_end[:, None] - context + offsets, after_start[:, None] + offsets), axis=1)
+    valid = (frames >= 0) & (frames < count)
+    indexes = (numpy.clip(frames, 0, count - 1)[:, :, None] * frame_frames +
+               numpy.arange(frame_frames))
+    spectra = numpy.abs(numpy.fft.rfft(mono[indexes] * numpy.hanning(frame_frames))) ** 2
+    spectra *= valid[:, :, None]
+    before = spectra[:, :context].sum(axis=1)
+    after = spectra[:, context:].sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        before /= before.sum(axis=1, keepdims=True)
+        after /= after.sum(axis=1, keepdims=True)
+    return numpy.nan_to_num(numpy.abs(after - before).sum(axis=1))
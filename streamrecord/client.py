@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Small command line client driving a running recorder daemon
+through its control socket
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+
+def default_socket_path():
+    """ Return the default path of the daemon control socket """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "streamrecord.sock")
+    return "/tmp/streamrecord-{}.sock".format(os.getuid())
+
+def send_command(socket_path, command):
+    """ Send one command to the daemon and return its decoded answer
+    socket_path: Path of the daemon control socket
+    command: Dictionnary with at least a 'command' key
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rwb') as stream:
+            stream.write(json.dumps(command).encode() + b"\n")
+            stream.flush()
+            return json.loads(stream.readline().decode())
+
+def main():
+    """ Parse the command line, send the command and print the answer """
+    arg_parser = argparse.ArgumentParser(description="Control a streamrecord daemon")
+    arg_parser.add_argument(
+        "--socket",
+        default=default_socket_path(),
+        help="Path of the daemon control socket (default: %(default)s)"
+    )
+    subparsers = arg_parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    start_parser = subparsers.add_parser("start", help="Start a new recording")
+    start_parser.add_argument(
+        "--id",
+        required=True,
+        help="X Window ID of the windows to record audio from",
+        dest="win_id"
+    )
+    start_parser.add_argument(
+        "--sink-input",
+        type=int,
+        help="Index of the PulseAudio sink input to record (matched against the window if not set)"
+    )
+    start_parser.add_argument(
+        "--regex",
+        help="Regex to extract artist and title from window title"
+    )
+    start_parser.add_argument(
+        "--encoder",
+        choices=["mp3", "flac", "opus"],
+        default="mp3",
+        help="Encoder to use (default: %(default)s)"
+    )
+    start_parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Use polling for window title change detection"
+    )
+    start_parser.add_argument(
+        "--poll-interval",
+        type=float,
+        metavar="SECONDS",
+        help="With --poll, poll at this fixed interval instead of polling faster "
+        "near the expected end of the tracks"
+    )
+    start_parser.add_argument(
+        "--poll-budget",
+        type=float,
+        metavar="FRACTION",
+        help="With --poll, maximal fraction of the time spent polling (default: 0.1)"
+    )
+    start_parser.add_argument(
+        "--continuous", "-c",
+        action="store_true",
+        help="Record infinitely"
+    )
+    start_parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="Do not write nor encode again the songs already recorded"
+    )
+    start_parser.add_argument(
+        "--library",
+        help="Library index used by --skip-existing (relative to the daemon directory)"
+    )
+    start_parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Do not encode again the songs sounding like already recorded ones, "
+        "stop when the playlist loops"
+    )
+    start_parser.add_argument(
+        "--fingerprints",
+        help="Fingerprints index used by --dedupe (relative to the daemon directory)"
+    )
+    start_parser.add_argument(
+        "--drop-rules",
+        metavar="FILE",
+        help="JSON file of rules recognizing the segments not to record "
+        "(relative to the daemon directory)"
+    )
+    start_parser.add_argument(
+        "--noise-floor-half-life",
+        type=float,
+        metavar="SECONDS",
+        help="Follow the noise floor of the last SECONDS of audio to detect gaps"
+    )
+    start_parser.add_argument(
+        "--rate",
+        type=int,
+        help="Sampling rate of the capture (default: the one of the recorded stream)"
+    )
+    start_parser.add_argument(
+        "--channels",
+        type=int,
+        help="Number of captured channels (default: the one of the recorded stream)"
+    )
+    start_parser.add_argument(
+        "--bits",
+        type=int,
+        choices=[16, 24],
+        help="Bits per captured sample (default: 16)"
+    )
+    start_parser.add_argument(
+        "--pulse-backend",
+        choices=["native", "subprocess"],
+        help="Talk to PulseAudio through libpulse or through pactl and parec "
+        "(default: native if libpulse is installed)"
+    )
+    start_parser.add_argument(
+        "--no-scheduling",
+        action="store_true",
+        help="Do not isolate the capture from the encoders"
+    )
+    start_parser.add_argument(
+        "--capture-cpu",
+        type=int,
+        help="CPU reserved to the capture (default: the last CPU, -1 not to pin anything)"
+    )
+    start_parser.add_argument(
+        "--capture-realtime",
+        type=int,
+        metavar="PRIORITY",
+        help="Run the capture with the real time scheduler at this priority, if permitted"
+    )
+    start_parser.add_argument(
+        "--encoder-nice",
+        type=int,
+        help="Nice value of the encoder processes (default: 10)"
+    )
+    start_parser.add_argument(
+        "--encoder-ionice",
+        metavar="CLASS[:LEVEL]",
+        help="I/O scheduling class of the encoder processes (default: best-effort:7)"
+    )
+    start_parser.add_argument(
+        "--no-supervisor",
+        action="store_true",
+        help="Do not restart the stalled capture, inspector and encoders"
+    )
+    start_parser.add_argument(
+        "--encode-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Kill an encoding lasting more than SECONDS, keeping its raw file"
+    )
+    start_parser.add_argument(
+        "--compress-backlog",
+        type=float,
+        metavar="SECONDS",
+        help="Compress in memory the audio buffered for more than SECONDS"
+    )
+    subparsers.add_parser("stop", help="Stop the current recording")
+    subparsers.add_parser("status", help="Show the state of the daemon")
+    subparsers.add_parser("metrics", help="Show the pipeline metrics")
+    subparsers.add_parser("shutdown", help="Stop the current recording and the daemon")
+
+    options = vars(arg_parser.parse_args())
+    socket_path = options.pop("socket")
+    command = {key: value for key, value in options.items() if value is not None}
+
+    try:
+        answer = send_command(socket_path, command)
+    except OSError as error:
+        print("Unable to reach the daemon on {}: {}".format(socket_path, error), file=sys.stderr)
+        return 2
+
+    print(json.dumps(answer, indent=2))
+    return 0 if answer.get('ok') else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Implementation of the clocks used by the threads to wait and timestamp,
+allowing tests and benchmarks to run in virtual time
+"""
+
+import time
+import threading
+
+class Clock:
+    """ Real time clock, the default one """
+
+    def time(self):
+        """ Return the current time in seconds since the epoch """
+        return time.time()
+
+    def sleep(self, seconds):
+        """ Suspend the calling thread for seconds """
+        time.sleep(seconds)
+
+class VirtualClock(Clock):
+    """ Clock whose time only advances when a thread sleeps: sleeping is instant.
+    Long sessions (thousands of tracks, hours of continuous recording) then
+    run as fast as the code allows.
+    Each thread sleeps from the time it last woke up at, and the time advances
+    to the earliest deadline of the sleeping threads: threads sleeping
+    concurrently move the time forward as much as the longest of them, not as
+    their sum. """
+    def __init__(self, start=0.0):
+        self.now = start
+        self.floor = start # Time reached by every thread, moved by advance
+        self.lock = threading.Lock()
+        self.woken = threading.Condition(self.lock)
+        self.deadlines = [] # Wake up times of the sleeping threads
+        self.threads = threading.local() # Time each thread last woke up at
+
+    def time(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            start = max(getattr(self.threads, 'wakeup', self.now), self.floor)
+            deadline = start + max(seconds, 0)
+            self.deadlines.append(deadline)
+            while deadline > self.now:
+                if deadline == min(self.deadlines):
+                    self.now = deadline
+                    self.woken.notify_all()
+                else:
+                    self.woken.wait()
+            self.deadlines.remove(deadline)
+            self.threads.wakeup = deadline
+        time.sleep(0) # Let the other threads run
+
+    def advance(self, seconds):
+        """ Move the time forward of seconds, for every thread """
+        with self.lock:
+            self.now += max(seconds, 0)
+            self.floor = self.now
+            self.woken.notify_all()
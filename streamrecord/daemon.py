@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Long-running recorder, driven through a Unix-domain control socket.
+Heavy modules, encoders and compiled regexes are loaded once, so starting a
+recording only costs the creation of its threads.
+
+The protocol is line based: each request is a JSON object with a 'command'
+key ('start', 'stop', 'status', 'metrics' or 'shutdown'), each answer is a JSON object
+with an 'ok' key.
+"""
+
+import os
+import re
+import json
+import functools
+import logging
+import argparse
+import threading
+import socketserver
+
+if __package__ == "":
+    from appinspector import PollAppInspector, NotifyAppInspector
+    from pollschedule import PollSchedule, AdaptivePollSchedule, CPU_BUDGET
+    from encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from recording import Recording
+    from client import default_socket_path
+    from metrics import registry, MetricsExporter
+    from tracing import tracer
+    from profiling import Profiler
+    from library import Library, DEFAULT_PATH as DEFAULT_LIBRARY_PATH
+    from rules import DropRules
+    from fingerprint import FingerprintIndex, DEFAULT_PATH as DEFAULT_FINGERPRINTS_PATH
+    from scheduling import default_policies, parse_ionice, ENCODER_NICE, ENCODER_IONICE
+elif __package__ == "streamrecord":
+    from streamrecord.appinspector import PollAppInspector, NotifyAppInspector
+    from streamrecord.pollschedule import PollSchedule, AdaptivePollSchedule, CPU_BUDGET
+    from streamrecord.encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from streamrecord.recording import Recording
+    from streamrecord.client import default_socket_path
+    from streamrecord.metrics import registry, MetricsExporter
+    from streamrecord.tracing import tracer
+    from streamrecord.profiling import Profiler
+    from streamrecord.library import Library, DEFAULT_PATH as DEFAULT_LIBRARY_PATH
+    from streamrecord.rules import DropRules
+    from streamrecord.fingerprint import (
+        FingerprintIndex, DEFAULT_PATH as DEFAULT_FINGERPRINTS_PATH)
+    from streamrecord.scheduling import (
+        default_policies, parse_ionice, ENCODER_NICE, ENCODER_IONICE)
+
+DEFAULT_REGEX = r"(?P<title>.+) - (?P<artist>.+) - .*"
+ENCODERS = {
+    'mp3': Mp3LameEncoder,
+    'flac': FlacEncoder,
+    'opus': OpusEncoder
+}
+
+class ControlRequestHandler(socketserver.StreamRequestHandler):
+    """ Handle the commands sent on one connection of the control socket """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                handler = getattr(self.server, "do_{}".format(request['command']), None)
+                if handler is None:
+                    raise ValueError("Unknown command '{}'".format(request['command']))
+                answer = handler(request)
+                answer['ok'] = True
+            except Exception as error: # Report any error to the client, keep serving
+                logging.exception("Command failed")
+                answer = {'ok': False, 'error': str(error)}
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+            self.wfile.flush()
+
+class RecorderDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Control socket server owning at most one recording at a time """
+    daemon_threads = True
+
+    def __init__(self, socket_path, profiler=None):
+        self.socket_path = socket_path
+        self.profiler = profiler # Profiler installed in the threads of each recording
+        self.encoders = {} # Encoder instances, kept between recordings
+        self.title_regexes = {} # Compiled regexes, kept between recordings
+        self.libraries = {} # Loaded library indexes, kept between recordings
+        self.fingerprints = {} # Loaded fingerprints indexes, kept between recordings
+        self.drop_rules = {} # Loaded (compiled) drop rules, kept between recordings
+        self.recording = None
+        self.reaper = None # Thread joining the current recording once it ended
+        self.ended = False # No recording can start anymore
+        self.recording_lock = threading.Lock()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path) # Stale socket from a previous run
+        super(RecorderDaemon, self).__init__(socket_path, ControlRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def get_encoder(self, name):
+        """ Return the (cached) encoder instance for the given name """
+        if name not in self.encoders:
+            self.encoders[name] = ENCODERS[name]()
+        return self.encoders[name]
+
+    def get_title_regex(self, regex):
+        """ Return the (cached) compiled version of regex """
+        if regex not in self.title_regexes:
+            self.title_regexes[regex] = re.compile(regex)
+        return self.title_regexes[regex]
+
+    def get_library(self, path):
+        """ Return the (cached) library index stored at path """
+        path = os.path.abspath(path)
+        if path not in self.libraries:
+            self.libraries[path] = Library(path)
+        return self.libraries[path]
+
+    def get_fingerprints(self, path):
+        """ Return the (cached) fingerprints index stored at path """
+        path = os.path.abspath(path)
+        if path not in self.fingerprints:
+            self.fingerprints[path] = FingerprintIndex.load(path)
+        return self.fingerprints[path]
+
+    def get_drop_rules(self, path):
+        """ Return the (cached) drop rules stored at path """
+        path = os.path.abspath(path)
+        if path not in self.drop_rules:
+            self.drop_rules[path] = DropRules.load(path)
+        return self.drop_rules[path]
+
+    def do_start(self, request):
+        """ Start a new recording. The previous one must be fully stopped. """
+        with self.recording_lock:
+            if self.ended:
+                raise RuntimeError("The daemon is shutting down")
+            if self.recording is not None and self.recording.is_alive():
+                raise RuntimeError("A recording is already running")
+            library = (self.get_library(request.get('library', DEFAULT_LIBRARY_PATH))
+                       if request.get('skip_existing') else None)
+            app_inspector = NotifyAppInspector
+            if request.get('poll'):
+                app_inspector = functools.partial(
+                    PollAppInspector,
+                    schedule=PollSchedule(request['poll_interval'])
+                    if request.get('poll_interval') else AdaptivePollSchedule(
+                        known_length=library and library.duration,
+                        cpu_budget=request.get('poll_budget', CPU_BUDGET)))
+            self.recording = Recording(
+                request['win_id'],
+                self.get_title_regex(request.get('regex', DEFAULT_REGEX)),
+                self.get_encoder(request.get('encoder', 'mp3')),
+                app_inspector,
+                request.get('continuous', False),
+                request.get('sink_input'),
+                interactive=False,
+                noise_floor_half_life=request.get('noise_floor_half_life'),
+                library=library,
+                fingerprints=(
+                    self.get_fingerprints(request.get('fingerprints', DEFAULT_FINGERPRINTS_PATH))
+                    if request.get('dedupe') else None),
+                rate=request.get('rate'),
+                channels=request.get('channels'),
+                sample_width=request['bits'] // 8 if request.get('bits') else None,
+                drop_rules=(self.get_drop_rules(request['drop_rules'])
+                            if request.get('drop_rules') else None),
+                pulse_backend=request.get('pulse_backend'),
+                scheduling=None if request.get('no_scheduling') else default_policies(
+                    request.get('capture_cpu'),
+                    capture_realtime=request.get('capture_realtime'),
+                    encoder_nice=request.get('encoder_nice', ENCODER_NICE),
+                    encoder_ionice=(parse_ionice(request['encoder_ionice'])
+                                    if request.get('encoder_ionice') else ENCODER_IONICE)),
+                supervise=not request.get('no_supervisor'),
+                encode_timeout=request.get('encode_timeout'),
+                compress_backlog=request.get('compress_backlog'))
+            if self.profiler is not None:
+                self.recording.profile(self.profiler)
+            self.recording.start()
+            self.reaper = threading.Thread(
+                target=self.reap,
+                args=(self.recording,),
+                name="Recording Reaper",
+                daemon=True)
+            self.reaper.start()
+            return self.recording.status()
+
+    def do_stop(self, request):
+        """ Ask the current recording to stop. Threads are joined in background. """
+        with self.recording_lock:
+            if self.recording is None or not self.recording.is_alive():
+                raise RuntimeError("No recording is running")
+            self.recording.stop()
+            return self.recording.status()
+
+    def do_status(self, request):
+        """ Return the state of the current (or last) recording """
+        with self.recording_lock:
+            if self.recording is None:
+                return {'recording': None}
+            return {'recording': self.recording.status()}
+
+    def do_metrics(self, request):
+        """ Return the current metrics of the pipeline """
+        registry.collect()
+        return {'metrics': registry.to_json()}
+
+    def do_shutdown(self, request):
+        """ Stop the current recording and the daemon itself """
+        with self.recording_lock:
+            if self.recording is not None:
+                self.recording.stop()
+        # shutdown() blocks until serve_forever returns: do not wait in the handler thread
+        threading.Thread(target=self.shutdown, name="Daemon Shutdown").start()
+        return {}
+
+    def reap(self, recording):
+        """ Join the threads of a recording once it ended, and save the fingerprints """
+        recording.end_event.wait()
+        recording.join()
+        for path, fingerprints in self.fingerprints.items():
+            fingerprints.save(path)
+        logging.info("Recording of %s ended", recording.win_id)
+
+    def end_recording(self):
+        """ Stop the current recording and wait until it is reaped, its
+        last songs being written and the fingerprints saved """
+        with self.recording_lock:
+            self.ended = True
+            recording, reaper = self.recording, self.reaper
+        if recording is None:
+            return
+        recording.stop()
+        reaper.join()
+
+    def server_close(self):
+        super(RecorderDaemon, self).server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+def main():
+    """ Main function, serving the control socket until shutdown """
+    arg_parser = argparse.ArgumentParser(description="Run the streamrecord daemon")
+    arg_parser.add_argument(
+        "--socket",
+        default=default_socket_path(),
+        help="Path of the control socket (default: %(default)s)"
+    )
+    arg_parser.add_argument(
+        "--debug", "-d",
+        help="Show debug info",
+        action="store_const",
+        default=logging.INFO,
+        const=logging.DEBUG
+    )
+    arg_parser.add_argument(
+        "--metrics",
+        help="File periodically rewritten with pipeline metrics "
+        "(JSON if it ends with '.json', Prometheus text format otherwise)"
+    )
+    arg_parser.add_argument(
+        "--metrics-interval",
+        help="Seconds between two metrics exports (default: %(default)s)",
+        type=float,
+        default=5
+    )
+    arg_parser.add_argument(
+        "--trace",
+        help="Trace the pipeline stages and write them at exit to this file, "
+        "in Chrome trace-event format (open it with https://ui.perfetto.dev)"
+    )
+    arg_parser.add_argument(
+        "--profile",
+        help="Profile every component thread and write one stats file per "
+        "component in this directory at exit",
+        metavar="DIR"
+    )
+    arg_parser.add_argument(
+        "--profile-sampling",
+        help="With --profile, sample stacks every SECONDS instead of "
+        "using cProfile (lower overhead, writes collapsed stacks)",
+        type=float,
+        metavar="SECONDS"
+    )
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=options.debug,
+        format="## %(levelname)s ## %(threadName)s ## %(message)s"
+    )
+
+    if options.trace:
+        tracer.enable()
+    metrics_exporter = None
+    if options.metrics:
+        metrics_exporter = MetricsExporter(options.metrics, options.metrics_interval)
+        metrics_exporter.start()
+
+    profiler = None
+    if options.profile:
+        profiler = Profiler(options.profile, options.profile_sampling)
+
+    server = RecorderDaemon(options.socket, profiler)
+    logging.info("Listening on %s", options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass # Ended like by the shutdown command
+    finally:
+        server.end_recording()
+        server.server_close()
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+        if options.trace:
+            tracer.export(options.trace)
+        if profiler is not None:
+            profiler.stop()
+    logging.info("Exit")
+
+if __name__ == "__main__":
+    main()
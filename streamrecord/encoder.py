@@ -4,9 +4,15 @@ Implementation of different standard encoders
 """
 
 import os
+import time
+import logging
+import threading
 import subprocess
 
-from slugify import slugify
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
 
 class Encoder:
     """
@@ -15,27 +21,114 @@ class Encoder:
     """
 
     SUPPORTED_TAGS = {}
+    EXTENSION = None # Extension of the encoded files
+    STREAMING = False # Can the raw data be given while recording, see open_stream
+    scheduling = None # If set, SchedulingPolicy of the encoder processes
+    timeout = None # If set, seconds after which an encoding is hung, see kill_expired
 
     @classmethod
     def get_filename(cls, infos):
         """
         Return a default file name from infos
         """
-        if infos and infos['title'] and infos['artist']:
+        if infos and infos.get('title') and infos.get('artist'):
+            from slugify import slugify # Slow to import, and only needed once songs are named
             filename = slugify(infos['artist'][0:50], separator="_")
             filename += "-"
             filename += slugify(infos['title'][0:50], separator="_")
             return filename
 
+    def get_output(self, basename, infos, output=None):
+        """
+        Return the path of the encoded file, with its extension
+        """
+        if not output:
+            output = self.get_filename(infos) or basename
+        return "{}.{}".format(output, self.EXTENSION)
+
     def __init__(self, keep_raw=False):
         self.keep_raw = keep_raw
+        self.running = {} # Encoder processes by pid, with their deadline
+        self.running_lock = threading.Lock() # Processes are spawned by the song writers
+
+    def encode(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
+        """
+        Encode the raw file at 'basename.raw', in audio_format, to 'basename.***'.
+        The encoded file is output (a path without extension) if given,
+        else it is named from infos if possible. Return whether the encoding succeeded.
+        """
+        raise NotImplementedError
 
-    def encode(self, basename, infos):
+    def open_stream(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
         """
-        Encode the raw file at 'basename.raw' to 'basename.***'.
+        Start encoding raw data written in the stdin of the returned process,
+        instead of reading 'basename.raw'. close_stream must be called at the end.
         """
         raise NotImplementedError
 
+    def spawn(self, cmd, deadline=True, **kwargs):
+        """
+        Start an encoder process, with the scheduling policy if any.
+        The policy is applied by the parent once the process started,
+        preexec_fn not being safe in the threads of the recorder.
+        deadline: Should the process be killed after timeout seconds?
+        Streaming encoders last as long as the song is recorded, and have none.
+        """
+        process = subprocess.Popen(cmd, **kwargs)
+        if self.scheduling is not None:
+            self.scheduling.apply(process.pid, os.path.basename(cmd[0]))
+        expires = None
+        if deadline and self.timeout is not None:
+            expires = time.monotonic() + self.timeout
+        with self.running_lock:
+            self.running[process.pid] = (process, expires)
+        return process
+
+    def finish(self, process, basename):
+        """
+        Wait for an encoder process reading 'basename.raw', and remove the raw
+        file if the encoding succeeded: it is kept if the process failed or was killed.
+        Return whether the encoding succeeded.
+        """
+        process.wait()
+        with self.running_lock:
+            self.running.pop(process.pid, None)
+        if process.returncode != 0:
+            logging.error("Encoding of '%s.raw' failed (exit status %d), raw file kept",
+                          basename, process.returncode)
+            return False
+        self.delete_raw(basename)
+        return True
+
+    def kill_expired(self, now=None):
+        """
+        Kill the encoder processes running past their deadline, and return them
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.running_lock:
+            expired = [process for process, expires in self.running.values()
+                       if expires is not None and expires < now]
+            for process in expired:
+                del self.running[process.pid]
+        for process in expired:
+            process.kill()
+        return expired
+
+    def close_stream(self, process):
+        """
+        End the encoding started by open_stream, return whether it succeeded
+        """
+        process.stdin.close()
+        process.wait()
+        with self.running_lock:
+            self.running.pop(process.pid, None)
+        if process.returncode != 0:
+            logging.error("Streamed encoding to '%s' failed (exit status %d)",
+                          process.args[-1], process.returncode)
+            return False
+        return True
+
     def delete_raw(self, basename):
         """
         Remove raw file after encoding
@@ -54,8 +147,9 @@ class DebugEncoder(Encoder):
         super(DebugEncoder, self).__init__()
         self.encoded = {}
 
-    def encode(self, basename, infos):
+    def encode(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
         self.encoded[basename] = os.stat("{}.raw".format(basename))
+        return True
 
     def clear(self):
         """
@@ -78,19 +172,32 @@ class Mp3LameEncoder(Encoder):
         "track": "--tn",
         "genre": "--tg"
     }
+    EXTENSION = "mp3"
+    USER_TAGS = {
+        "replaygain_track_gain": "REPLAYGAIN_TRACK_GAIN",
+        "replaygain_track_peak": "REPLAYGAIN_TRACK_PEAK"
+    }
+
+    def __init__(self, keep_raw=False, quality=6):
+        """
+        quality: Variable bitrate quality, from 0 (best) to 9 (smallest)
+        """
+        super(Mp3LameEncoder, self).__init__(keep_raw)
+        self.quality = quality
 
-    def encode(self, basename, infos):
+    def encode(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
         cmd = [
             "/usr/bin/lame",
             "--quiet",
             # Input data
             "-r", # Use lame with raw input
-            "-s", "44.1", # Raw is sample at 44100Hz
-            "--bitwidth", "16", # With 16 bits samples
+            "-s", "{:g}".format(audio_format.rate / 1000), # Sampling rate in kHz
+            "--bitwidth", str(audio_format.bits),
             # Output spec
-            "-m", "j", # Encode in joint stereo
+            "-m", "j" if audio_format.channels == 2 else "m", # Joint stereo, or mono input
             "-h", # Use a quiet good encoding quality
-            "-V", "6" # Use a variable bitrate
+            "-V", str(self.quality), # Use a variable bitrate
+            "--noreplaygain" # Gain is measured while recording, see USER_TAGS
             ]
 
         if infos:
@@ -99,16 +206,15 @@ class Mp3LameEncoder(Encoder):
                 if key in self.SUPPORTED_TAGS.keys():
                     cmd.append(self.SUPPORTED_TAGS[key])
                     cmd.append(str(value))
+                elif key in self.USER_TAGS.keys():
+                    cmd.append("--tv")
+                    cmd.append("TXXX={}={}".format(self.USER_TAGS[key], str(value)))
 
         cmd.append("{}.raw".format(basename))
-        filename = self.get_filename(infos)
-        if not filename:
-            filename = basename
-        cmd.append("{}.mp3".format(filename))
+        cmd.append(self.get_output(basename, infos, output))
 
-        lame_process = subprocess.Popen(cmd)
-        lame_process.wait()
-        self.delete_raw(basename)
+        lame_process = self.spawn(cmd)
+        return self.finish(lame_process, basename)
 
 class FlacEncoder(Encoder):
     """
@@ -130,20 +236,32 @@ class FlacEncoder(Encoder):
         "organization": "ORGANIZATION",
         "location": "LOCATION",
         "contact": "CONTACT",
-        "isrc": "ISRC"
+        "isrc": "ISRC",
+        "replaygain_track_gain": "REPLAYGAIN_TRACK_GAIN",
+        "replaygain_track_peak": "REPLAYGAIN_TRACK_PEAK"
     }
+    EXTENSION = "flac"
+
+    def __init__(self, keep_raw=False, compression_level=5):
+        """
+        compression_level: From 0 (fastest) to 8 (smallest)
+        """
+        super(FlacEncoder, self).__init__(keep_raw)
+        self.compression_level = compression_level
 
-    def encode(self, basename, infos):
+    def encode(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
         cmd = [
             "/usr/bin/flac",
-            "--silent"
+            "--silent",
             # Input data
             "--force-raw-input", # Use lame with raw input
-            "--channels=2", # Two channels input
-            "--bps=16", # 16 bits per samples
-            "--sample-rate=44100", # Raw is sampled at 44100Hz
+            "--endian=little", "--sign=signed", # Signed little endian samples
+            "--channels={}".format(audio_format.channels),
+            "--bps={}".format(audio_format.bits),
+            "--sample-rate={}".format(audio_format.rate),
             # Output spec
-            "--replay-gain", # Apply replay gain
+            "--compression-level-{}".format(self.compression_level),
+            # Replay gain is measured while recording, see SUPPORTED_TAGS
             ]
 
         if infos:
@@ -154,17 +272,81 @@ class FlacEncoder(Encoder):
                         self.SUPPORTED_TAGS[key], str(value)))
 
         cmd.append("-f") # Override already existing file
-        filename = self.get_filename(infos)
-        if not filename:
-            filename = basename
         cmd.append("-o") # Set output file
-        cmd.append("{}.flac".format(filename))
+        cmd.append(self.get_output(basename, infos, output))
 
         cmd.append("{}.raw".format(basename))
 
-        lame_process = subprocess.Popen(cmd)
-        if not self.keep_raw:
-            lame_process.wait()
-            subprocess.call(
-                ["/bin/rm", "{}.raw".format(basename)]
-            )
+        flac_process = self.spawn(cmd)
+        return self.finish(flac_process, basename)
+
+class OpusEncoder(Encoder):
+    """
+    Opus (in Ogg) encoder implementation based on opusenc, able to stream
+    """
+    SUPPORTED_TAGS = {
+        "title": "TITLE",
+        "artist": "ARTIST",
+        "album": "ALBUM",
+        "year": "DATE",
+        "comment": "DESCRIPTION",
+        "track": "TRACKNUMBER",
+        "genre": "GENRE",
+        "version": "VERSION",
+        "performer": "PERFORMER",
+        "copyright": "COPYRIGHT",
+        "license": "LICENSE",
+        "organization": "ORGANIZATION",
+        "location": "LOCATION",
+        "contact": "CONTACT",
+        "isrc": "ISRC"
+    }
+    EXTENSION = "opus"
+    STREAMING = True
+
+    def __init__(self, keep_raw=False, bitrate=128):
+        """
+        bitrate: Target bitrate in kbit/s (variable bitrate)
+        """
+        super(OpusEncoder, self).__init__(keep_raw)
+        self.bitrate = bitrate
+
+    def get_command(self, source, infos, output, audio_format=DEFAULT_FORMAT):
+        """
+        Return the opusenc command encoding source ('-' for stdin) to output
+        """
+        cmd = [
+            "/usr/bin/opusenc",
+            "--quiet",
+            # Input data
+            "--raw", # Raw input...
+            "--raw-bits", str(audio_format.bits), # ... with samples of this width
+            "--raw-rate", str(audio_format.rate), # ... sampled at this rate
+            "--raw-chan", str(audio_format.channels), # ... on this number of channels
+            "--raw-endianness", "0", # ... in little endian
+            # Output spec
+            "--bitrate", str(self.bitrate),
+            "--vbr"
+            ]
+
+        if infos:
+            for key, value in infos.items():
+                if key in self.SUPPORTED_TAGS.keys():
+                    cmd.append("--comment")
+                    cmd.append("{}={}".format(
+                        self.SUPPORTED_TAGS[key], str(value)))
+
+        cmd.append(source)
+        cmd.append(output)
+        return cmd
+
+    def encode(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
+        opusenc_process = self.spawn(self.get_command(
+            "{}.raw".format(basename), infos, self.get_output(basename, infos, output),
+            audio_format))
+        return self.finish(opusenc_process, basename)
+
+    def open_stream(self, basename, infos, output=None, audio_format=DEFAULT_FORMAT):
+        return self.spawn(
+            self.get_command("-", infos, self.get_output(basename, infos, output), audio_format),
+            deadline=False, stdin=subprocess.PIPE)
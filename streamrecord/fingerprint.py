@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Audio fingerprints of the recorded songs and their inverted index, to
+recognize a song already recorded whatever its title
+"""
+
+import os
+import logging
+import functools
+import threading
+import collections
+
+import numpy
+
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+DEFAULT_PATH = "streamrecord-fingerprints.npz" # In the output directory
+# Frames and hops are given at RATE, and scaled to the same durations at other rates,
+# for the hashes not to depend on the capture rate
+RATE = 44100
+FRAME_SAMPLES = 4096 # About 93ms
+INDEX_HOP = 2048 # Hop between the indexed frames
+QUERY_HOP = 512 # Hop between the searched frames, a divisor of INDEX_HOP
+INDEXED = (2, 12) # Seconds of each song which are indexed...
+SEARCHED = (1, 14) # ... and seconds searched in them, allowing imprecise cuts
+# 33 logarithmic bands between 300Hz and 3kHz give 32 bits hashes
+BAND_EDGES = numpy.geomspace(300, 3000, 34)
+
+def scaled(samples, rate):
+    """ Return the number of frames at rate lasting as long as samples frames at RATE """
+    return int(round(samples * rate / RATE))
+
+@functools.lru_cache(maxsize=4)
+def _analysis_tables(rate):
+    """ Return the frames window and the matrix summing the spectrum bins of each band """
+    frame_samples = scaled(FRAME_SAMPLES, rate)
+    frequencies = numpy.fft.rfftfreq(frame_samples, 1.0 / rate)
+    bands = numpy.searchsorted(BAND_EDGES, frequencies) - 1
+    matrix = numpy.zeros((len(frequencies), len(BAND_EDGES) - 1))
+    in_bands = (bands >= 0) & (bands < len(BAND_EDGES) - 1)
+    matrix[in_bands, bands[in_bands]] = 1
+    return numpy.hanning(frame_samples), matrix
+
+BIT_WEIGHTS = 1 << numpy.arange(len(BAND_EDGES) - 2, dtype=numpy.uint64)
+
+def fingerprint(raw_data, hop=INDEX_HOP, audio_format=DEFAULT_FORMAT):
+    """ Return the 32 bits hashes of the frames of raw_data, every hop samples (at RATE).
+    Each bit tells if the energy difference between two adjacent bands increases
+    from the previous frame (Haitsma and Kalker). """
+    mono = audio_format.samples(raw_data).mean(axis=1)
+    window, bands_matrix = _analysis_tables(audio_format.rate)
+    # Hops stay multiples of the query one, for the offsets between frames to match
+    hop = scaled(QUERY_HOP, audio_format.rate) * (hop // QUERY_HOP)
+    frames = (len(mono) - len(window)) // hop + 1
+    if frames < 2:
+        return numpy.zeros(0, dtype=numpy.uint32)
+    indexes = numpy.arange(len(window))[None, :] + hop * numpy.arange(frames)[:, None]
+    spectrums = numpy.abs(numpy.fft.rfft(mono[indexes] * window, axis=1)) ** 2
+    energies = spectrums.dot(bands_matrix)
+    differences = energies[:, :-1] - energies[:, 1:]
+    bits = (differences[1:] - differences[:-1]) > 0
+    return bits.dot(BIT_WEIGHTS).astype(numpy.uint32)
+
+class Fingerprinter:
+    """ Collect the beginning of a song fed chunk by chunk, and fingerprint it """
+    def __init__(self, audio_format=DEFAULT_FORMAT):
+        self.audio_format = audio_format
+        self.frame_samples = scaled(FRAME_SAMPLES, audio_format.rate)
+        self.needed_bytes = (
+            int(max(INDEXED[1], SEARCHED[1]) * audio_format.rate) + self.frame_samples
+        ) * audio_format.frame_bytes
+        self.head = bytearray()
+
+    def update(self, data):
+        """ Collect the next chunk of the song """
+        missing = self.needed_bytes - len(self.head)
+        if missing > 0:
+            self.head.extend(bytes(data[:missing]))
+
+    def _part(self, seconds, hop):
+        frame_bytes = self.audio_format.frame_bytes
+        start, end = (int(second * self.audio_format.rate) * frame_bytes for second in seconds)
+        return fingerprint(
+            self.head[start:end + self.frame_samples * frame_bytes], hop, self.audio_format)
+
+    def indexed_hashes(self):
+        """ Return the hashes to index for this song """
+        return self._part(INDEXED, INDEX_HOP)
+
+    def searched_hashes(self):
+        """ Return the hashes to search in the index for this song """
+        return self._part(SEARCHED, QUERY_HOP)
+
+class FingerprintIndex:
+    """ Inverted index from hashes to the songs and frames they appear in.
+    A song matches if enough of its hashes are found in an indexed song with the
+    same time offset. """
+    MAX_POSTINGS = 100 # Hashes found in more frames are too common to be relevant
+
+    def __init__(self, min_matches=8):
+        """
+        min_matches: Number of hashes matching with the same offset to recognize a song
+        """
+        self.min_matches = min_matches
+        self.names = [] # Song names, by song number
+        self.postings = {} # Hash: list of (song number << 16 | frame number)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, hashes):
+        """ Index the hashes (Fingerprinter.indexed_hashes) of a song """
+        with self.lock:
+            number = len(self.names)
+            self.names.append(name)
+            for frame, song_hash in enumerate(hashes.tolist()):
+                self.postings.setdefault(song_hash, []).append(number << 16 | frame)
+
+    def match(self, hashes):
+        """ Return the name of the indexed song matching the hashes
+        (Fingerprinter.searched_hashes) of a song, or None """
+        phases = INDEX_HOP // QUERY_HOP
+        votes = collections.Counter()
+        with self.lock:
+            for position, song_hash in enumerate(hashes.tolist()):
+                postings = self.postings.get(song_hash)
+                if postings is None or len(postings) > self.MAX_POSTINGS:
+                    continue
+                for posting in postings:
+                    offset = position - (posting & 0xFFFF) * phases
+                    votes[posting >> 16, offset] += 1
+            if not votes:
+                return None
+            (number, _), count = votes.most_common(1)[0]
+            logging.debug("Best fingerprint match: %s (%d hashes)", self.names[number], count)
+            return self.names[number] if count >= self.min_matches else None
+
+    def save(self, path):
+        """ Store the index in a numpy .npz file """
+        with self.lock:
+            hashes = numpy.array(
+                [song_hash for song_hash, postings in self.postings.items() for _ in postings],
+                dtype=numpy.uint32)
+            postings = numpy.array(
+                [posting for postings in self.postings.values() for posting in postings],
+                dtype=numpy.int64)
+            names = numpy.array(self.names, dtype=str)
+        with open(path, 'wb') as index_file:
+            numpy.savez(index_file, hashes=hashes, postings=postings, names=names)
+
+    @classmethod
+    def load(cls, path, min_matches=8):
+        """ Return the index stored at path, an empty one if it does not exist """
+        index = cls(min_matches)
+        if not os.path.exists(path):
+            return index
+        with numpy.load(path) as stored:
+            index.names = stored['names'].tolist()
+            for song_hash, posting in zip(stored['hashes'].tolist(), stored['postings'].tolist()):
+                index.postings.setdefault(song_hash, []).append(posting)
+        logging.info("%d songs in the fingerprints index '%s'", len(index), path)
+        return index
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Persistent index of the songs already recorded in the output directory,
+allowing to skip them on the next passes
+"""
+
+import os
+import json
+import logging
+import threading
+
+if __package__ == "":
+    from encoder import Encoder
+elif __package__ == "streamrecord":
+    from streamrecord.encoder import Encoder
+
+DEFAULT_PATH = "streamrecord-library.json" # In the output directory
+
+class Library:
+    """ Index of the recorded songs, keyed by their file name (normalized artist
+    and title), with their duration. It is saved after each change. """
+    def __init__(self, path, tolerance=3):
+        """
+        path: JSON file holding the index, created if needed
+        tolerance: Maximal difference, in seconds, between the duration of a
+            song and the indexed one for them to be the same track
+        """
+        self.path = path
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.songs = {}
+        if os.path.exists(path):
+            with open(path) as library_file:
+                self.songs = json.load(library_file)
+            logging.info("%d songs in the library '%s'", len(self.songs), path)
+
+    @staticmethod
+    def get_key(infos):
+        """ Return the key of a song, None if it cannot be identified """
+        return Encoder.get_filename(infos)
+
+    def contains(self, infos, length):
+        """ Is the song, lasting approximately length seconds, already recorded? """
+        key = self.get_key(infos)
+        with self.lock:
+            song = self.songs.get(key)
+        return song is not None and abs(song['duration'] - length) <= self.tolerance
+
+    def duration(self, infos):
+        """ Return the duration of a recorded song, None if it is not in the library """
+        key = self.get_key(infos)
+        with self.lock:
+            song = self.songs.get(key)
+        return song['duration'] if song is not None else None
+
+    def add(self, infos, length):
+        """ Index a newly recorded song """
+        key = self.get_key(infos)
+        if key is None:
+            return
+        with self.lock:
+            self.songs[key] = {
+                'artist': infos['artist'],
+                'title': infos['title'],
+                'duration': length
+            }
+            self.save()
+
+    def move(self, changes):
+        """ Index again the songs whose infos changed, from a list of (old infos,
+        new infos), keeping their duration. Saved once for all the changes. """
+        with self.lock:
+            for infos, new_infos in changes:
+                song = self.songs.pop(self.get_key(infos), None)
+                key = self.get_key(new_infos)
+                if song is not None and key is not None:
+                    song.update(artist=new_infos['artist'], title=new_infos['title'])
+                    self.songs[key] = song
+            self.save()
+
+    def save(self):
+        """ Write the index atomically, the lock being held """
+        temporary_path = "{}.tmp".format(self.path)
+        with open(temporary_path, 'w') as library_file:
+            json.dump(self.songs, library_file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Incremental loudness measurement (ITU-R BS.1770 / EBU R128 integrated loudness
+and sample peak) of the recorded songs, giving their ReplayGain tags
+"""
+
+import numpy
+
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+REFERENCE_LOUDNESS = -18.0 # ReplayGain 2.0 reference level, in LUFS
+ABSOLUTE_GATE = -70.0 # LUFS
+RELATIVE_GATE = -10.0 # LU under the absolutely gated loudness
+
+# K-weighting filter (high shelf, then high pass) as given by BS.1770 at 48kHz
+K_WEIGHTING = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285),
+     (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0),
+     (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+def k_weighting_power(frequencies):
+    """ Return the squared magnitude response of the K-weighting filter at frequencies (Hz) """
+    z = numpy.exp(-2j * numpy.pi * numpy.asarray(frequencies) / 48000)
+    response = numpy.ones(len(z), dtype=complex)
+    for numerator, denominator in K_WEIGHTING:
+        response *= (
+            numpy.polyval(numerator[::-1], z) / numpy.polyval(denominator[::-1], z))
+    return numpy.abs(response) ** 2
+
+class LoudnessMeter:
+    """ Measure the loudness of a song fed chunk by chunk.
+    Only the K-weighted mean square of each 100ms block is kept, filtering being
+    done in the frequency domain for all the blocks of a chunk at once. """
+    BLOCK_SECONDS = 0.1 # Gating blocks are 4 blocks long, overlapping of 3 blocks
+
+    def __init__(self, audio_format=DEFAULT_FORMAT):
+        self.audio_format = audio_format
+        self.channels = audio_format.channels
+        self.block_frames = int(self.BLOCK_SECONDS * audio_format.rate)
+        frequencies = numpy.fft.rfftfreq(self.block_frames, 1.0 / audio_format.rate)
+        # Weight of each bin of the one sided spectrum in the mean square (Parseval)
+        bins_weight = numpy.full(len(frequencies), 2.0)
+        bins_weight[0] = 1.0
+        if self.block_frames % 2 == 0:
+            bins_weight[-1] = 1.0
+        self.spectrum_weights = (
+            bins_weight * k_weighting_power(frequencies) / (self.block_frames ** 2))
+        self.blocks = [] # K-weighted mean square of each block, per channel
+        self.max_sample = 0
+        self.pending = b"" # Data not filling a whole block yet
+
+    def update(self, data):
+        """ Analyze the next chunk of the song """
+        data = self.pending + bytes(data)
+        samples = self.audio_format.samples(data)
+        if len(samples):
+            self.max_sample = max(self.max_sample, float(numpy.abs(samples, dtype=float).max()))
+        complete_frames = len(samples) - len(samples) % self.block_frames
+        self.pending = data[complete_frames * self.audio_format.frame_bytes:]
+        if not complete_frames:
+            return
+        blocks = samples[:complete_frames].reshape(-1, self.block_frames, self.channels) / 32768.0
+        spectrums = numpy.abs(numpy.fft.rfft(blocks, axis=1)) ** 2
+        self.blocks.append(numpy.einsum('bfc,f->bc', spectrums, self.spectrum_weights))
+
+    def integrated_loudness(self):
+        """ Return the gated loudness of the song in LUFS, or None if it is too short or silent """
+        if not self.blocks:
+            return None
+        blocks = numpy.concatenate(self.blocks)
+        if len(blocks) < 4:
+            return None
+        cumulated = numpy.concatenate((numpy.zeros((1, self.channels)), numpy.cumsum(blocks, axis=0)))
+        gating_blocks = (cumulated[4:] - cumulated[:-4]) / 4
+        powers = gating_blocks.sum(axis=1)
+        with numpy.errstate(divide='ignore'):
+            loudnesses = -0.691 + 10 * numpy.log10(powers)
+        gated = powers[loudnesses > ABSOLUTE_GATE]
+        if not len(gated):
+            return None
+        relative_gate = -0.691 + 10 * numpy.log10(gated.mean()) + RELATIVE_GATE
+        gated = powers[(loudnesses > ABSOLUTE_GATE) & (loudnesses > relative_gate)]
+        return float(-0.691 + 10 * numpy.log10(gated.mean()))
+
+    def peak(self):
+        """ Return the sample peak of the song, 1.0 being the full scale """
+        return self.max_sample / 32768.0
+
+    def replaygain_tags(self):
+        """ Return the ReplayGain tags of the song, empty if its loudness is unknown """
+        loudness = self.integrated_loudness()
+        if loudness is None:
+            return {}
+        return {
+            'replaygain_track_gain': "{:.2f} dB".format(REFERENCE_LOUDNESS - loudness),
+            'replaygain_track_peak': "{:.6f}".format(self.peak())
+        }
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Implementation of the pipeline metrics: a thread safe registry, an
+instrumented lock and the thread exporting them to a file
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+class Metrics:
+    """ Thread safe registry of counters, gauges and summaries.
+    Every metric is identified by its name and its labels. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.summaries = {} # name -> labels -> [count, sum, max]
+        self.descriptions = {}
+        self.collectors = [] # Callables run before each export to refresh gauges
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def describe(self, name, description):
+        """ Set the help text of a metric """
+        self.descriptions[name] = description
+
+    def inc(self, name, value=1, **labels):
+        """ Increment a counter """
+        key = self._key(labels)
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set the value of a gauge """
+        key = self._key(labels)
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """ Add an observation (a duration most of the time) to a summary """
+        key = self._key(labels)
+        with self.lock:
+            summary = self.summaries.setdefault(name, {}).setdefault(key, [0, 0.0, value])
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = max(summary[2], value)
+
+    def add_collector(self, collector):
+        """ Register a callable refreshing some gauges before each export """
+        with self.lock:
+            self.collectors.append(collector)
+
+    def remove_collector(self, collector):
+        """ Unregister a collector added with add_collector """
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def collect(self):
+        """ Run all the collectors """
+        with self.lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            try:
+                collector(self)
+            except Exception: # A failing collector must not stop the export
+                logging.exception("Metrics collector failed")
+
+    def clear(self):
+        """ Forget all the values (collectors are kept) """
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.summaries.clear()
+
+    def to_json(self):
+        """ Return all the metrics as a JSON serializable dictionnary """
+        def _labeled(values, convert=lambda value: value):
+            return [
+                {'labels': dict(key), 'value': convert(value)}
+                for key, value in sorted(values.items())
+            ]
+        with self.lock:
+            return {
+                'counters': {
+                    name: _labeled(values) for name, values in self.counters.items()
+                },
+                'gauges': {
+                    name: _labeled(values) for name, values in self.gauges.items()
+                },
+                'summaries': {
+                    name: _labeled(values, lambda summary: {
+                        'count': summary[0], 'sum': summary[1], 'max': summary[2]
+                    })
+                    for name, values in self.summaries.items()
+                }
+            }
+
+    def to_prometheus(self):
+        """ Return all the metrics in the Prometheus text exposition format """
+        def _labels(key):
+            if not key:
+                return ""
+            return "{{{}}}".format(",".join(
+                '{}="{}"'.format(label, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                for label, value in key
+            ))
+        lines = []
+        def _family(name, metric_type, values):
+            if name in self.descriptions:
+                lines.append("# HELP {} {}".format(name, self.descriptions[name]))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for key, value in sorted(values.items()):
+                lines.append("{}{} {}".format(name, _labels(key), value))
+
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                _family(name, "counter", values)
+            for name, values in sorted(self.gauges.items()):
+                _family(name, "gauge", values)
+            for name, values in sorted(self.summaries.items()):
+                if name in self.descriptions:
+                    lines.append("# HELP {} {}".format(name, self.descriptions[name]))
+                lines.append("# TYPE {} summary".format(name))
+                for key, summary in sorted(values.items()):
+                    lines.append("{}_count{} {}".format(name, _labels(key), summary[0]))
+                    lines.append("{}_sum{} {}".format(name, _labels(key), summary[1]))
+                _family("{}_max".format(name), "gauge", {
+                    key: summary[2] for key, summary in values.items()
+                })
+        return "\n".join(lines) + "\n"
+
+registry = Metrics()
+registry.describe("streamrecord_capture_bytes_total", "Bytes read from the capture pipe")
+registry.describe("streamrecord_capture_bytes_per_second", "Capture rate since the last export")
+registry.describe("streamrecord_buffer_seconds", "Audio buffered in memory, in seconds")
+registry.describe("streamrecord_buffer_memory_bytes", "Memory used by the compressed buffer")
+registry.describe("streamrecord_task_queue_depth", "Songs waiting to be written")
+registry.describe("streamrecord_noise_floor_db", "Estimated noise floor of the stream, in dBFS")
+registry.describe("streamrecord_lock_wait_seconds", "Time spent waiting for a lock")
+registry.describe("streamrecord_lock_hold_seconds", "Time a lock has been held")
+registry.describe("streamrecord_cut_latency_seconds", "Delay between a title change and its cut")
+registry.describe("streamrecord_write_seconds", "Time spent writing one song")
+registry.describe("streamrecord_encode_wall_seconds", "Wall time of one song encoding")
+registry.describe("streamrecord_encode_cpu_seconds", "CPU time of one song encoding")
+registry.describe("streamrecord_songs_skipped_total", "Songs dropped as already recorded")
+registry.describe("streamrecord_songs_dropped_total", "Segments dropped by a drop rule")
+registry.describe("streamrecord_duplicates_total", "Songs dropped as sounding like a recorded one")
+registry.describe("streamrecord_songs_failed_total", "Songs whose encoding failed")
+registry.describe("streamrecord_title_polls_total", "Window title polls of the poll inspector")
+registry.describe("streamrecord_restarts_total", "Stalled components restarted by the supervisor")
+
+class InstrumentedLock:
+    """ Lock recording in a registry how long it is waited for and held """
+    def __init__(self, name, metrics=None):
+        self.name = name
+        self.metrics = registry if metrics is None else metrics
+        self._lock = threading.Lock()
+        self._acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        """ Same as threading.Lock.acquire """
+        wait_start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            self.metrics.observe(
+                "streamrecord_lock_wait_seconds", self._acquired_at - wait_start, lock=self.name)
+        return acquired
+
+    def release(self):
+        """ Same as threading.Lock.release """
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        self.metrics.observe("streamrecord_lock_hold_seconds", held, lock=self.name)
+
+    def locked(self):
+        """ Same as threading.Lock.locked """
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def __repr__(self):
+        return "<InstrumentedLock {} {}>".format(self.name, repr(self._lock))
+
+class MetricsExporter(threading.Thread):
+    """ Thread periodically rewriting the metrics file.
+    The format is JSON if the file name ends with '.json', Prometheus text otherwise. """
+    def __init__(self, path, interval=5, metrics=None):
+        super(MetricsExporter, self).__init__(name="Metrics Exporter", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.metrics = registry if metrics is None else metrics
+        self.stop_event = threading.Event()
+        self.last_capture = None
+
+    def update_capture_rate(self):
+        """ Derive the capture rate from the capture bytes counter """
+        now = time.time()
+        with self.metrics.lock:
+            captured = sum(self.metrics.counters.get(
+                "streamrecord_capture_bytes_total", {}).values())
+        if self.last_capture is not None:
+            elapsed = now - self.last_capture[0]
+            if elapsed > 0:
+                self.metrics.set(
+                    "streamrecord_capture_bytes_per_second",
+                    (captured - self.last_capture[1]) / elapsed)
+        self.last_capture = (now, captured)
+
+    def export(self):
+        """ Refresh gauges and atomically rewrite the metrics file """
+        self.metrics.collect()
+        self.update_capture_rate()
+        if self.path.endswith(".json"):
+            content = json.dumps(self.metrics.to_json(), indent=2)
+        else:
+            content = self.metrics.to_prometheus()
+        temporary_path = "{}.tmp".format(self.path)
+        with open(temporary_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(temporary_path, self.path)
+
+    def run(self):
+        logging.info("Exporting metrics to %s every %s seconds", self.path, self.interval)
+        while not self.stop_event.wait(self.interval):
+            self.export()
+        self.export()
+        logging.info("Exit")
+
+    def stop(self):
+        """ Write the metrics one last time and stop """
+        self.stop_event.set()
+        self.join()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Streaming estimation of the noise floor of the recorded stream, giving the
+silence threshold used to find gaps between songs
+"""
+
+import threading
+
+import numpy
+
+if __package__ == "":
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+def window_energies(raw_data, window_frames, hop_frames=None, audio_format=DEFAULT_FORMAT):
+    """ Return the mean square value of the samples (scaled to 16 bits) of each window of
+    raw_data. Windows are window_frames long, every hop_frames (not overlapping by default),
+    aligned on the end of the data and fully inside it.
+    Energies are returned from the end of the data to its beginning. """
+    samples = audio_format.samples(raw_data)
+    frame_energy = numpy.square(samples, dtype=numpy.float64).mean(axis=1)
+    cumulated = numpy.concatenate(([0.0], numpy.cumsum(frame_energy)))
+    hop_frames = window_frames if hop_frames is None else hop_frames
+    ends = numpy.arange(len(frame_energy), window_frames - 1, -hop_frames)
+    return (cumulated[ends] - cumulated[ends - window_frames]) / window_frames
+
+class NoiseFloorEstimator:
+    """ Keep a histogram of the energy (in dBFS) of short windows of the captured
+    audio, with bounded memory, and derive from its low quantile the energy under
+    which a window is considered silent. """
+    MIN_DB = -100
+    MAX_DB = 0
+
+    def __init__(self, window_seconds=0.1, quantile=0.02, margin_db=6,
+                 max_threshold_db=-30, half_life=None, min_seconds=30,
+                 audio_format=DEFAULT_FORMAT):
+        """
+        window_seconds: Length of the analyzed windows
+        quantile: Fraction of the quietest windows considered as noise floor
+        margin_db: Margin over the noise floor under which a window is silent
+        max_threshold_db: Upper bound of the threshold, to never cut in quiet music
+        half_life: If set, seconds of audio after which past windows weight half,
+            to follow the noise floor of the current track instead of the session
+        min_seconds: Seconds of audio to analyze before giving a threshold
+        audio_format: AudioFormat of the analyzed audio
+        """
+        self.audio_format = audio_format
+        self.window_frames = int(window_seconds * audio_format.rate)
+        self.quantile = quantile
+        self.margin_db = margin_db
+        self.max_threshold_db = max_threshold_db
+        self.decay = 1.0 if not half_life else 0.5 ** (window_seconds / half_life)
+        self.min_windows = min_seconds / window_seconds
+        self.histogram = numpy.zeros(self.MAX_DB - self.MIN_DB + 1)
+        self.analyzed = 0.0 # Weighted number of windows in the histogram
+        self.pending = b"" # Captured data not filling a whole window yet
+        self.lock = threading.Lock()
+
+    def update(self, data):
+        """ Analyze newly captured data """
+        data = self.pending + bytes(data)
+        window_bytes = self.window_frames * self.audio_format.frame_bytes
+        complete = len(data) - len(data) % window_bytes
+        self.pending = data[complete:]
+        if not complete:
+            return
+        energies = window_energies(
+            data[:complete], self.window_frames, audio_format=self.audio_format)
+        decibels = 10 * numpy.log10(numpy.maximum(energies, 1e-12) / (32768.0 ** 2))
+        bins = numpy.clip(numpy.round(decibels), self.MIN_DB, self.MAX_DB).astype(int) - self.MIN_DB
+        # Energies are from the latest window, which has the highest weight
+        weights = self.decay ** numpy.arange(len(bins))
+        with self.lock:
+            decay = self.decay ** len(bins)
+            self.histogram *= decay
+            self.analyzed *= decay
+            numpy.add.at(self.histogram, bins, weights)
+            self.analyzed += weights.sum()
+
+    def noise_floor_db(self):
+        """ Return the estimated noise floor in dBFS, or None if not enough audio was analyzed """
+        with self.lock:
+            if self.analyzed < self.min_windows:
+                return None
+            cumulated = numpy.cumsum(self.histogram)
+            index = int(numpy.searchsorted(cumulated, self.quantile * cumulated[-1]))
+        return float(index + self.MIN_DB)
+
+    def silence_energy(self):
+        """ Return the mean square sample value under which a window is silent,
+        or None if the noise floor is not known yet """
+        noise_floor = self.noise_floor_db()
+        if noise_floor is None:
+            return None
+        threshold_db = min(noise_floor + self.margin_db, self.max_threshold_db)
+        return (32768.0 ** 2) * 10 ** (threshold_db / 10)
+
+    def silence_amplitude(self):
+        """ Return the absolute sample value under which a sample is silent
+        (see find_longest_silence), or None if the noise floor is not known yet """
+        energy = self.silence_energy()
+        return None if energy is None else int(energy ** 0.5)
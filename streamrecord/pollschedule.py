@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Schedules of the window title polls of PollAppInspector: at a fixed
+interval, or adapted to the expected end of the playing track
+"""
+
+import statistics
+import collections
+
+MIN_INTERVAL = 0.05 # Seconds between two polls near the expected end of a track
+MAX_INTERVAL = 4 # Seconds between two polls early in a track
+LATE_INTERVAL = 1 # Seconds between two polls once a track lasts longer than expected
+RAMP = 0.2 # Interval per second away from the expected end
+CPU_BUDGET = 0.1 # Fraction of the time spent polling, at most
+HISTORY = 16 # Track lengths kept to expect the next one
+MIN_SPREAD = 1 # Seconds of uncertainty on an expected length, at least
+
+class PollSchedule:
+    """ Poll at a fixed interval """
+    def __init__(self, interval=1):
+        self.interval = interval
+
+    def track_started(self, start, infos=None):
+        """ A track started at start (clock time), described by infos (title and artist) """
+
+    def polled(self, cost):
+        """ A poll took cost seconds """
+
+    def next_interval(self, now):
+        """ Return the seconds to wait before the next poll """
+        return self.interval
+
+    def change_time(self, last_poll, now):
+        """ Return the time of a title change, seen at now, since the last poll
+        (None for the first poll of the track), and account the track end """
+        return now
+
+class AdaptivePollSchedule(PollSchedule):
+    """ Poll rarely early in a track, and quickly near its expected end: its
+    length if known (e.g. from the library), else the median of the previous
+    track lengths. The interval grows with the distance to the expected end
+    (out of its uncertainty), is longer the more uncertain the expected end,
+    is never shorter than allowed by the CPU budget, and is the fixed one until
+    a track length is known. """
+    def __init__(self, interval=1, known_length=None, min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL, ramp=RAMP, cpu_budget=CPU_BUDGET,
+                 history=HISTORY):
+        """
+        interval: Fixed interval used when no track length is known
+        known_length: If given, callable returning the length in seconds of the
+            track of infos, or None if it is unknown
+        cpu_budget: Maximal fraction of the time spent polling, which bounds the
+            interval from the measured cost of a poll
+        history: Number of previous track lengths considered
+        """
+        super(AdaptivePollSchedule, self).__init__(interval)
+        self.known_length = known_length
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ramp = ramp
+        self.cpu_budget = cpu_budget
+        self.lengths = collections.deque(maxlen=history) # Of the fully seen tracks
+        self.cost = 0.0 # Moving average of the poll cost
+        self.start = None
+        self.last_change = None # Time of the last title change, None before the first one
+        self.expected = None # (length, spread) of the playing track
+
+    def track_started(self, start, infos=None):
+        self.start = start
+        if self.last_change is None: # Playing since before the recording started
+            self.expected = None
+            return
+        length = self.known_length(infos) if self.known_length and infos else None
+        if length is not None:
+            self.expected = (length, MIN_SPREAD)
+        elif self.lengths:
+            median = statistics.median(self.lengths)
+            deviation = statistics.median(abs(other - median) for other in self.lengths)
+            self.expected = (median, max(deviation, MIN_SPREAD))
+        else:
+            self.expected = None
+
+    def polled(self, cost):
+        self.cost = cost if self.cost == 0 else 0.8 * self.cost + 0.2 * cost
+
+    def next_interval(self, now):
+        floor = max(self.min_interval, self.cost / self.cpu_budget)
+        if self.expected is None:
+            return max(self.interval, floor)
+        length, spread = self.expected
+        elapsed = now - self.start
+        distance = max(abs(elapsed - length) - spread, 0)
+        # An uncertain expectation is not worth the fastest polls
+        floor = max(floor, self.min_interval * spread / MIN_SPREAD)
+        interval = min(max(distance * self.ramp, floor), self.max_interval)
+        if elapsed > length + spread:
+            interval = min(interval, max(LATE_INTERVAL, floor))
+        return interval
+
+    def change_time(self, last_poll, now):
+        # The middle of the polls halves the mean error
+        change = now if last_poll is None else (last_poll + now) / 2
+        if self.last_change is not None:
+            self.lengths.append(change - self.last_change)
+        self.last_change = change
+        return change
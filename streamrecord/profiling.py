@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Implementation of the profiling mode, covering every component thread
+instead of the main one (which only waits for the end event)
+"""
+
+import os
+import re
+import sys
+import pstats
+import logging
+import cProfile
+import threading
+import collections
+
+SAMPLING_INTERVAL = 0.01 # Seconds between two samples when cProfile is not usable
+# Since Python 3.12, cProfile relies on sys.monitoring and covers every thread
+PROCESS_WIDE_CPROFILE = sys.version_info >= (3, 12)
+
+def component_filename(name):
+    """ Return a file name friendly version of a thread name """
+    return re.sub(r"\W+", "_", name).strip("_").lower()
+
+class StackSampler(threading.Thread):
+    """ Thread periodically sampling the stacks of the profiled threads.
+    Much cheaper than cProfile, but statistical. """
+    def __init__(self, interval):
+        super(StackSampler, self).__init__(name="Stack Sampler", daemon=True)
+        self.interval = interval
+        self.threads = {} # Thread ident -> component name
+        self.samples = collections.defaultdict(collections.Counter)
+        self.stop_event = threading.Event()
+
+    def watch(self, ident, name):
+        """ Start sampling the thread ident, accounted as the component name """
+        self.threads[ident] = name
+
+    def unwatch(self, ident):
+        """ Stop sampling the thread ident (idents are reused by new threads) """
+        self.threads.pop(ident, None)
+
+    def sample(self):
+        """ Record the current stack of each watched thread """
+        for ident, frame in sys._current_frames().items():
+            name = self.threads.get(ident)
+            if name is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            self.samples[name][";".join(reversed(stack))] += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        """ Stop sampling """
+        self.stop_event.set()
+        self.join()
+
+class Profiler:
+    """ Install a profiler in each component thread and write one stats file per
+    component when stopped.
+    With cProfile (default), files are '<component>.prof', readable with pstats
+    or snakeviz. With sampling, files are '<component>.folded' collapsed stacks,
+    readable with flamegraph.pl or speedscope. Where cProfile cannot profile
+    the threads separately (Python 3.12 and later), every thread is sampled. """
+    def __init__(self, output_dir, sampling_interval=None):
+        """
+        output_dir: Directory where stats files are written
+        sampling_interval: If set, sample stacks every sampling_interval seconds
+            instead of using cProfile
+        """
+        self.output_dir = output_dir
+        self.stats = {} # Component name -> pstats.Stats
+        self.stats_lock = threading.Lock()
+        self.sampler = None
+        if not sampling_interval and PROCESS_WIDE_CPROFILE:
+            logging.warning("cProfile cannot profile each thread on Python %d.%d, "
+                            "sampling them instead", *sys.version_info[:2])
+            sampling_interval = SAMPLING_INTERVAL
+        if sampling_interval:
+            self.sampler = StackSampler(sampling_interval)
+            self.sampler.start()
+
+    def profile(self, thread):
+        """ Profile thread when it runs. Must be called before thread.start() """
+        original_run = thread.run
+
+        def _profiled_run():
+            if self.sampler is not None:
+                self.sampler.watch(threading.get_ident(), thread.name)
+                try:
+                    original_run()
+                finally:
+                    self.sampler.unwatch(threading.get_ident())
+                return
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                original_run()
+            finally:
+                profile.disable()
+                self.add_profile(thread.name, profile)
+
+        thread.run = _profiled_run
+
+    def add_profile(self, name, profile):
+        """ Merge profile in the stats of the component name """
+        with self.stats_lock:
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+
+    def stop(self):
+        """ Write the stats file of each component """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.sampler is not None:
+            self.sampler.stop()
+            for name, stacks in self.sampler.samples.items():
+                path = os.path.join(
+                    self.output_dir, "{}.folded".format(component_filename(name)))
+                with open(path, 'w') as folded_file:
+                    for stack, count in stacks.most_common():
+                        folded_file.write("{} {}\n".format(stack, count))
+                logging.info("Profile of '%s' written to %s", name, path)
+        with self.stats_lock:
+            for name, stats in self.stats.items():
+                path = os.path.join(
+                    self.output_dir, "{}.prof".format(component_filename(name)))
+                stats.dump_stats(path)
+                logging.info("Profile of '%s' written to %s", name, path)
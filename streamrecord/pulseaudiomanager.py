@@ -3,11 +3,25 @@
 Main PulseAudio manager implementation
 """
 
+import os
 import re
+import time
 import logging
+import functools
 import threading
 import subprocess
 
+if __package__ == "":
+    from audioformat import AudioFormat, DEFAULT_FORMAT
+    import pulseclient
+    from pulseclient import PulseClient, RecordStream, PulseError, FRAGMENT_SECONDS
+elif __package__ == "streamrecord":
+    from streamrecord.audioformat import AudioFormat, DEFAULT_FORMAT
+    from streamrecord import pulseclient
+    from streamrecord.pulseclient import PulseClient, RecordStream, PulseError, FRAGMENT_SECONDS
+
+SINK_NAME = "deezer_record" # Null sink the recorded stream is moved to
+
 def select(choice_list):
     """ Ask the user to select an option
     choice_list: The list of options
@@ -23,63 +37,190 @@ def select(choice_list):
 
     return choice
 
+@functools.lru_cache(maxsize=8)
+def parse_sink_inputs(pacmd_output):
+    """ Parse the output of 'pacmd list-sink-inputs'
+    pacmd_output: Text printed by pacmd
+    return a dictionnary mapping each sink input index to a dictionnary of its
+    fields, the 'properties' field being itself a dictionnary.
+    Results are cached: they must not be modified.
+    """
+    sink_inputs = {}
+    current = None
+    in_properties = False
+    for line in pacmd_output.splitlines():
+        index = re.match(r"^\s*index: (\d+)", line)
+        if index:
+            current = {'properties': {}}
+            sink_inputs[int(index.group(1))] = current
+            in_properties = False
+            continue
+        if current is None:
+            continue
+        if re.match(r"^\s*properties:\s*$", line):
+            in_properties = True
+            continue
+        prop = re.match(r'^\s*([\w.-]+) = "(.*)"\s*$', line)
+        if in_properties and prop:
+            current['properties'][prop.group(1)] = prop.group(2)
+            continue
+        field = re.match(r"^\s*([\w ]+): (.*)$", line)
+        if field:
+            in_properties = False
+            current[field.group(1)] = field.group(2)
+    return sink_inputs
+
+def list_sink_inputs():
+    """ Ask PulseAudio for the current sink inputs (see parse_sink_inputs),
+    through libpulse if available, else running pacmd """
+    if pulseclient.available():
+        try:
+            with PulseClient("streamrecord") as client:
+                return client.list_sink_inputs()
+        except PulseError as error:
+            logging.debug("%s, falling back to pacmd", error)
+    pacmd_output = subprocess.check_output(["/usr/bin/pacmd", "list-sink-inputs"])
+    return parse_sink_inputs(pacmd_output.decode())
+
+def get_process_binary(pid):
+    """ Return the binary name of a process, as PulseAudio reports it """
+    try:
+        return os.path.basename(os.readlink("/proc/{}/exe".format(pid)))
+    except OSError:
+        try:
+            with open("/proc/{}/comm".format(pid)) as comm:
+                return comm.read().strip()
+        except OSError:
+            return None
+
+def is_descendant(pid, ancestor_pid):
+    """ Is the process pid a (grand-)child of ancestor_pid? """
+    while pid > 1:
+        try:
+            with open("/proc/{}/stat".format(pid)) as stat:
+                # Command name may contain spaces, parent pid follows its closing parenthesis
+                pid = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            return False
+        if pid == ancestor_pid:
+            return True
+    return False
+
+def match_sink_input(sink_inputs, pid):
+    """ Find the sink input played by the process pid (the owner of the window).
+    Sink inputs are ranked: played by pid itself, then by one of its children
+    (multi-process browsers), then by any process of the same binary.
+    Highest index wins on ties, as it is the latest stream.
+    return the index of the sink input, or None if no one matches
+    """
+    binary = get_process_binary(pid)
+    candidates = []
+    for index, sink_input in sink_inputs.items():
+        properties = sink_input['properties']
+        try:
+            process_id = int(properties.get('application.process.id'))
+        except (TypeError, ValueError):
+            process_id = None
+        if process_id == pid:
+            rank = 3
+        elif process_id is not None and is_descendant(process_id, pid):
+            rank = 2
+        elif binary is not None and properties.get('application.process.binary') == binary:
+            rank = 1
+        else:
+            continue
+        candidates.append((rank, index))
+    if not candidates:
+        return None
+    return max(candidates)[1]
+
+def wait_sink_input(pid, timeout=10, interval=0.5):
+    """ Wait for the process pid to play something and return its sink input index,
+    or None if nothing matches before timeout seconds """
+    deadline = time.time() + timeout
+    while True:
+        sink_input = match_sink_input(list_sink_inputs(), pid)
+        if sink_input is not None or time.time() >= deadline:
+            return sink_input
+        time.sleep(interval)
+
+def negotiate_format(sink_input=None, rate=None, channels=None, sample_width=None):
+    """ Return the AudioFormat to capture: the given rate, channels and sample width,
+    else the ones of the sink input stream (to be recorded without resampling nor
+    remixing), else the default ones """
+    native = None
+    if sink_input is not None and (rate is None or channels is None):
+        sink_inputs = list_sink_inputs()
+        if sink_input in sink_inputs:
+            native = AudioFormat.from_sample_spec(sink_inputs[sink_input].get('sample spec'))
+    native = native or DEFAULT_FORMAT
+    return AudioFormat(
+        rate or native.rate, channels or native.channels,
+        sample_width or DEFAULT_FORMAT.sample_width)
+
 class PulseAudioManager(threading.Thread):
     """ PulseAudio manager class that load required module, move sinks
     and restore everything at the end."""
-    def __init__(self, thread_synchronization, parec_output_pipe):
+    record_stream = None # If set, read by the stream loader instead of the pipe
+    def __init__(self, thread_synchronization, parec_output_pipe, sink_input=None,
+                 audio_format=DEFAULT_FORMAT, scheduling=None):
         """ Create a new PulseAudio Manager
         thread_synchronization Dictionnary with 'start' and 'end' objects for synchronization
         parec_output_pipe Writing end of a pipe where the parec output will
             be redirected.
+        sink_input Index of the sink input to record. If None, the user is prompted.
+        audio_format AudioFormat of the recording sink and of the parec output
+        scheduling If given, SchedulingPolicy of the parec process
         """
         super(PulseAudioManager, self).__init__(name="PulseAudio Manager")
         self.thread_start = thread_synchronization['start']
         self.thread_end = thread_synchronization['end']
         self.parec_process = None
+        self.parec_lock = threading.Lock() # Guards parec_process against restart_capture
         self.parec_output_pipe = parec_output_pipe
-        self.sink_input = None
+        self.sink_input = sink_input
+        self.audio_format = audio_format
+        self.scheduling = scheduling
         self.module_id = None
 
+    def select_sink_input(self):
+        """ Let the user choose the sink input to record if it is not known yet """
+        if self.sink_input is None:
+            print("Let's play your application... Then press Enter.")
+            _ = input()
+            sink_inputs = {
+                index: sink_input['properties'].get('application.name')
+                for index, sink_input in list_sink_inputs().items()
+            }
+            if len(sink_inputs.keys()) == 1:
+                self.sink_input = list(sink_inputs.keys())[0]
+            else:
+                self.sink_input = select(sink_inputs)
+
     def move_sink_input(self):
-        """ Let's the user choose a sink to move to the recorder """
-        def _parse_sink_inputs():
-            """ Read PA output to list all available sinks """
-            sink_inputs = {}
-            pacmd_process = subprocess.Popen(
-                ["/usr/bin/pacmd", "list-sink-inputs"],
-                stdout=subprocess.PIPE
-            )
-            for line in pacmd_process.stdout:
-                line = line.decode()
-                sink_index = re.search(r"^\s*index: (.*)", line)
-                if sink_index:
-                    for line in pacmd_process.stdout:
-                        line = line.decode()
-                        app_name = re.search(r"^\s*application.name = \"(.*)\"", line)
-                        if app_name:
-                            sink_inputs[int(sink_index.group(1))] = app_name.group(1)
-                            break
-            return sink_inputs
-
-        # Find which input need to be moved
-        print("Let's play your application... Then press Enter.")
-        _ = input()
-        sink_inputs = _parse_sink_inputs()
-        if len(sink_inputs.keys()) == 1:
-            self.sink_input = list(sink_inputs.keys())[0]
-        else:
-            self.sink_input = select(sink_inputs)
+        """ Move the sink to the recorder, letting the user choose it if it is not known yet """
+        self.select_sink_input()
 
-        # Load the null module
-        self.module_id = int(subprocess.check_output(
-            ["/usr/bin/pactl", "load-module", "module-null-sink", "sink_name=deezer_record"]
-        ))
+        # Load the null module, in the captured format for parec not to convert it
+        self.module_id = int(subprocess.check_output([
+            "/usr/bin/pactl", "load-module", "module-null-sink"
+        ] + self.null_sink_arguments()))
 
         # Move the sink input
         subprocess.call(
-            ["/usr/bin/pactl", "move-sink-input", str(self.sink_input), "deezer_record"]
+            ["/usr/bin/pactl", "move-sink-input", str(self.sink_input), SINK_NAME]
         )
 
+    def null_sink_arguments(self):
+        """ Return the arguments of the null sink, in the captured format
+        for the recording not to convert it """
+        return [
+            "sink_name={}".format(SINK_NAME),
+            "format={}".format(self.audio_format.pulse_format),
+            "rate={}".format(self.audio_format.rate),
+            "channels={}".format(self.audio_format.channels)
+        ]
+
     def reset_sink_input(self):
         """ Reset the PA configuration to its initial state """
         logging.debug("Reset sink input to its right sink")
@@ -94,13 +235,32 @@ class PulseAudioManager(threading.Thread):
     def launch_parec(self):
         """ Actually launch the record of the moved sink """
         self.parec_process = subprocess.Popen(
-            ["/usr/bin/parec", "-d", "deezer_record.monitor"],
+            [
+                "/usr/bin/parec", "-d", "{}.monitor".format(SINK_NAME),
+                "--format={}".format(self.audio_format.pulse_format),
+                "--rate={}".format(self.audio_format.rate),
+                "--channels={}".format(self.audio_format.channels)
+            ],
             stdout=self.parec_output_pipe
         )
+        if self.scheduling is not None:
+            self.scheduling.apply(self.parec_process.pid, "parec")
 
     def stop_parec(self):
         """ Stop recording of the stream """
-        self.parec_process.terminate()
+        with self.parec_lock:
+            self.parec_process.terminate()
+
+    def restart_capture(self):
+        """ Respawn a stalled or dead parec on the same null sink, the pipe
+        (and so the data already captured) being kept """
+        with self.parec_lock:
+            if self.parec_process is None or self.thread_end.is_set():
+                return
+            self.parec_process.kill()
+            self.parec_process.wait()
+            logging.warning("parec (%d) killed, relaunching it", self.parec_process.pid)
+            self.launch_parec()
 
     def run(self):
         self.move_sink_input()
@@ -113,3 +273,65 @@ class PulseAudioManager(threading.Thread):
         self.stop_parec()
         self.reset_sink_input()
         logging.info("Exit")
+
+class NativePulseAudioManager(PulseAudioManager):
+    """ PulseAudio manager talking to the server through libpulse: no pactl
+    nor parec process, the stream loader reads the recorded audio straight
+    from the server instead of a pipe """
+    def __init__(self, thread_synchronization, parec_output_pipe, sink_input=None,
+                 audio_format=DEFAULT_FORMAT, scheduling=None,
+                 fragment_seconds=FRAGMENT_SECONDS):
+        """ Same as PulseAudioManager, the pipe being unused, and the scheduling
+        policy being the one of the stream loader reading the record stream
+        fragment_seconds Duration of audio delivered at once by the server
+        """
+        super(NativePulseAudioManager, self).__init__(
+            thread_synchronization, parec_output_pipe, sink_input, audio_format, scheduling)
+        self.client = None
+        self.original_sink = None
+        self.record_stream = RecordStream(
+            "{}.monitor".format(SINK_NAME), audio_format, fragment_seconds)
+
+    def move_sink_input(self):
+        self.select_sink_input()
+        self.client = PulseClient("streamrecord manager")
+        sink_input = self.client.list_sink_inputs().get(self.sink_input)
+        if sink_input is not None:
+            self.original_sink = int(sink_input['sink'].split()[0])
+        self.module_id = self.client.load_module(
+            "module-null-sink", " ".join(self.null_sink_arguments()))
+        self.client.move_sink_input(self.sink_input, SINK_NAME)
+
+    def reset_sink_input(self):
+        logging.debug("Reset sink input to its sink %s", self.original_sink)
+        try:
+            if self.original_sink is not None:
+                self.client.move_sink_input(self.sink_input, self.original_sink)
+        except PulseError as error: # The stream may have ended meanwhile
+            logging.warning("%s", error)
+        logging.debug("Unload NULL module")
+        # Ends the record stream, and so the reads of the stream loader
+        self.client.unload_module(self.module_id)
+        self.client.close()
+
+    def launch_parec(self):
+        """ Nothing to launch: the record stream is opened by its first read """
+
+    def stop_parec(self):
+        """ Nothing to stop: the record stream ends with the null sink """
+
+    def restart_capture(self):
+        """ Reconnect the record stream to the same null sink """
+        self.record_stream.restart()
+
+BACKENDS = {
+    'native': NativePulseAudioManager,
+    'subprocess': PulseAudioManager
+}
+
+def capture_backend(name=None):
+    """ Return the PulseAudio manager class of the backend name (see BACKENDS),
+    by default the native one if libpulse is available """
+    if name is None:
+        name = 'native' if pulseclient.available() else 'subprocess'
+    return BACKENDS[name]
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Minimal PulseAudio client, talking to the server through libpulse (ctypes),
+instead of running pacmd, pactl and parec
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import functools
+import threading
+
+SAMPLE_FORMATS = {"s16le": 3, "s24le": 9} # pa_sample_format_t of AudioFormat.pulse_format
+CHANNELS_MAX = 32
+INVALID_INDEX = 0xffffffff # Also the "server default" value of pa_buffer_attr fields
+CONTEXT_READY, CONTEXT_FAILED, CONTEXT_TERMINATED = 4, 5, 6
+STREAM_READY, STREAM_FAILED, STREAM_TERMINATED = 2, 3, 4
+OPERATION_RUNNING = 0
+STREAM_ADJUST_LATENCY = 0x2000 # Let the server honor the fragment size
+FRAGMENT_SECONDS = 0.05 # Capture latency, as much audio is delivered at once
+
+class PulseError(Exception):
+    """ Failure of a PulseAudio call, or libpulse not available """
+
+class SampleSpec(ctypes.Structure):
+    """ pa_sample_spec """
+    _fields_ = [("format", ctypes.c_int), ("rate", ctypes.c_uint32), ("channels", ctypes.c_uint8)]
+
+class BufferAttr(ctypes.Structure):
+    """ pa_buffer_attr """
+    _fields_ = [(name, ctypes.c_uint32)
+                for name in ("maxlength", "tlength", "prebuf", "minreq", "fragsize")]
+
+class ChannelMap(ctypes.Structure):
+    """ pa_channel_map """
+    _fields_ = [("channels", ctypes.c_uint8), ("map", ctypes.c_int * CHANNELS_MAX)]
+
+class CVolume(ctypes.Structure):
+    """ pa_cvolume """
+    _fields_ = [("channels", ctypes.c_uint8), ("values", ctypes.c_uint32 * CHANNELS_MAX)]
+
+class SinkInputInfo(ctypes.Structure):
+    """ pa_sink_input_info, up to the fields used """
+    _fields_ = [
+        ("index", ctypes.c_uint32),
+        ("name", ctypes.c_char_p),
+        ("owner_module", ctypes.c_uint32),
+        ("client", ctypes.c_uint32),
+        ("sink", ctypes.c_uint32),
+        ("sample_spec", SampleSpec),
+        ("channel_map", ChannelMap),
+        ("volume", CVolume),
+        ("buffer_usec", ctypes.c_uint64),
+        ("sink_usec", ctypes.c_uint64),
+        ("resample_method", ctypes.c_char_p),
+        ("driver", ctypes.c_char_p),
+        ("mute", ctypes.c_int),
+        ("proplist", ctypes.c_void_p),
+        ("corked", ctypes.c_int)
+    ]
+
+SUCCESS_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p)
+INDEX_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p)
+SINK_INPUT_INFO_CALLBACK = ctypes.CFUNCTYPE(
+    None, ctypes.c_void_p, ctypes.POINTER(SinkInputInfo), ctypes.c_int, ctypes.c_void_p)
+
+@functools.lru_cache(maxsize=1)
+def load_libpulse():
+    """ Return the libpulse library, with the prototypes of the used functions """
+    path = ctypes.util.find_library("pulse")
+    if path is None:
+        raise PulseError("libpulse not found")
+    lib = ctypes.CDLL(path)
+    pointer, integer, string = ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p
+    prototypes = {
+        'pa_mainloop_new': (pointer, []),
+        'pa_mainloop_get_api': (pointer, [pointer]),
+        'pa_mainloop_iterate': (integer, [pointer, integer, ctypes.POINTER(integer)]),
+        'pa_mainloop_wakeup': (None, [pointer]),
+        'pa_mainloop_free': (None, [pointer]),
+        'pa_context_new': (pointer, [pointer, string]),
+        'pa_context_connect': (integer, [pointer, string, integer, pointer]),
+        'pa_context_get_state': (integer, [pointer]),
+        'pa_context_errno': (integer, [pointer]),
+        'pa_context_disconnect': (None, [pointer]),
+        'pa_context_unref': (None, [pointer]),
+        'pa_context_get_sink_input_info_list': (
+            pointer, [pointer, SINK_INPUT_INFO_CALLBACK, pointer]),
+        'pa_context_load_module': (pointer, [pointer, string, string, INDEX_CALLBACK, pointer]),
+        'pa_context_unload_module': (
+            pointer, [pointer, ctypes.c_uint32, SUCCESS_CALLBACK, pointer]),
+        'pa_context_move_sink_input_by_name': (
+            pointer, [pointer, ctypes.c_uint32, string, SUCCESS_CALLBACK, pointer]),
+        'pa_context_move_sink_input_by_index': (
+            pointer, [pointer, ctypes.c_uint32, ctypes.c_uint32, SUCCESS_CALLBACK, pointer]),
+        'pa_operation_get_state': (integer, [pointer]),
+        'pa_operation_unref': (None, [pointer]),
+        'pa_proplist_iterate': (string, [pointer, ctypes.POINTER(pointer)]),
+        'pa_proplist_gets': (string, [pointer, string]),
+        'pa_sample_spec_snprint': (string, [string, ctypes.c_size_t, ctypes.POINTER(SampleSpec)]),
+        'pa_strerror': (string, [integer]),
+        'pa_stream_new': (pointer, [pointer, string, ctypes.POINTER(SampleSpec), pointer]),
+        'pa_stream_connect_record': (
+            integer, [pointer, string, ctypes.POINTER(BufferAttr), integer]),
+        'pa_stream_get_state': (integer, [pointer]),
+        'pa_stream_peek': (
+            integer, [pointer, ctypes.POINTER(pointer), ctypes.POINTER(ctypes.c_size_t)]),
+        'pa_stream_drop': (integer, [pointer]),
+        'pa_stream_disconnect': (integer, [pointer]),
+        'pa_stream_unref': (None, [pointer])
+    }
+    for name, (restype, argtypes) in prototypes.items():
+        function = getattr(lib, name)
+        function.restype = restype
+        function.argtypes = argtypes
+    return lib
+
+@functools.lru_cache(maxsize=1)
+def available():
+    """ Can libpulse be used? """
+    try:
+        load_libpulse()
+        return True
+    except (PulseError, OSError, AttributeError):
+        return False
+
+class PulseClient:
+    """ Connection to the PulseAudio server (the default one, or PULSE_SERVER's),
+    with its own main loop: it must be used by one thread at a time """
+    def __init__(self, name="streamrecord"):
+        self.lib = load_libpulse()
+        self.mainloop = self.lib.pa_mainloop_new()
+        self.context = self.lib.pa_context_new(
+            self.lib.pa_mainloop_get_api(self.mainloop), name.encode())
+        if self.lib.pa_context_connect(self.context, None, 0, None) < 0:
+            error = self.error()
+            self.close()
+            raise error
+        while True:
+            state = self.lib.pa_context_get_state(self.context)
+            if state == CONTEXT_READY:
+                break
+            if state in (CONTEXT_FAILED, CONTEXT_TERMINATED):
+                error = self.error()
+                self.close()
+                raise error
+            self.iterate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def error(self, message="PulseAudio error"):
+        """ Return the PulseError of the last failure of the context """
+        return PulseError("{}: {}".format(
+            message, self.lib.pa_strerror(self.lib.pa_context_errno(self.context)).decode()))
+
+    def iterate(self, block=True):
+        """ Run one iteration of the main loop, waiting for events if block """
+        if self.lib.pa_mainloop_iterate(self.mainloop, int(block), None) < 0:
+            raise PulseError("Connection to the PulseAudio server lost")
+
+    def wait(self, operation, message):
+        """ Run the main loop until the operation is done """
+        if not operation:
+            raise self.error(message)
+        try:
+            while self.lib.pa_operation_get_state(operation) == OPERATION_RUNNING:
+                self.iterate()
+        finally:
+            self.lib.pa_operation_unref(operation)
+
+    def list_sink_inputs(self):
+        """ Return the current sink inputs, as parse_sink_inputs of the pulseaudiomanager """
+        sink_inputs = {}
+        def on_info(context, info, eol, userdata):
+            if eol or not info:
+                return
+            info = info.contents
+            properties = {}
+            state = ctypes.c_void_p()
+            while True:
+                key = self.lib.pa_proplist_iterate(info.proplist, ctypes.byref(state))
+                if key is None:
+                    break
+                value = self.lib.pa_proplist_gets(info.proplist, key)
+                properties[key.decode()] = value.decode('utf-8', 'replace') if value else ""
+            sample_spec = ctypes.create_string_buffer(64)
+            self.lib.pa_sample_spec_snprint(sample_spec, 64, ctypes.byref(info.sample_spec))
+            sink_inputs[info.index] = {
+                'properties': properties,
+                'driver': (info.driver or b"").decode(),
+                'sink': str(info.sink),
+                'state': "CORKED" if info.corked else "RUNNING",
+                'sample spec': sample_spec.value.decode()
+            }
+        callback = SINK_INPUT_INFO_CALLBACK(on_info)
+        self.wait(self.lib.pa_context_get_sink_input_info_list(self.context, callback, None),
+                  "Unable to list the sink inputs")
+        return sink_inputs
+
+    def load_module(self, name, arguments=""):
+        """ Load a module and return its index """
+        result = []
+        callback = INDEX_CALLBACK(lambda context, index, userdata: result.append(index))
+        self.wait(self.lib.pa_context_load_module(
+            self.context, name.encode(), arguments.encode(), callback, None),
+                  "Unable to load {}".format(name))
+        if not result or result[0] == INVALID_INDEX:
+            raise self.error("Unable to load {}".format(name))
+        return result[0]
+
+    def call(self, function, message, *arguments):
+        """ Run an operation reporting its success, raise a PulseError if it failed """
+        result = []
+        callback = SUCCESS_CALLBACK(lambda context, success, userdata: result.append(success))
+        self.wait(function(self.context, *arguments, callback, None), message)
+        if not result or not result[0]:
+            raise self.error(message)
+
+    def unload_module(self, index):
+        """ Unload the module of the given index """
+        self.call(self.lib.pa_context_unload_module,
+                  "Unable to unload module {}".format(index), index)
+
+    def move_sink_input(self, index, sink):
+        """ Move a sink input to the sink, given by index or by name """
+        message = "Unable to move sink input {} to {}".format(index, sink)
+        if isinstance(sink, int):
+            self.call(self.lib.pa_context_move_sink_input_by_index, message, index, sink)
+        else:
+            self.call(self.lib.pa_context_move_sink_input_by_name, message, index, sink.encode())
+
+    def close(self):
+        """ Disconnect from the server """
+        if self.context:
+            self.lib.pa_context_disconnect(self.context)
+            self.lib.pa_context_unref(self.context)
+            self.context = None
+        if self.mainloop:
+            self.lib.pa_mainloop_free(self.mainloop)
+            self.mainloop = None
+
+class RecordStream:
+    """ Record stream of a PulseAudio source, read as a file. The connection is
+    opened by the first read, by the reading thread which then owns it.
+    A failed stream reads as empty until it is restarted. """
+    def __init__(self, source, audio_format, fragment_seconds=FRAGMENT_SECONDS):
+        """
+        source: Name of the recorded source (a sink monitor)
+        audio_format: AudioFormat the server converts the recorded audio to
+        fragment_seconds: Duration of the fragments sent by the server, which
+            bounds the capture latency
+        """
+        self.source = source
+        self.audio_format = audio_format
+        self.fragment_bytes = audio_format.round(fragment_seconds * audio_format.bytes_per_second)
+        self.client = None
+        self.stream = None
+        self.opened = False # Only the first connection is opened on demand
+        self.restarting = False # Reconnect at the next read, see restart
+        self.lock = threading.Lock() # Guards the client against restart
+
+    def open(self):
+        """ Connect the record stream """
+        client = PulseClient("streamrecord capture")
+        with self.lock:
+            self.client = client
+        self.opened = True
+        lib = self.client.lib
+        sample_spec = SampleSpec(
+            SAMPLE_FORMATS[self.audio_format.pulse_format], self.audio_format.rate,
+            self.audio_format.channels)
+        self.stream = lib.pa_stream_new(
+            self.client.context, b"streamrecord", ctypes.byref(sample_spec), None)
+        if not self.stream:
+            raise self.client.error("Unable to create the record stream")
+        buffer_attr = BufferAttr(
+            INVALID_INDEX, INVALID_INDEX, INVALID_INDEX, INVALID_INDEX, self.fragment_bytes)
+        if lib.pa_stream_connect_record(
+                self.stream, self.source.encode(), ctypes.byref(buffer_attr),
+                STREAM_ADJUST_LATENCY) < 0:
+            raise self.client.error("Unable to record {}".format(self.source))
+        while lib.pa_stream_get_state(self.stream) not in (
+                STREAM_READY, STREAM_FAILED, STREAM_TERMINATED):
+            self.client.iterate()
+        if lib.pa_stream_get_state(self.stream) != STREAM_READY:
+            raise self.client.error("Unable to record {}".format(self.source))
+
+    def read(self, size):
+        """ Return at least size bytes of whole frames (the fragments are not split),
+        less once the stream ended (e.g. its source was removed) """
+        if self.restarting:
+            self.restarting = False
+            self.close()
+            try:
+                self.open()
+            except PulseError as error: # Retried at the next restart
+                logging.warning("Unable to reconnect the record stream: %s", error)
+                self.close()
+        elif self.stream is None and not self.opened:
+            self.open()
+        if self.stream is None:
+            return b""
+        lib = self.client.lib
+        data, length = ctypes.c_void_p(), ctypes.c_size_t()
+        fragments, read = [], 0
+        while (read < size and not self.restarting and
+               lib.pa_stream_get_state(self.stream) == STREAM_READY):
+            if lib.pa_stream_peek(self.stream, ctypes.byref(data), ctypes.byref(length)) < 0:
+                break
+            if length.value == 0:
+                try:
+                    self.client.iterate() # Wait for the next fragment
+                except PulseError as error:
+                    logging.warning("Record stream failed: %s", error)
+                    self.close()
+                    break
+                continue
+            if data.value: # Else a hole in the stream: nothing was recorded
+                # The only copy, from the memory shared with the server
+                fragments.append(ctypes.string_at(data.value, length.value))
+                read += length.value
+            lib.pa_stream_drop(self.stream)
+        return b"".join(fragments)
+
+    def restart(self):
+        """ Reconnect the stream at the next read, waking up the pending one.
+        Unlike the other methods, it may be called by any thread. """
+        with self.lock:
+            self.restarting = True
+            if self.client is not None:
+                self.client.lib.pa_mainloop_wakeup(self.client.mainloop)
+
+    def close(self):
+        """ Disconnect the stream """
+        with self.lock:
+            if self.stream is not None:
+                self.client.lib.pa_stream_disconnect(self.stream)
+                self.client.lib.pa_stream_unref(self.stream)
+                self.stream = None
+            if self.client is not None:
+                self.client.close()
+                self.client = None
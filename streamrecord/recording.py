@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Implementation of a recording session, gathering the shared ressources
+and the threads working on them
+"""
+
+import os
+import queue
+import logging
+import functools
+import threading
+
+if __package__ == "":
+    from pulseaudiomanager import capture_backend, wait_sink_input, negotiate_format
+    from appinspector import NotifyAppInspector, get_x_win_pid
+    from streamloader import StreamLoader
+    from songwriter import SongWriter
+    from metrics import registry, InstrumentedLock
+    from noisefloor import NoiseFloorEstimator
+    from supervisor import Supervisor
+    from backlog import CompressedBacklog
+elif __package__ == "streamrecord":
+    from streamrecord.pulseaudiomanager import (
+        capture_backend, wait_sink_input, negotiate_format)
+    from streamrecord.appinspector import NotifyAppInspector, get_x_win_pid
+    from streamrecord.streamloader import StreamLoader
+    from streamrecord.songwriter import SongWriter
+    from streamrecord.metrics import registry, InstrumentedLock
+    from streamrecord.noisefloor import NoiseFloorEstimator
+    from streamrecord.supervisor import Supervisor
+    from streamrecord.backlog import CompressedBacklog
+
+class Recording:
+    """ One recording session: create interprocess ressources and threads,
+    launch and join them. """
+    def __init__(self, win_id, title_regex, audio_encoder,
+                 app_inspector=NotifyAppInspector, continuous=False, sink_input=None,
+                 interactive=True, capture_source=None, clock=None,
+                 noise_floor_half_life=None, library=None, fingerprints=None,
+                 rate=None, channels=None, sample_width=None, drop_rules=None,
+                 pulse_backend=None, scheduling=None, supervise=True, encode_timeout=None,
+                 compress_backlog=None):
+        """
+        win_id: X Window ID of the window to record audio from
+        title_regex: Compiled regex extracting artist and title from the window title
+        audio_encoder: Encoder instance used to convert the songs
+        app_inspector: AppInspector class used to detect title changes
+        continuous: Record infinitely
+        sink_input: Index of the PulseAudio sink input to record. If None, it is
+            matched against the window's process, and the user is prompted if
+            that fails (a RuntimeError is raised if not interactive).
+        capture_source: Callable creating the thread writing raw audio in the pipe, from
+            the synchronization dictionnary and the pipe. Defaults to a PulseAudioManager.
+            If the thread has a record_stream, it is read instead of the pipe.
+        clock: Clock of the application inspector and the song writer (real time by default)
+        noise_floor_half_life: If set, seconds after which the captured audio weights half
+            in the silence threshold estimation. Otherwise the whole session is used.
+        library: If given, Library of the already recorded songs, which are not written again
+        fingerprints: If given, FingerprintIndex of the already recorded songs, which are
+            not encoded again. Hearing again a song of the session ends it if not continuous.
+        rate, channels, sample_width: Format of the captured audio. Unset ones are the
+            ones of the recorded sink input if known (see negotiate_format), else the
+            ones of CD audio. The capture source is given the format as audio_format.
+        drop_rules: If given, DropRules of the segments dropped from the buffer
+            without being written nor encoded (ads, jingles...)
+        pulse_backend: Backend of the default capture source, 'native' (libpulse) or
+            'subprocess' (pactl and parec). Defaults to the native one if available.
+        scheduling: If given, (capture, encoder) SchedulingPolicy pair (see
+            scheduling.default_policies) of the stream loader and parec, and of the
+            encoder processes
+        supervise: Restart the stalled components (see Supervisor), and stop the
+            recording if one of them dies
+        encode_timeout: If set, seconds after which a supervised encoding is killed,
+            its raw file being kept
+        compress_backlog: If set, seconds after which the buffered audio is
+            compressed in memory (see CompressedBacklog)
+        """
+        self.win_id = win_id
+        self.audio_encoder = audio_encoder
+
+        if capture_source is None and sink_input is None:
+            win_pid = get_x_win_pid(win_id)
+            if win_pid is not None:
+                logging.info("Looking for sink inputs of process %d", win_pid)
+                sink_input = wait_sink_input(win_pid)
+            if sink_input is not None:
+                logging.info("Sink input %d selected", sink_input)
+            elif not interactive:
+                raise RuntimeError("No sink input found for window {}".format(win_id))
+        self.audio_format = negotiate_format(
+            sink_input if capture_source is None else None, rate, channels, sample_width)
+        logging.info("Capturing %s", self.audio_format)
+
+        # Create shared ressources
+        parec_pipe_read_end, parec_pipe_write_end = os.pipe() # create a pipe
+        self.parec_pipe_read_end = os.fdopen(parec_pipe_read_end, 'rb')
+        self.parec_pipe_write_end = os.fdopen(parec_pipe_write_end, 'wb')
+        start_barrier = threading.Barrier(4) # A barrier to synchronize thread
+        self.end_event = threading.Event() # Event set when all data are processed
+        self.task_queue = queue.Queue() # Thread safe queue for interprocess communication
+        # Container of the raw data ...
+        if compress_backlog is not None:
+            self.raw_data = CompressedBacklog(self.audio_format, compress_backlog)
+        else:
+            self.raw_data = bytearray()
+        self.raw_data_lock = InstrumentedLock("raw_data_lock") # ... and its lock
+        self.noise_floor = NoiseFloorEstimator(
+            half_life=noise_floor_half_life, audio_format=self.audio_format)
+        logging.info("Shared ressources initialized")
+
+        capture_scheduling, encoder_scheduling = scheduling or (None, None)
+        if encoder_scheduling is not None:
+            audio_encoder.scheduling = encoder_scheduling
+        if encode_timeout is not None:
+            audio_encoder.timeout = encode_timeout
+
+        # Create threads
+        if capture_source is None:
+            capture_source = functools.partial(
+                capture_backend(pulse_backend), sink_input=sink_input,
+                scheduling=capture_scheduling)
+        self.browser_recorder = capture_source(
+            {
+                'start': start_barrier,
+                'end': self.end_event
+            },
+            self.parec_pipe_write_end,
+            audio_format=self.audio_format)
+        self.capture_input = (getattr(self.browser_recorder, 'record_stream', None) or
+                              self.parec_pipe_read_end)
+
+        self.browser_inspector = app_inspector(
+            {
+                'start': start_barrier,
+                'tasks': self.task_queue,
+                'end': self.end_event
+            }, {
+                'raw_data' : self.raw_data,
+                'lock': self.raw_data_lock
+            }, {
+                'win_id': win_id,
+                'title_regex': title_regex
+            },
+            continuous,
+            clock,
+            rules=drop_rules)
+
+        self.stream_loader = StreamLoader(
+            {
+                'start': start_barrier,
+                'end': self.end_event
+            },
+            self.capture_input,
+            {
+                'raw_data' : self.raw_data,
+                'lock': self.raw_data_lock,
+                'noise_floor': self.noise_floor,
+                'audio_format': self.audio_format
+            },
+            capture_scheduling)
+
+        self.song_writer = SongWriter(
+            {
+                'start': start_barrier,
+                'tasks': self.task_queue,
+                'end': self.end_event
+            }, {
+                'raw_data' : self.raw_data,
+                'lock': self.raw_data_lock,
+                'noise_floor': self.noise_floor,
+                'audio_format': self.audio_format
+            },
+            audio_encoder,
+            clock,
+            library,
+            fingerprints,
+            not continuous
+            )
+
+        self.threads = [
+            self.browser_recorder,
+            self.browser_inspector,
+            self.stream_loader,
+            self.song_writer
+        ]
+        self.supervisor = None
+        if supervise:
+            self.supervisor = Supervisor(
+                {
+                    'start': start_barrier,
+                    'end': self.end_event
+                }, {
+                    'raw_data' : self.raw_data,
+                    'lock': self.raw_data_lock
+                }, {
+                    'capture': self.browser_recorder,
+                    'inspector': self.browser_inspector,
+                    'loader': self.stream_loader,
+                    'writer': self.song_writer
+                },
+                audio_encoder)
+            self.threads.append(self.supervisor)
+        logging.info("Threads initialized. Ready for launching")
+
+    def collect_metrics(self, metrics):
+        """ Refresh the gauges of the session """
+        with self.raw_data_lock:
+            len_raw_data = len(self.raw_data)
+        metrics.set(
+            "streamrecord_buffer_seconds", len_raw_data / self.audio_format.bytes_per_second)
+        metrics.set("streamrecord_task_queue_depth", self.task_queue.qsize())
+        if isinstance(self.raw_data, CompressedBacklog):
+            metrics.set("streamrecord_buffer_memory_bytes", self.raw_data.memory())
+        noise_floor = self.noise_floor.noise_floor_db()
+        if noise_floor is not None:
+            metrics.set("streamrecord_noise_floor_db", noise_floor)
+
+    def profile(self, profiler):
+        """ Install profiler in the threads of the session, including the
+        backlog compressor which is not a component. Must be called before start. """
+        threads = list(self.threads)
+        if isinstance(self.raw_data, CompressedBacklog):
+            threads.append(self.raw_data.compressor)
+        for thread in threads:
+            profiler.profile(thread)
+
+    def start(self):
+        """ Launch all the threads """
+        registry.add_collector(self.collect_metrics)
+        if isinstance(self.raw_data, CompressedBacklog):
+            self.raw_data.start()
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """ Ask all the threads to stop """
+        self.end_event.set()
+
+    def is_alive(self):
+        """ Is any thread of the session still running? """
+        return any(thread.is_alive() for thread in self.threads)
+
+    def join(self):
+        """ Wait for all the threads and release the shared ressources """
+        self.browser_recorder.join()
+        logging.info("%s joined", repr(self.browser_recorder))
+        self.parec_pipe_write_end.close()
+
+        self.stream_loader.join()
+        logging.info("%s joined", repr(self.stream_loader))
+        self.parec_pipe_read_end.close()
+        if self.capture_input is not self.parec_pipe_read_end:
+            self.capture_input.close()
+
+        self.browser_inspector.join()
+        logging.info("%s joined", repr(self.browser_inspector))
+
+        self.song_writer.join()
+        logging.info("%s joined", repr(self.song_writer))
+
+        if self.supervisor is not None:
+            self.supervisor.join()
+        if isinstance(self.raw_data, CompressedBacklog):
+            self.raw_data.close()
+        registry.remove_collector(self.collect_metrics)
+
+    def status(self):
+        """ Return a JSON serializable summary of the session """
+        with self.raw_data_lock:
+            len_raw_data = len(self.raw_data)
+        return {
+            'win_id': self.win_id,
+            'running': self.is_alive(),
+            'stopping': self.end_event.is_set(),
+            'sink_input': getattr(self.browser_recorder, 'sink_input', None),
+            'pending_tasks': self.task_queue.qsize(),
+            'audio_format': str(self.audio_format),
+            'buffered_seconds': len_raw_data / self.audio_format.bytes_per_second,
+            'songs_written': self.song_writer.songs_written,
+            'songs_skipped': self.song_writer.songs_skipped,
+            'songs_dropped': self.song_writer.songs_dropped,
+            'songs_failed': self.song_writer.songs_failed,
+            'restarts': dict(self.supervisor.restarts) if self.supervisor is not None else {}
+        }
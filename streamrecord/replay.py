@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Replay sources, standing in for parec and for the player window, to run
+the real pipeline from a raw file and a script of title changes, possibly
+faster than real time.
+"""
+
+import io
+import logging
+import threading
+
+if __package__ == "":
+    from appinspector import AppInspector
+    from clock import Clock
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.appinspector import AppInspector
+    from streamrecord.clock import Clock
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+class FileCaptureSource(threading.Thread):
+    """ Stand-in for the PulseAudio manager: write a raw file in the pipe at
+    speed times the real time. """
+    def __init__(self, thread_synchronization, output_pipe, path, speed=1.0, chunk_seconds=0.1,
+                 clock=None, audio_format=DEFAULT_FORMAT):
+        """
+        thread_synchronization: Dictionnary with 'start' and 'end' objects for synchronization
+        output_pipe: Writing end of the pipe read by the stream loader
+        path: Raw file to replay, in audio_format
+        speed: Replay speed factor
+        chunk_seconds: Duration of audio written at once
+        clock: Clock used to pace the replay
+        audio_format: AudioFormat of the file
+        """
+        super(FileCaptureSource, self).__init__(name="Capture Replay")
+        self.thread_start = thread_synchronization['start']
+        self.thread_end = thread_synchronization['end']
+        self.output_pipe = output_pipe
+        self.path = path
+        self.speed = speed
+        self.audio_format = audio_format
+        self.chunk_bytes = int(chunk_seconds * audio_format.rate) * audio_format.frame_bytes
+        self.written = 0
+        self.clock = Clock() if clock is None else clock
+
+    def run(self):
+        one_second_samples_num = self.audio_format.bytes_per_second # Number of bytes in one second
+        logging.info("Start barrier reached")
+        self.thread_start.wait()
+        start = self.clock.time()
+        with io.open(self.path, 'rb') as input_file:
+            while not self.thread_end.is_set():
+                chunk = input_file.read(self.chunk_bytes)
+                if not chunk:
+                    logging.info("End of '%s' reached", self.path)
+                    break
+                self.output_pipe.write(chunk)
+                self.output_pipe.flush()
+                self.written += len(chunk)
+                # Keep the replay at the requested speed
+                delay = (start + self.written / (one_second_samples_num * self.speed) -
+                         self.clock.time())
+                if delay > 0:
+                    self.clock.sleep(delay)
+        self.thread_end.wait()
+        logging.info("Exit")
+
+class ScriptedAppInspector(AppInspector):
+    """ Stand-in for the window inspectors: titles change according to a script.
+    Reported times are on the audio timeline, so task lengths are in audio
+    seconds whatever the replay speed. """
+    def __init__(self, synchronization, data, x_info, continuous=False, clock=None,
+                 rules=None, script=(), speed=1.0):
+        """
+        script: List of (time, title) tuples, time being in seconds of audio since
+            the beginning of the replay. The first title must be at time 0. In
+            continuous mode, the last entry marks the end of the replay.
+        speed: Replay speed factor, the same as the capture source one
+        """
+        super(ScriptedAppInspector, self).__init__(
+            synchronization, data, x_info, continuous, clock, rules)
+        self.script = list(script)
+        self.speed = speed
+        self.position = 0
+        self.origin = None
+
+    def get_x_win_title(self):
+        return self.script[self.position][1]
+
+    def detect_changes(self, previous_name, previous_time):
+        if self.origin is None:
+            # Start of the replay, see AppInspector.run
+            self.origin = previous_time
+        self.position = min(self.position + 1, len(self.script) - 1)
+        change_time, title = self.script[self.position]
+        delay = self.origin + change_time / self.speed - self.clock.time()
+        if delay > 0:
+            self.clock.sleep(delay)
+        if self.position == len(self.script) - 1:
+            # Nothing will change anymore
+            self.thread_end.set()
+        return title, self.origin + change_time
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Retagging and renaming of encoded songs without encoding them again: the
+ID3v2 (and ID3v1) tags of MP3 files and the Vorbis comments of FLAC files are
+rewritten in place, in the padding left after the tags when it is large enough
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import logging
+import argparse
+import concurrent.futures
+
+if __package__ == "":
+    from encoder import Encoder, Mp3LameEncoder, FlacEncoder
+    from library import Library
+elif __package__ == "streamrecord":
+    from streamrecord.encoder import Encoder, Mp3LameEncoder, FlacEncoder
+    from streamrecord.library import Library
+
+PADDING = 1024 # Bytes left after rewritten tags, for the next retagging to be in place
+COPY_BUFFER = 1 << 20 # Bytes copied at once when the audio data has to be moved
+
+ID3_FRAMES = {
+    "title": "TIT2",
+    "artist": "TPE1",
+    "album": "TALB",
+    "track": "TRCK",
+    "genre": "TCON"
+}
+ID3_YEAR_FRAMES = {3: "TYER", 4: "TDRC"} # Depends on the ID3v2 version
+ID3_ENCODINGS = {0: "latin-1", 1: "utf-16", 2: "utf-16-be", 3: "utf-8"}
+ID3_WRITTEN_ENCODINGS = {3: 1, 4: 3} # UTF-16 with BOM for ID3v2.3, UTF-8 for ID3v2.4
+ID3V1_FIELDS = (("title", 30), ("artist", 30), ("album", 30), ("year", 4), ("comment", 28))
+
+def synchsafe(data):
+    """ Return the integer of 4 bytes of 7 bits """
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+def to_synchsafe(value):
+    """ Return the 4 bytes of 7 bits encoding value """
+    return bytes((value >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+def split_id3_text(data, encoding):
+    """ Split the null separated strings of an ID3v2 frame """
+    if ID3_ENCODINGS[encoding].startswith("utf-16"):
+        # Separators are aligned 2 bytes nulls
+        parts = [data[index:index + 2] for index in range(0, len(data) - len(data) % 2, 2)]
+        strings, current = [], b""
+        for part in parts:
+            if part == b"\0\0":
+                strings.append(current)
+                current = b""
+            else:
+                current += part
+        strings.append(current)
+    else:
+        strings = data.split(b"\0")
+    return [string.decode(ID3_ENCODINGS[encoding], 'replace') for string in strings]
+
+def id3_text(version, *strings):
+    """ Return the data of an ID3v2 frame holding the null separated strings """
+    encoding = ID3_WRITTEN_ENCODINGS[version]
+    separator = b"\0\0" if encoding == 1 else b"\0"
+    return bytes((encoding,)) + separator.join(
+        string.encode(ID3_ENCODINGS[encoding]) for string in strings)
+
+class ID3Tag:
+    """ ID3v2.3 or ID3v2.4 tag at the beginning of a MP3 file """
+    def __init__(self, version=3, frames=(), size=0):
+        """
+        version: Major version of the tag (3 or 4)
+        frames: List of (frame id, flags, data) of the tag
+        size: Bytes used by the tag in the file, header and padding included
+        """
+        self.version = version
+        self.frames = list(frames)
+        self.size = size
+
+    @classmethod
+    def read(cls, mp3_file):
+        """ Parse the tag at the beginning of mp3_file, an empty one if there is none """
+        header = mp3_file.read(10)
+        if len(header) < 10 or header[:3] != b"ID3":
+            return cls()
+        version, flags = header[3], header[5]
+        if version not in ID3_WRITTEN_ENCODINGS:
+            raise ValueError("Unsupported ID3v2.{} tag".format(version))
+        if flags & 0x80:
+            raise ValueError("Unsynchronised ID3v2 tags are not supported")
+        size = synchsafe(header[6:10])
+        body = mp3_file.read(size)
+        position = 0
+        if flags & 0x40: # Extended header, dropped when rewritten
+            position = (synchsafe(body[:4]) if version == 4 else
+                        struct.unpack(">I", body[:4])[0] + 4)
+        frames = []
+        while position + 10 <= len(body) and body[position] != 0:
+            frame_id = body[position:position + 4].decode('latin-1')
+            frame_size = (synchsafe(body[position + 4:position + 8]) if version == 4 else
+                          struct.unpack(">I", body[position + 4:position + 8])[0])
+            frame_flags = body[position + 8:position + 10]
+            frames.append((frame_id, frame_flags, body[position + 10:position + 10 + frame_size]))
+            position += 10 + frame_size
+        # A footer is not counted in the size
+        return cls(version, frames, 10 + size + (10 if flags & 0x10 else 0))
+
+    def get_infos(self):
+        """ Return the infos (as given to the encoders) held by the tag """
+        keys = {frame_id: key for key, frame_id in ID3_FRAMES.items()}
+        keys.update({frame_id: "year" for frame_id in ID3_YEAR_FRAMES.values()})
+        user_keys = {tag: key for key, tag in Mp3LameEncoder.USER_TAGS.items()}
+        infos = {}
+        for frame_id, flags, data in self.frames:
+            if not data or flags[1] or data[0] not in ID3_ENCODINGS:
+                continue # Compressed, encrypted or invalid frame
+            strings = split_id3_text(data[1:], data[0])
+            if frame_id in keys:
+                infos[keys[frame_id]] = strings[0]
+            elif frame_id == "COMM" and len(data) > 4:
+                infos["comment"] = split_id3_text(data[4:], data[0])[-1]
+            elif frame_id == "TXXX" and len(strings) > 1 and strings[0].upper() in user_keys:
+                infos[user_keys[strings[0].upper()]] = strings[1]
+        return infos
+
+    def is_managed(self, frame_id, data):
+        """ Is the frame one of the infos, replaced by set_infos? """
+        if frame_id in ID3_FRAMES.values() or frame_id in ID3_YEAR_FRAMES.values():
+            return True
+        if frame_id == "COMM":
+            return True
+        if frame_id == "TXXX" and data and data[0] in ID3_ENCODINGS:
+            description = split_id3_text(data[1:], data[0])[0]
+            return description.upper() in Mp3LameEncoder.USER_TAGS.values()
+        return False
+
+    def set_infos(self, infos):
+        """ Replace the frames of the infos, keeping the other ones """
+        self.frames = [frame for frame in self.frames if not self.is_managed(frame[0], frame[2])]
+        frame_ids = dict(ID3_FRAMES, year=ID3_YEAR_FRAMES[self.version])
+        for key, value in infos.items():
+            if value is None:
+                continue
+            if key in frame_ids:
+                data = id3_text(self.version, str(value))
+                frame_id = frame_ids[key]
+            elif key == "comment":
+                encoding = id3_text(self.version, "", str(value))
+                data = encoding[:1] + b"eng" + encoding[1:] # Language, then description
+                frame_id = "COMM"
+            elif key in Mp3LameEncoder.USER_TAGS:
+                data = id3_text(self.version, Mp3LameEncoder.USER_TAGS[key], str(value))
+                frame_id = "TXXX"
+            else:
+                continue
+            self.frames.append((frame_id, b"\0\0", data))
+
+    def to_bytes(self, size=None):
+        """ Return the tag, padded to size bytes if given, else with PADDING bytes """
+        frames = b"".join(
+            frame_id.encode('latin-1') +
+            (to_synchsafe(len(data)) if self.version == 4 else struct.pack(">I", len(data))) +
+            flags + data
+            for frame_id, flags, data in self.frames)
+        body_size = len(frames) + PADDING if size is None else size - 10
+        if body_size < len(frames):
+            raise ValueError("Tag larger than {} bytes".format(size))
+        return (b"ID3" + bytes((self.version, 0, 0)) + to_synchsafe(body_size) +
+                frames.ljust(body_size, b"\0"))
+
+def update_id3v1(mp3_file, infos):
+    """ Update the ID3v1 tag at the end of mp3_file (opened 'r+b'), if it has one """
+    if mp3_file.seek(0, os.SEEK_END) < 128:
+        return # Seeking before the beginning would fail
+    mp3_file.seek(-128, os.SEEK_END)
+    tag = bytearray(mp3_file.read(128))
+    if tag[:3] != b"TAG":
+        return
+    position = 3
+    for key, length in ID3V1_FIELDS:
+        value = str(infos.get(key) or "").encode('latin-1', 'replace')[:length]
+        tag[position:position + length] = value.ljust(length, b"\0")
+        position += length
+    track = str(infos.get("track") or "").split("/")[0]
+    tag[125:127] = bytes((0, int(track) % 256)) if track.isdigit() else b"\0\0"
+    mp3_file.seek(-128, os.SEEK_END)
+    mp3_file.write(tag)
+
+class FlacMetadata:
+    """ Metadata blocks at the beginning of a FLAC file """
+    VORBIS_COMMENT = 4
+    PADDING = 1
+
+    def __init__(self, blocks, size):
+        """
+        blocks: List of (type, data) of the metadata blocks, padding excluded
+        size: Bytes used by the metadata in the file, 'fLaC' marker and padding included
+        """
+        self.blocks = blocks
+        self.size = size
+
+    @classmethod
+    def read(cls, flac_file):
+        """ Parse the metadata blocks of flac_file """
+        if flac_file.read(4) != b"fLaC":
+            raise ValueError("Not a FLAC file")
+        blocks, size, last = [], 4, False
+        while not last:
+            header = flac_file.read(4)
+            if len(header) < 4:
+                raise ValueError("Truncated FLAC metadata")
+            last, block_type = bool(header[0] & 0x80), header[0] & 0x7f
+            length = int.from_bytes(header[1:4], 'big')
+            data = flac_file.read(length)
+            if block_type != cls.PADDING:
+                blocks.append((block_type, data))
+            size += 4 + length
+        return cls(blocks, size)
+
+    def get_comments(self):
+        """ Return the vendor string and the comments of the Vorbis comment block """
+        for block_type, data in self.blocks:
+            if block_type == self.VORBIS_COMMENT:
+                vendor_length = struct.unpack_from("<I", data)[0]
+                vendor = data[4:4 + vendor_length]
+                position = 4 + vendor_length
+                count = struct.unpack_from("<I", data, position)[0]
+                position += 4
+                comments = []
+                for _ in range(count):
+                    length = struct.unpack_from("<I", data, position)[0]
+                    comments.append(data[position + 4:position + 4 + length].decode(
+                        'utf-8', 'replace'))
+                    position += 4 + length
+                return vendor, comments
+        return b"streamrecord", []
+
+    def get_infos(self):
+        """ Return the infos (as given to the encoders) of the Vorbis comments """
+        keys = {tag: key for key, tag in FlacEncoder.SUPPORTED_TAGS.items()}
+        infos = {}
+        for comment in self.get_comments()[1]:
+            tag, separator, value = comment.partition("=")
+            if separator and tag.upper() in keys:
+                infos[keys[tag.upper()]] = value
+        return infos
+
+    def set_infos(self, infos):
+        """ Replace the comments of the infos, keeping the other ones """
+        vendor, comments = self.get_comments()
+        managed = FlacEncoder.SUPPORTED_TAGS.values()
+        comments = [comment for comment in comments
+                    if comment.partition("=")[0].upper() not in managed]
+        comments += ["{}={}".format(FlacEncoder.SUPPORTED_TAGS[key], value)
+                     for key, value in infos.items()
+                     if key in FlacEncoder.SUPPORTED_TAGS and value is not None]
+        encoded = [comment.encode('utf-8') for comment in comments]
+        data = (struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(encoded)) +
+                b"".join(struct.pack("<I", len(comment)) + comment for comment in encoded))
+        blocks = [block for block in self.blocks if block[0] != self.VORBIS_COMMENT]
+        # STREAMINFO must stay the first block
+        self.blocks = blocks[:1] + [(self.VORBIS_COMMENT, data)] + blocks[1:]
+
+    def to_bytes(self, size=None):
+        """ Return the metadata, padded to size bytes if given, else with PADDING bytes """
+        blocks = self.blocks
+        used = 4 + sum(4 + len(data) for _, data in blocks)
+        if size is None:
+            blocks = blocks + [(self.PADDING, bytes(PADDING))]
+        elif size >= used + 4:
+            blocks = blocks + [(self.PADDING, bytes(size - used - 4))]
+        elif size != used:
+            raise ValueError("Metadata larger than {} bytes".format(size))
+        return b"fLaC" + b"".join(
+            bytes((block_type | (0x80 if index == len(blocks) - 1 else 0),)) +
+            len(data).to_bytes(3, 'big') + data
+            for index, (block_type, data) in enumerate(blocks))
+
+def read_header(path):
+    """ Return the parsed tag (ID3Tag or FlacMetadata) of an encoded song """
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as song_file:
+        if extension == ".mp3":
+            return ID3Tag.read(song_file)
+        if extension == ".flac":
+            return FlacMetadata.read(song_file)
+    raise ValueError("Unsupported file type: {}".format(path))
+
+def read_tags(path):
+    """ Return the infos (as given to the encoders) of an encoded song """
+    return read_header(path).get_infos()
+
+def write_tags(path, infos):
+    """ Replace the tags of an encoded song by infos, in place if the space
+    used by the current ones is large enough. Return True if it was. """
+    header = read_header(path)
+    header.set_infos(infos)
+    try:
+        data = header.to_bytes(header.size)
+    except ValueError:
+        data = None
+    if data is not None:
+        with open(path, 'r+b') as song_file:
+            song_file.write(data)
+            if path.lower().endswith(".mp3"):
+                update_id3v1(song_file, infos)
+        return True
+    # Move the audio data after a larger tag
+    temporary_path = "{}.retag".format(path)
+    try:
+        with open(path, 'rb') as song_file, open(temporary_path, 'wb') as output_file:
+            output_file.write(header.to_bytes())
+            song_file.seek(header.size)
+            shutil.copyfileobj(song_file, output_file, COPY_BUFFER)
+        if path.lower().endswith(".mp3"):
+            with open(temporary_path, 'r+b') as output_file:
+                update_id3v1(output_file, infos)
+        shutil.copymode(path, temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.unlink(temporary_path)
+    return False
+
+def retag_file(path, change, rename=True):
+    """ Apply change, a function returning the new infos from the current ones,
+    to the tags of path, and rename it after them (see Encoder.get_filename).
+    Return the old infos, the new ones and the new path. """
+    infos = read_tags(path)
+    new_infos = change(dict(infos))
+    if new_infos != infos:
+        write_tags(path, new_infos)
+    new_path = path
+    filename = Encoder.get_filename(new_infos) if rename else None
+    if filename:
+        extension = os.path.splitext(path)[1]
+        new_path = os.path.join(os.path.dirname(path), filename + extension)
+        if new_path != path:
+            # Unlike a rename, fails if another song already has the name
+            os.link(path, new_path)
+            os.unlink(path)
+    return infos, new_infos, new_path
+
+def find_songs(paths):
+    """ Return the retaggable songs among paths, directories being walked """
+    songs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                songs.extend(os.path.join(root, name) for name in sorted(files)
+                             if name.lower().endswith((".mp3", ".flac")))
+        else:
+            songs.append(path)
+    return songs
+
+class Retagger:
+    """ Retag and rename many songs over a pool of threads (the work is mostly
+    I/O), keeping the library index up to date """
+    def __init__(self, change, rename=True, library=None):
+        """
+        change: Function returning the new infos of a song from its current ones
+        rename: Rename the songs after their new infos
+        library: If given, Library whose entries of the retagged songs are moved
+        """
+        self.change = change
+        self.rename = rename
+        self.library = library
+
+    def run(self, paths, jobs=None):
+        """ Retag the songs of paths with at most jobs threads and return a report """
+        songs = find_songs(paths)
+        report = {'retagged': 0, 'unchanged': 0, 'renamed': 0, 'failed': []}
+        moves = []
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(retag_file, path, self.change, self.rename): path
+                for path in songs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    infos, new_infos, new_path = future.result()
+                except (OSError, ValueError, struct.error) as error:
+                    logging.error("Unable to retag '%s': %s", path, error)
+                    report['failed'].append(path)
+                    continue
+                if new_infos == infos:
+                    report['unchanged'] += 1
+                else:
+                    logging.debug("'%s' retagged: %s", path, json.dumps(new_infos))
+                    report['retagged'] += 1
+                    moves.append((infos, new_infos))
+                if new_path != path:
+                    logging.info("'%s' renamed to '%s'", path, new_path)
+                    report['renamed'] += 1
+        if self.library is not None and moves:
+            self.library.move(moves)
+        report['wall_seconds'] = time.time() - start
+        report['files_per_second'] = (len(songs) / report['wall_seconds']
+                                      if report['wall_seconds'] else None)
+        return report
+
+def parse_assignment(assignment):
+    """ Return the (key, value) of a TAG=VALUE command line argument """
+    key, separator, value = assignment.partition("=")
+    if not separator:
+        raise argparse.ArgumentTypeError("'{}' is not TAG=VALUE".format(assignment))
+    return key.lower(), value or None
+
+def main():
+    """ Parse options, retag and print the report """
+    arg_parser = argparse.ArgumentParser(
+        description="Fix the tags of recorded songs (MP3, FLAC) without encoding them again, "
+        "and rename them after their new tags")
+    arg_parser.add_argument("paths", nargs="+", help="Songs, or directories of songs")
+    arg_parser.add_argument(
+        "--set", type=parse_assignment, action="append", default=[], metavar="TAG=VALUE",
+        help="Set a tag (title, artist, album, year, comment, track, genre...), "
+        "an empty value removes it. Can be repeated")
+    arg_parser.add_argument(
+        "--swap", action="store_true",
+        help="Exchange the artist and the title, when the title regex parsed them backwards")
+    arg_parser.add_argument(
+        "--keep-names", action="store_true", help="Do not rename the songs")
+    arg_parser.add_argument(
+        "--library", help="Library index (see streamrecord --skip-existing) to keep up to date")
+    arg_parser.add_argument(
+        "--jobs", "-j", type=int,
+        help="Number of threads (default: the default of concurrent.futures)")
+    arg_parser.add_argument(
+        "--debug", "-d",
+        help="Show debug info",
+        action="store_const",
+        default=logging.INFO,
+        const=logging.DEBUG
+    )
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=options.debug,
+        format="## %(levelname)s ## %(threadName)s ## %(message)s"
+    )
+
+    def change(infos):
+        """ Apply the command line changes to infos """
+        if options.swap:
+            infos['artist'], infos['title'] = infos.get('title'), infos.get('artist')
+        infos.update(options.set)
+        return {key: value for key, value in infos.items() if value is not None}
+
+    retagger = Retagger(
+        change, not options.keep_names,
+        Library(options.library) if options.library else None)
+    report = retagger.run(options.paths, options.jobs)
+    print(json.dumps(report, indent=2))
+    return 1 if report['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
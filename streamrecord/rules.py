@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Rules recognizing the segments of the stream which are not music (ads,
+"Loading..." titles, jingles) so that they are dropped from the buffer
+instead of being written and encoded
+"""
+
+import re
+import json
+
+class DropRule:
+    """ Segments to drop: all the given conditions must hold.
+    Regexes are searched (not matched) and case insensitive. """
+    PATTERNS = ('window', 'title', 'artist') # Searched texts, see DropRule.matches
+
+    def __init__(self, name=None, window=None, title=None, artist=None,
+                 min_length=None, max_length=None):
+        """
+        name: Name of the rule, in logs (default: its conditions)
+        window: Regex searched in the whole window title
+        title, artist: Regexes searched in the infos extracted by the title regex
+        min_length, max_length: Bounds, in seconds, of the segment length
+        """
+        self.patterns = {}
+        for field, pattern in (('window', window), ('title', title), ('artist', artist)):
+            if pattern is not None:
+                self.patterns[field] = re.compile(pattern, re.IGNORECASE)
+        self.min_length = min_length
+        self.max_length = max_length
+        if not self.patterns and min_length is None and max_length is None:
+            raise ValueError("A drop rule needs at least one condition")
+        self.name = name or self.describe()
+
+    def describe(self):
+        """ Return a readable summary of the conditions """
+        conditions = ["{}~/{}/".format(field, self.patterns[field].pattern)
+                      for field in self.PATTERNS if field in self.patterns]
+        if self.min_length is not None:
+            conditions.append("length>={}s".format(self.min_length))
+        if self.max_length is not None:
+            conditions.append("length<={}s".format(self.max_length))
+        return " ".join(conditions)
+
+    def matches(self, task):
+        """ Does the task of AppInspector.run fulfill the conditions? """
+        length = task['length']
+        if self.min_length is not None and length < self.min_length:
+            return False
+        if self.max_length is not None and length > self.max_length:
+            return False
+        texts = dict(task.get('infos') or {}, window=task.get('window_title'))
+        return all(pattern.search(texts.get(field) or "")
+                   for field, pattern in self.patterns.items())
+
+    def __repr__(self):
+        return "DropRule({!r})".format(self.name)
+
+class DropRules:
+    """ Ordered set of drop rules, a segment is dropped if any of them matches """
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    @classmethod
+    def load(cls, path):
+        """ Read the rules from a JSON file holding a list of DropRule arguments:
+        [{"name": "ads", "title": "^(Ad|Advertisement)$", "max_length": 60}] """
+        with open(path) as rules_file:
+            return cls(DropRule(**rule) for rule in json.load(rules_file))
+
+    def match(self, task):
+        """ Return the first rule matching the task, or None """
+        for rule in self.rules:
+            if rule.matches(task):
+                return rule
+        return None
+
+    def __len__(self):
+        return len(self.rules)
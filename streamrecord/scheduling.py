@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+CPU and I/O scheduling policies, isolating the capture (the stream loader
+thread and parec) from the encoder processes: the capture runs on a reserved
+core at a higher priority, the encoders on the other cores at a lower one
+"""
+
+import os
+import ctypes
+import logging
+import platform
+import threading
+
+CAPTURE_NICE = -10 # Only permitted with CAP_SYS_NICE, or a high enough RLIMIT_NICE
+ENCODER_NICE = 10
+ENCODER_IONICE = ("best-effort", 7)
+IOPRIO_CLASSES = {"none": 0, "realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1 # A thread id is also a process id here
+IOPRIO_SYSCALLS = { # (ioprio_set, ioprio_get) numbers, not exposed by the os module
+    'x86_64': (251, 252),
+    'aarch64': (30, 31),
+    'riscv64': (30, 31),
+    'i686': (289, 290),
+    'i386': (289, 290),
+    'armv7l': (314, 315),
+    'ppc64le': (273, 274)
+}
+SCHEDULERS = {
+    getattr(os, name): name[len("SCHED_"):].lower()
+    for name in ("SCHED_OTHER", "SCHED_BATCH", "SCHED_IDLE", "SCHED_FIFO", "SCHED_RR")
+    if hasattr(os, name)
+}
+
+def ioprio_syscall(setting, *arguments):
+    """ Call ioprio_set (if setting) or ioprio_get, raise OSError on failure """
+    numbers = IOPRIO_SYSCALLS.get(platform.machine())
+    if numbers is None:
+        raise OSError("ioprio is not supported on {}".format(platform.machine()))
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = libc.syscall(numbers[0 if setting else 1], *arguments)
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+def set_ionice(pid, io_class, level=0):
+    """ Set the I/O scheduling class (see IOPRIO_CLASSES) and level of a process """
+    ioprio_syscall(
+        True, IOPRIO_WHO_PROCESS, pid, (IOPRIO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | level)
+
+def get_ionice(pid):
+    """ Return the I/O scheduling class and level of a process """
+    value = ioprio_syscall(False, IOPRIO_WHO_PROCESS, pid)
+    classes = {number: name for name, number in IOPRIO_CLASSES.items()}
+    return (classes.get(value >> IOPRIO_CLASS_SHIFT, "unknown"),
+            value & ((1 << IOPRIO_CLASS_SHIFT) - 1))
+
+def parse_ionice(text):
+    """ Return the (class, level) of a CLASS[:LEVEL] command line argument """
+    io_class, _, level = text.partition(":")
+    if io_class not in IOPRIO_CLASSES:
+        raise ValueError("Unknown I/O scheduling class '{}'".format(io_class))
+    return io_class, int(level or 0)
+
+class SchedulingPolicy:
+    """ Scheduling settings applied to a thread or a process. Settings which
+    are not permitted are skipped with a warning: they are best effort. """
+    def __init__(self, cpus=None, nice=None, realtime_priority=None, ionice=None):
+        """
+        cpus: Set of the CPUs to run on, all by default
+        nice: Nice value, from -20 (highest priority) to 19
+        realtime_priority: If set, run with the round-robin real time scheduler
+            at this priority (1 to 99), nice being then ignored by the kernel
+        ionice: (class, level) of the I/O scheduling, see IOPRIO_CLASSES
+        """
+        self.cpus = set(cpus) if cpus is not None else None
+        self.nice = nice
+        self.realtime_priority = realtime_priority
+        self.ionice = ionice
+        self.reported = False # Effective settings logged once at info level
+
+    def __repr__(self):
+        return "SchedulingPolicy(cpus={}, nice={}, realtime_priority={}, ionice={})".format(
+            sorted(self.cpus) if self.cpus is not None else None, self.nice,
+            self.realtime_priority, self.ionice)
+
+    def apply(self, pid=None, name="thread"):
+        """ Apply the policy to a process, or to the calling thread if pid is None,
+        and return its effective settings """
+        if pid is None:
+            pid = threading.get_native_id()
+        settings = []
+        if self.cpus is not None:
+            settings.append(("CPU affinity", os.sched_setaffinity, (pid, self.cpus)))
+        if self.realtime_priority is not None:
+            settings.append(("real time priority", os.sched_setscheduler,
+                             (pid, os.SCHED_RR, os.sched_param(self.realtime_priority))))
+        if self.nice is not None:
+            settings.append(("nice value", os.setpriority, (os.PRIO_PROCESS, pid, self.nice)))
+        if self.ionice is not None:
+            settings.append(("I/O priority", set_ionice, (pid,) + tuple(self.ionice)))
+        for description, setting, arguments in settings:
+            try:
+                setting(*arguments)
+            except OSError as error: # Not permitted, or not supported
+                logging.warning("Unable to set the %s of %s: %s", description, name, error)
+        effective = self.effective(pid)
+        logging.log(logging.DEBUG if self.reported else logging.INFO,
+                    "Scheduling of %s (%d): %s", name, pid, effective)
+        self.reported = True
+        return effective
+
+    @staticmethod
+    def effective(pid):
+        """ Return the current scheduling settings of a process """
+        effective = {}
+        try:
+            effective['cpus'] = sorted(os.sched_getaffinity(pid))
+            effective['scheduler'] = SCHEDULERS.get(os.sched_getscheduler(pid), "unknown")
+            effective['realtime_priority'] = os.sched_getparam(pid).sched_priority
+            effective['nice'] = os.getpriority(os.PRIO_PROCESS, pid)
+        except OSError: # The process already exited
+            return effective
+        try:
+            effective['ionice'] = "{}:{}".format(*get_ionice(pid))
+        except OSError:
+            pass
+        return effective
+
+def default_policies(capture_cpu=None, capture_nice=CAPTURE_NICE, capture_realtime=None,
+                     encoder_nice=ENCODER_NICE, encoder_ionice=ENCODER_IONICE):
+    """ Return the (capture, encoder) policies. The capture is pinned to
+    capture_cpu, by default the last available CPU, and the encoders run on
+    the other ones. Nothing is pinned with a single CPU, or a negative capture_cpu. """
+    cpus = sorted(os.sched_getaffinity(0))
+    if capture_cpu is None:
+        capture_cpu = cpus[-1] if len(cpus) > 1 else -1
+    capture_cpus = encoder_cpus = None
+    if capture_cpu >= 0:
+        if capture_cpu not in cpus:
+            raise ValueError("CPU {} is not available".format(capture_cpu))
+        capture_cpus = {capture_cpu}
+        encoder_cpus = set(cpus) - capture_cpus or None
+    return (SchedulingPolicy(capture_cpus, capture_nice, capture_realtime),
+            SchedulingPolicy(encoder_cpus, encoder_nice, ionice=encoder_ionice))
@@ -4,12 +4,43 @@ Implementation of the thread writing raw data on disk with right name
 """
 
 import io
-import math
+import os
 import time
 import queue
 import struct
 import logging
+import resource
 import threading
+import collections
+import concurrent.futures
+
+import numpy
+
+if __package__ == "":
+    from metrics import registry
+    from tracing import tracer
+    from clock import Clock
+    from noisefloor import window_energies
+    from boundary import spectral_flux_scores, CONTEXT_SECONDS
+    from loudness import LoudnessMeter
+    from fingerprint import Fingerprinter
+    from encoder import Encoder
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.metrics import registry
+    from streamrecord.tracing import tracer
+    from streamrecord.clock import Clock
+    from streamrecord.noisefloor import window_energies
+    from streamrecord.boundary import spectral_flux_scores, CONTEXT_SECONDS
+    from streamrecord.loudness import LoudnessMeter
+    from streamrecord.fingerprint import Fingerprinter
+    from streamrecord.encoder import Encoder
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
+CUT_CANDIDATES = 4 # Gaps confirmed by their spectral discontinuity, see find_breaking_byte
+TIE_DB = 3 # Gaps louder than the quietest one by more are not confirmed, see comparable_gaps
+SEARCH_SECONDS = 2 # Audio searched for the end of a song, twice the title change precision
+WRITE_WORKERS = 4 # Songs of a batch written concurrently, see SongWriter.write_batch
 
 def round_on_sample(byte_index, channels=2, channel_bytes_width=2):
     """
@@ -18,19 +49,25 @@ def round_on_sample(byte_index, channels=2, channel_bytes_width=2):
     of a channel in byte.
     """
     byte_index = int(byte_index)
-    while byte_index % (channels*channel_bytes_width) != 0:
-        byte_index -= 1
-    return byte_index
+    return byte_index - byte_index % (channels*channel_bytes_width)
 
-def find_longest_silence(data, previous_result=None, threshold=0x0010, minimal_length=0.1):
+def find_longest_silence(data, previous_result=None, threshold=0x0010, minimal_length=0.1,
+                         audio_format=DEFAULT_FORMAT):
     """ find the longest silence in a raw stream.
         previous_result: Result returns from the previous call. This allow the function to start
         from the last point instead of computing same silences many times.
-        threshold: minimal absolute value of a sample under which you consider it's a silence
+        threshold: minimal absolute value of a sample (scaled to 16 bits) under which
+        you consider it's a silence
         minimal_length: minimal length in seconds of a silence to detect
+        audio_format: AudioFormat of data
         returns A dictionnary with 'found' and 'longest_silence' keys
     """
-    minimal_length = (44100 * 2 * 2) * minimal_length
+    minimal_length = audio_format.bytes_per_second * minimal_length
+    frame_bytes = audio_format.frame_bytes
+    # Only the 16 most significant bits of each sample are read
+    frame_struct = struct.Struct(
+        "<" + ("x" * (audio_format.sample_width - 2) + "h") * audio_format.channels)
+    data = bytes(data) # Unpacked in place
     if not previous_result:
         current_silence = {
             'begin': None,
@@ -46,14 +83,13 @@ def find_longest_silence(data, previous_result=None, threshold=0x0010, minimal_l
         in_silence = previous_result['state']['in_silence']
         index = previous_result['state']['index']
 
-    while index <= len(data)-4:
-        # 1 sample is 4 bytes (2 2-bytes channels)
-        sample_values = struct.unpack("hh", bytes(data[index:index+4]))
+    while index <= len(data)-frame_bytes:
+        sample_values = frame_struct.unpack_from(data, index)
 
         # Sample value is relative to zero (positive or negative)
         # We consider a silence if sample value is under 0x0020 (over 0xFFFF)
-        # TODO: make test to discover the best threshold
-        if abs(sample_values[0]) < threshold and abs(sample_values[1]) < threshold:
+        # NoiseFloorEstimator.silence_amplitude gives a threshold adapted to the stream
+        if -threshold < min(sample_values) and max(sample_values) < threshold:
             # If we're not in a silence, update values accordingly
             if not in_silence:
                 in_silence = True
@@ -71,15 +107,15 @@ def find_longest_silence(data, previous_result=None, threshold=0x0010, minimal_l
                 if (current_silence['length'] > minimal_length and
                         current_silence['length'] > longest_silence['length']):
                     longest_silence = current_silence.copy()
-        index = index+4
+        index = index+frame_bytes
 
     # We ran over all available data
     # If we found a silence with a sufficient length
     # and that we're not still in a silence (witch run on more data not fetched)
     if longest_silence['length'] > 0 and not in_silence:
         # Assert that the cut index is on a whole sample
-        longest_silence['length'] = round_on_sample(longest_silence['length'])
-        longest_silence['cut'] = round_on_sample(
+        longest_silence['length'] = audio_format.round(longest_silence['length'])
+        longest_silence['cut'] = audio_format.round(
             longest_silence['begin'] +
             longest_silence['length']/2
         )
@@ -95,52 +131,165 @@ def find_longest_silence(data, previous_result=None, threshold=0x0010, minimal_l
     result['current_silence'] = current_silence
     return result
 
-def find_breaking_byte(raw_data, minimal_length=0.1):
-    raw_data = list(reversed(raw_data)) # Start from the end of the data
-    one_second_samples_num = 2 * 2 * 44100 # Number of bytes in one second
-    window_width = (minimal_length * one_second_samples_num)
-    number_of_windows = int(2*(math.ceil(len(raw_data) / window_width)))
-    signal_power = []
-
-    for i in range(0, number_of_windows):
-        window_start = int(math.floor(i * (window_width/2)))
-        window_end = int(math.ceil(window_start + window_width))
-        signal_power.append(sum([
-            math.pow(x, 2) for x in raw_data[window_start:window_end]
-        ]) / window_width)
-
-    # TODO: do some recursive research with smaller window width
-
-    minimal_signal_power = min(signal_power)
-    break_start = None
-    break_end = None
-    for i, power in enumerate(signal_power):
-        if power == minimal_signal_power:
-            break_start = i if break_start is None else break_start
-            break_end = i if (break_end is None or break_end == i-1) else break_end
+def find_breaking_byte(raw_data, minimal_length=0.1, threshold=None, audio_format=DEFAULT_FORMAT,
+                       candidates=1):
+    """ Return the byte index on which to cut raw_data, in the middle of a gap.
+    The energy of half overlapping windows of minimal_length seconds is computed from the end.
+    threshold: mean square sample value under which a window is silent (see
+        NoiseFloorEstimator.silence_energy). If given, the longest run of silent windows
+        is chosen (the latest one on ties). Otherwise, or if no window is silent, the
+        latest run of windows with the minimal energy is chosen.
+    audio_format: AudioFormat of raw_data
+    candidates: If more than 1, the gaps ranked first (the longest silent runs, or the
+        quietest windows) which are as quiet as the best one (see comparable_gaps) are
+        confirmed by their spectral discontinuity (see spectral_flux_scores), to cut
+        between songs rather than in a quiet passage.
+    """
+    raw_data = bytes(raw_data) # Converted once for all the analyses
+    window_frames = int(minimal_length * audio_format.rate)
+    hop_frames = max(window_frames // 2, 1)
+    energies = window_energies(raw_data, window_frames, hop_frames, audio_format)
+    if len(energies) == 0:
+        return audio_format.round(len(raw_data))
+
+    frames = len(raw_data) // audio_format.frame_bytes
+    gaps = gap_spans(energies, frames, window_frames, hop_frames, threshold, candidates)
+    best = 0
+    compared = comparable_gaps(gaps, frames, threshold, audio_format)
+    if len(compared) > 1:
+        with tracer.span("spectral_flux", candidates=len(compared)):
+            scores = spectral_flux_scores(
+                raw_data, [gaps[i][:2] for i in compared], audio_format)
+        best = compared[int(numpy.argmax(scores))]
+    break_start, break_end, _ = gaps[best]
+    return ((break_start + break_end) // 2) * audio_format.frame_bytes
+
+def gap_spans(energies, frames, window_frames, hop_frames, threshold=None, candidates=1):
+    """ Return up to candidates gaps of data of frames frames, from the energies of its
+    windows (see window_energies), as (first, last) frame numbers and mean window energy,
+    best ranked first. See find_breaking_byte for the ranking. """
+    longest = threshold is not None and bool((energies <= threshold).any())
+    silent = energies <= threshold if longest else energies == energies.min()
+    # Runs of consecutive silent windows, as (first, last) window numbers from the end
+    runs = []
+    for i, is_silent in enumerate(silent):
+        if not is_silent:
+            continue
+        if runs and runs[-1][1] == i-1:
+            runs[-1] = (runs[-1][0], i)
         else:
-            if break_start is not None and break_end is not None and break_end != i-1:
+            runs.append((i, i))
+    if longest:
+        # Sorting is stable: the latest run comes first on ties
+        runs.sort(key=lambda run: run[0] - run[1])
+    else:
+        # The quietest windows not overlapping the previous candidates
+        for i in numpy.argsort(energies, kind='stable').tolist():
+            if len(runs) >= candidates:
                 break
+            if all(i < first - 1 or i > last + 1 for first, last in runs):
+                runs.append((i, i))
+    return [
+        (frames - last * hop_frames - window_frames, frames - first * hop_frames,
+         float(energies[first:last + 1].mean()))
+        for first, last in runs[:candidates]
+    ]
 
-    break_start = break_start * (window_width/2)
-    break_end = break_end * (window_width/2) + window_width
-    break_start = len(raw_data)-(break_start+1)
-    break_end = len(raw_data)-(break_end+1)
-    breaking_byte = round_on_sample(int(round((break_start + break_end)/2)))
+def comparable_gaps(gaps, frames, threshold=None, audio_format=DEFAULT_FORMAT):
+    """ Return the indexes of the gaps (see gap_spans) of data of frames frames worth
+    comparing by their spectral discontinuity: the ones within TIE_DB of the quietest one
+    (or silent under threshold), whose contexts are not cut by the data boundaries.
+    A louder span inside a song could otherwise win over a true gap, and a gap
+    near the boundaries gets inflated scores. Fewer than 2 gaps: nothing to compare. """
+    if len(gaps) < 2:
+        return []
+    quietest = min(level for _, _, level in gaps) * 10 ** (TIE_DB / 10)
+    context = int(CONTEXT_SECONDS * audio_format.rate)
+    compared = [
+        i for i, (start, end, level) in enumerate(gaps)
+        if (level <= quietest or (threshold is not None and level <= threshold)) and
+        context <= start and end <= frames - context
+    ]
+    return compared if len(compared) > 1 else []
 
-    return breaking_byte
+def find_breaking_bytes(raw_data, ends, search_seconds=2, minimal_length=0.1, threshold=None,
+                        audio_format=DEFAULT_FORMAT, candidates=1):
+    """ Batched find_breaking_byte: return the byte index on which to cut raw_data in each
+    of its parts search_seconds long ending at the byte indexes ends (which must not overlap).
+    The window energies of all the parts are computed at once, and the compared gaps of
+    all the parts scored by one spectral_flux_scores call, their context not being cut
+    at the part boundaries. """
+    raw_data = bytes(raw_data)
+    window_frames = int(minimal_length * audio_format.rate)
+    hop_frames = max(window_frames // 2, 1)
+    search_frames = int(search_seconds * audio_format.rate)
+    end_frames = numpy.asarray(ends, dtype=numpy.int64) // audio_format.frame_bytes
+    if len(end_frames) == 0:
+        return []
+    if search_frames < window_frames:
+        return [int(end) * audio_format.frame_bytes for end in end_frames]
+    # Energies of the frames of each part, then of its windows, as in window_energies
+    frames = end_frames[:, None] - search_frames + numpy.arange(search_frames)
+    frame_energy = numpy.square(
+        audio_format.samples(raw_data)[frames], dtype=numpy.float64).mean(axis=2)
+    cumulated = numpy.concatenate(
+        (numpy.zeros((len(end_frames), 1)), numpy.cumsum(frame_energy, axis=1)), axis=1)
+    window_ends = numpy.arange(search_frames, window_frames - 1, -hop_frames)
+    energies = ((cumulated[:, window_ends] - cumulated[:, window_ends - window_frames]) /
+                window_frames)
+
+    data_frames = len(raw_data) // audio_format.frame_bytes
+    gaps, spans, compared = [], [], []
+    for part, part_energies in enumerate(energies):
+        start = int(end_frames[part]) - search_frames
+        part_gaps = [
+            (start + first, start + last, level) for first, last, level in gap_spans(
+                part_energies, search_frames, window_frames, hop_frames, threshold, candidates)]
+        gaps.append(part_gaps)
+        indexes = comparable_gaps(part_gaps, data_frames, threshold, audio_format)
+        compared.append(indexes)
+        spans.extend(part_gaps[i][:2] for i in indexes)
+    scores = []
+    if spans:
+        with tracer.span("spectral_flux", candidates=len(spans)):
+            scores = spectral_flux_scores(raw_data, spans, audio_format).tolist()
+    cuts = []
+    for part_gaps, indexes in zip(gaps, compared):
+        best = 0
+        if indexes:
+            part_scores, scores = scores[:len(indexes)], scores[len(indexes):]
+            best = indexes[int(numpy.argmax(part_scores))]
+        break_start, break_end, _ = part_gaps[best]
+        cuts.append(((break_start + break_end) // 2) * audio_format.frame_bytes)
+    return cuts
 
 class SongWriter(threading.Thread):
     """
     This class read raw data, detect the gap and write it to a file in raw.
     Then it start an encoder to convert it to MP3
     """
-    def __init__(self, synchronization, data, encoder):
+    def __init__(self, synchronization, data, encoder, clock=None, library=None,
+                 fingerprints=None, stop_on_loop=False, cut_candidates=CUT_CANDIDATES,
+                 batch=True):
         super(SongWriter, self).__init__(name="Song Writer")
         self.synchronization = synchronization
         self.raw_data = data['raw_data']
         self.raw_data_lock = data['lock']
+        self.noise_floor = data.get('noise_floor') # Estimator giving the silence threshold
+        self.audio_format = data.get('audio_format', DEFAULT_FORMAT)
         self.encoder = encoder
+        self.clock = Clock() if clock is None else clock
+        self.library = library # If given, Library of the songs to skip
+        self.fingerprints = fingerprints # If given, FingerprintIndex of the songs to skip
+        self.stop_on_loop = stop_on_loop # Stop when a song of the session is heard again
+        self.session_songs = set() # Names of the songs fingerprinted during this session
+        self.cut_candidates = cut_candidates # Gaps compared to find the end of a song
+        self.batch = batch # Write the backlog of buffered songs at once, see write_batch
+        self.backlog = collections.deque() # Tasks taken from the queue, not written yet
+        self.songs_written = 0 # Number of songs handed to the encoder
+        self.songs_skipped = 0 # Number of songs already in the library
+        self.songs_dropped = 0 # Number of segments matching a drop rule
+        self.songs_failed = 0 # Number of songs whose encoding failed
         logging.debug(self)
 
     def __str__(self):
@@ -152,75 +301,302 @@ class SongWriter(threading.Thread):
         import json
         return "{}({}){}".format(self.name, self.ident, json.dumps(me))
 
-    def write_data(self, file_name, length, is_hard_length=False):
+    def write_data(self, file_name, length, is_hard_length=False, analyzers=(),
+                   discard=False, stream=None):
         """ Write data for ONE song on disk as raw.
         file_name: basename (without extension) of the file which is going to be created
         length: approximated length, in seconds, of the song recorded
         is_hard_length: Is it a 'hard' length, or does the systel have to find the best breaking sample?
+        analyzers: Objects whose update method is fed with the written data
+        discard: Drop the data of the song from the buffer without writing it
+        stream: If given, binary pipe (of a streaming encoder) to write in, instead of a file
         """
-        one_second_samples_num = 2 * 2 * 44100 # Number of bytes in one second
+        one_second_samples_num = self.audio_format.bytes_per_second # Number of bytes in one second
         len_available_raw_data = 0 # Number of bytes available in raw_data
         lasting_raw_data = [] # Copy of a part of raw_data which must contain the end of the song
         silence = None # Inter-track gap information
         breaking_byte = None # Index of byte on which to cut the raw stream
         wrote_length = 0.0 # Actual length wrote on disk (in seconds with decimal part)
+        wrote_bytes = 0
 
-        with io.open("{}.raw".format(file_name), 'wb') as output_file:
-            logging.info("Writing '%s.raw' on disk", file_name)
+        if stream is not None:
+            # The pipe is closed by the encoder
+            output = io.open(stream.fileno(), 'wb', closefd=False)
+            logging.info("Streaming '%s' to the encoder", file_name)
+        else:
+            output_path = os.devnull if discard else "{}.raw".format(file_name)
+            output = io.open(output_path, 'wb')
+            logging.info("Writing '%s' on disk", output_path)
+        with output as output_file:
             # Song length precision is 1 second.
             # Copy the song except the last 2 seconds of data (2 times the precision)
-            main_part_length = round_on_sample(int((length-2)*one_second_samples_num))
+            main_part_length = max(
+                self.audio_format.round((length-2)*one_second_samples_num), 0)
             with self.raw_data_lock:
                 len_available_raw_data = len(self.raw_data)
             logging.debug("Available samples : %d", len_available_raw_data)
             logging.debug("Main part length : %d", main_part_length)
             # Wait until sufficiently data are loaded
-            while len_available_raw_data < main_part_length:
-                logging.debug("Sleep 1 second...")
-                time.sleep(1)
-                with self.raw_data_lock:
-                    len_available_raw_data = len(self.raw_data)
-                logging.debug("Available samples : %d", len_available_raw_data)
-                logging.debug("Main part length : %d", main_part_length)
+            with tracer.span("wait_main_part", song=file_name):
+                while len_available_raw_data < main_part_length:
+                    logging.debug("Sleep 1 second...")
+                    self.clock.sleep(1)
+                    with self.raw_data_lock:
+                        len_available_raw_data = len(self.raw_data)
+                    logging.debug("Available samples : %d", len_available_raw_data)
+                    logging.debug("Main part length : %d", main_part_length)
 
             # Actually write main part on disk
-            with self.raw_data_lock:
-                output_file.write(bytes(self.raw_data[0:main_part_length]))
-                del self.raw_data[0:main_part_length]
-                len_available_raw_data = len(self.raw_data)
+            with tracer.span("write_main_part", song=file_name):
+                with self.raw_data_lock:
+                    # Discarded data is not even copied
+                    main_part = b"" if discard else bytes(self.raw_data[0:main_part_length])
+                    del self.raw_data[0:main_part_length]
+                    len_available_raw_data = len(self.raw_data)
+                output_file.write(main_part)
+                wrote_bytes += main_part_length
+            for analyzer in analyzers:
+                with tracer.span("analyze", song=file_name, analyzer=type(analyzer).__name__):
+                    analyzer.update(main_part)
 
             logging.debug(
                 "Copied %s seconds on %s",
-                output_file.tell()/one_second_samples_num,
+                wrote_bytes/one_second_samples_num,
                 length
             )
 
             # Wait for the remaining data of the song
-            while (
-                len_available_raw_data < 2*one_second_samples_num and
-                not self.synchronization['end'].is_set()
-                ):
-                time.sleep(1)
-                with self.raw_data_lock:
-                    len_available_raw_data = len(self.raw_data)
+            with tracer.span("wait_song_end", song=file_name):
+                while (
+                    len_available_raw_data < 2*one_second_samples_num and
+                    not self.synchronization['end'].is_set()
+                    ):
+                    self.clock.sleep(1)
+                    with self.raw_data_lock:
+                        len_available_raw_data = len(self.raw_data)
 
             with self.raw_data_lock:
                 lasting_raw_data = list(self.raw_data[0:2*one_second_samples_num])
             if self.synchronization['end'].is_set() or is_hard_length:
                 breaking_byte = len(lasting_raw_data)
             else:
-                breaking_byte = find_breaking_byte(lasting_raw_data)
+                with tracer.span("break_search", song=file_name):
+                    threshold = None
+                    if self.noise_floor is not None:
+                        threshold = self.noise_floor.silence_energy()
+                    breaking_byte = find_breaking_byte(
+                        lasting_raw_data, threshold=threshold, audio_format=self.audio_format,
+                        candidates=self.cut_candidates)
 
             # Write the end of the song
-            output_file.write(bytes(lasting_raw_data[0:breaking_byte]))
+            song_end = bytes(lasting_raw_data[0:breaking_byte])
+            with tracer.span("write_song_end", song=file_name):
+                output_file.write(song_end)
+                wrote_bytes += len(song_end)
+            for analyzer in analyzers:
+                analyzer.update(song_end)
             # Delete it from the raw_data
             with self.raw_data_lock:
                 del self.raw_data[0:breaking_byte]
 
-            wrote_length = output_file.tell()/one_second_samples_num
+            wrote_length = wrote_bytes/one_second_samples_num
 
         return wrote_length
 
+    def is_duplicate(self, task, fingerprinter):
+        """ Is the written song of task already in the fingerprints index?
+        The recording is then stopped if the song was recorded during this
+        session and stop_on_loop is set. """
+        with tracer.span("fingerprint_match", song=task['id']):
+            duplicate = self.fingerprints.match(fingerprinter.searched_hashes())
+        if duplicate is None:
+            return False
+        logging.info("%s sounds like %s", task['id'], duplicate)
+        registry.inc("streamrecord_duplicates_total")
+        if self.stop_on_loop and duplicate in self.session_songs:
+            logging.info("Playlist looped, stopping")
+            self.synchronization['end'].set()
+        return True
+
+    def encode_song(self, basename, infos, stream=None):
+        """ Encode a written song, or end the encoding of the streamed one,
+        measuring the encoder resources. Return whether the encoding succeeded. """
+        logging.info("Calling encode to convert %s", basename)
+        encoder_name = type(self.encoder).__name__
+        encode_start = time.time()
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with tracer.span("encode", song=basename, encoder=encoder_name):
+            if stream is None:
+                succeeded = self.encoder.encode(basename, infos, audio_format=self.audio_format)
+            else:
+                succeeded = self.encoder.close_stream(stream)
+        registry.observe(
+            "streamrecord_encode_wall_seconds", time.time() - encode_start,
+            encoder=encoder_name)
+        # Only waited-for children are accounted: encoders running
+        # in background are missed, other short-lived children are counted
+        new_children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        registry.observe(
+            "streamrecord_encode_cpu_seconds",
+            (new_children_usage.ru_utime - children_usage.ru_utime) +
+            (new_children_usage.ru_stime - children_usage.ru_stime),
+            encoder=encoder_name)
+        return succeeded
+
+    def start_task(self, task):
+        """ Return the job of a task about to be written: is it skipped, its
+        analyzers, and the streaming encoder process it is written to, if any """
+        tracer.instant("task_dequeued", song=task['id'])
+        drop = task.get('drop') is not None
+        skip = drop or (self.library is not None and
+                        self.library.contains(task['infos'], task['length']))
+        loudness_meter = LoudnessMeter(self.audio_format)
+        analyzers = [loudness_meter]
+        fingerprinter = None
+        if self.fingerprints is not None:
+            fingerprinter = Fingerprinter(self.audio_format)
+            analyzers.append(fingerprinter)
+        stream = None
+        if not skip and self.encoder.STREAMING:
+            # Encoded while written: the loudness is not known in time to be tagged
+            stream = self.encoder.open_stream(
+                task['id'], task['infos'], audio_format=self.audio_format)
+        return {
+            'drop': drop,
+            'skip': skip,
+            'loudness_meter': loudness_meter,
+            'fingerprinter': fingerprinter,
+            'analyzers': () if skip else analyzers,
+            'stream': stream
+        }
+
+    def end_task(self, task, job, wrote_length):
+        """ Encode the written song of task, and account it. The task is done
+        even if this fails, so that the inspector waiting for the queue ends. """
+        try:
+            self.account_task(task, job, wrote_length)
+        finally:
+            self.synchronization['tasks'].task_done()
+
+    def account_task(self, task, job, wrote_length):
+        """ Encode the written song of task, and count it """
+        skip, stream, fingerprinter = job['skip'], job['stream'], job['fingerprinter']
+        if isinstance(task['id'], float):
+            # Task id is the time of the title change
+            registry.observe(
+                "streamrecord_cut_latency_seconds", self.clock.time() - task['id'])
+        if stream is not None and not self.encode_song(task['id'], task['infos'], stream):
+            registry.inc("streamrecord_songs_failed_total")
+            self.songs_failed += 1
+            return
+        if not skip and fingerprinter is not None and self.is_duplicate(task, fingerprinter):
+            skip = True
+            os.unlink(
+                "{}.raw".format(task['id']) if stream is None else
+                self.encoder.get_output(task['id'], task['infos']))
+        if job['drop']:
+            logging.info("%s dropped by the rule %s", task['id'], task['drop'])
+            registry.inc("streamrecord_songs_dropped_total")
+            self.songs_dropped += 1
+        elif skip:
+            logging.info("%s already recorded, skipped", task['id'])
+            registry.inc("streamrecord_songs_skipped_total")
+            self.songs_skipped += 1
+        else:
+            if stream is None and not self.encode_song(
+                    task['id'],
+                    dict(task['infos'] or {}, **job['loudness_meter'].replaygain_tags())):
+                registry.inc("streamrecord_songs_failed_total")
+                self.songs_failed += 1
+                return
+            if self.library is not None:
+                self.library.add(task['infos'], wrote_length)
+            if fingerprinter is not None:
+                name = Encoder.get_filename(task['infos']) or str(task['id'])
+                self.fingerprints.add(name, fingerprinter.indexed_hashes())
+                self.session_songs.add(name)
+            self.songs_written += 1
+
+    def ready_tasks(self, task, remaining_length):
+        """ Return task, followed by the next tasks if their audio is already fully
+        buffered, to be written in one batch. Every queued task is moved to the
+        backlog, where the ones not returned stay in order. """
+        while True:
+            try:
+                self.backlog.append(self.synchronization['tasks'].get_nowait())
+            except queue.Empty:
+                break
+        with self.raw_data_lock:
+            len_available_raw_data = len(self.raw_data)
+        tasks = [task]
+        end = remaining_length + task['length']
+        # The search parts of the songs must not overlap, see find_breaking_bytes
+        if end < SEARCH_SECONDS or end * self.audio_format.bytes_per_second > len_available_raw_data:
+            return tasks
+        while self.backlog and self.backlog[0]['length'] >= SEARCH_SECONDS:
+            end += self.backlog[0]['length']
+            if end * self.audio_format.bytes_per_second > len_available_raw_data:
+                break
+            tasks.append(self.backlog.popleft())
+        return tasks
+
+    def write_batch(self, tasks, jobs, remaining_length):
+        """ Write the songs of tasks, whose audio is fully buffered, in one pass
+        over the buffer: their ends are searched at once (see find_breaking_bytes),
+        the buffer is trimmed once, and the songs are written concurrently.
+        Return the length written for each task, in seconds. """
+        bytes_per_second = self.audio_format.bytes_per_second
+        ends, hard, end = [], [], remaining_length
+        for task in tasks:
+            end += task['length']
+            ends.append(self.audio_format.round(end * bytes_per_second))
+            hard.append(task.get('hard_length', False) or self.synchronization['end'].is_set())
+        # The writer is the only one deleting from the buffer, and the loader only
+        # appends to it: the songs are copied one by one without the raw data lock,
+        # which would stall the capture while the whole backlog is copied. A
+        # CompressedBacklog only holds its own lock to collect the chunks of a
+        # song, decompressed after releasing it
+        data = b"".join(bytes(self.raw_data[start:end])
+                        for start, end in zip([0] + ends[:-1], ends))
+
+        cuts = list(ends)
+        searched = [i for i in range(len(tasks)) if not hard[i]]
+        if searched:
+            with tracer.span("break_search", songs=len(searched)):
+                threshold = None
+                if self.noise_floor is not None:
+                    threshold = self.noise_floor.silence_energy()
+                found = find_breaking_bytes(
+                    data, [ends[i] for i in searched], SEARCH_SECONDS,
+                    threshold=threshold, audio_format=self.audio_format,
+                    candidates=self.cut_candidates)
+            for i, cut in zip(searched, found):
+                cuts[i] = cut
+        with self.raw_data_lock:
+            del self.raw_data[0:cuts[-1]]
+
+        def write_song(task, job, song):
+            if job['stream'] is not None:
+                output = io.open(job['stream'].stdin.fileno(), 'wb', closefd=False)
+            elif job['skip']:
+                output = None # Dropped from the buffer, not even written
+            else:
+                output = io.open("{}.raw".format(task['id']), 'wb')
+            if output is not None:
+                with output as output_file:
+                    output_file.write(song)
+            for analyzer in job['analyzers']:
+                analyzer.update(song)
+
+        data = memoryview(data)
+        starts = [0] + cuts[:-1]
+        with tracer.span("write_batch", songs=len(tasks)):
+            with concurrent.futures.ThreadPoolExecutor(WRITE_WORKERS) as executor:
+                for future in [executor.submit(write_song, task, job, data[start:cut])
+                               for task, job, start, cut in zip(tasks, jobs, starts, cuts)]:
+                    future.result()
+        return [(cut - start) / bytes_per_second for start, cut in zip(starts, cuts)]
+
     def run(self):
         task = None
         remaining_length = 0
@@ -229,8 +605,12 @@ class SongWriter(threading.Thread):
 
         while not (
                 self.synchronization['end'].is_set() and
-                self.synchronization['tasks'].empty()):
+                self.synchronization['tasks'].empty() and
+                not self.backlog):
             while task is None:
+                if self.backlog:
+                    task = self.backlog.popleft()
+                    break
                 try:
                     task = self.synchronization['tasks'].get(timeout=10)
                 except queue.Empty:
@@ -238,20 +618,40 @@ class SongWriter(threading.Thread):
                         break
                     else:
                         pass
-            if task is not None:
-                logging.debug("Task measured length: %s s", task['length'])
-                logging.debug("Task computed length: %s s", task['length'] + remaining_length)
-                wrote_length = self.write_data(task['id'], task['length'] + remaining_length, task['hard_length'])
-                remaining_length = task['length'] - wrote_length
-                logging.debug("Task wrote length: %s s", wrote_length)
-                logging.debug("Task remaining length: %s s", remaining_length)
-
-                logging.info("Calling encode to convert %s", task['id'])
-                self.encoder.encode(
-                    task['id'],
-                    task['infos'])
-                self.synchronization['tasks'].task_done()
+            if task is None:
+                continue
+            tasks = self.ready_tasks(task, remaining_length) if self.batch else [task]
+            if len(tasks) > 1:
+                logging.info("Writing %d buffered songs at once", len(tasks))
+                registry.observe("streamrecord_batch_songs", len(tasks))
+                jobs = [self.start_task(task) for task in tasks]
+                write_start = time.time()
+                wrote_lengths = self.write_batch(tasks, jobs, remaining_length)
+                write_end = time.time()
+                registry.observe("streamrecord_write_seconds", write_end - write_start)
+                for task, job, wrote_length in zip(tasks, jobs, wrote_lengths):
+                    tracer.complete("write", write_start, write_end, song=task['id'])
+                    remaining_length += task['length'] - wrote_length
+                    self.end_task(task, job, wrote_length)
                 task = None
+                continue
+
+            logging.debug("Task measured length: %s s", task['length'])
+            logging.debug("Task computed length: %s s", task['length'] + remaining_length)
+            job = self.start_task(task)
+            write_start = time.time()
+            stream = job['stream']
+            wrote_length = self.write_data(
+                task['id'], task['length'] + remaining_length, task.get('hard_length', False),
+                job['analyzers'], job['skip'], stream and stream.stdin)
+            write_end = time.time()
+            registry.observe("streamrecord_write_seconds", write_end - write_start)
+            tracer.complete("write", write_start, write_end, song=task['id'])
+            remaining_length = task['length'] + remaining_length - wrote_length
+            logging.debug("Task wrote length: %s s", wrote_length)
+            logging.debug("Task remaining length: %s s", remaining_length)
+            self.end_task(task, job, wrote_length)
+            task = None
 
         logging.info("End Event Set")
         logging.info("Exit")
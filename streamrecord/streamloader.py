@@ -6,14 +6,24 @@ Implementation of the thread loading the pipe content in script
 import threading
 import logging
 
+if __package__ == "":
+    from metrics import registry
+    from audioformat import DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.metrics import registry
+    from streamrecord.audioformat import DEFAULT_FORMAT
+
 class StreamLoader(threading.Thread):
     """ Thread that load the data from the pipe. It one of the most important one to avoid data
     leaks. """
-    def __init__(self, thread_synchronization, bin_stream_input, raw_data):
+    def __init__(self, thread_synchronization, bin_stream_input, raw_data, scheduling=None):
         """
         thread_synchronization: Dictionnary with start and end object for synchronization
         bin_stream_input: Reading end of the pipe where parec writes
-        raw_data: Dictionnary with list and its lock
+        raw_data: Dictionnary with list and its lock, and optionally the
+            'noise_floor' estimator to feed with the captured data and the
+            'audio_format' of the data
+        scheduling: If given, SchedulingPolicy of the thread
         """
         super(StreamLoader, self).__init__(name="Stream Loader")
         self.thread_start = thread_synchronization['start']
@@ -21,6 +31,11 @@ class StreamLoader(threading.Thread):
         self.bin_stream_input = bin_stream_input
         self.raw_data = raw_data['raw_data']
         self.raw_data_lock = raw_data['lock']
+        self.noise_floor = raw_data.get('noise_floor')
+        self.audio_format = raw_data.get('audio_format', DEFAULT_FORMAT)
+        self.scheduling = scheduling
+        self.capturing = False # Set once the start barrier is passed
+        self.bytes_read = 0 # Progress watched by the Supervisor
         logging.debug(self)
 
     def __str__(self):
@@ -34,13 +49,23 @@ class StreamLoader(threading.Thread):
         return "{}({}){}".format(self.name, self.ident, json.dumps(me))
 
     def run(self):
-        bytes_to_read = int((44100/10) * 2 * 2)
+        bytes_to_read = self.audio_format.round(self.audio_format.bytes_per_second / 10)
+        if self.scheduling is not None:
+            self.scheduling.apply(name=self.name)
         logging.info("Start barrier reached")
         self.thread_start.wait()
+        self.capturing = True
         while not self.thread_end.is_set():
             data = self.bin_stream_input.read(bytes_to_read)
+            if not data: # The capture stalled or is being restarted
+                self.thread_end.wait(0.1)
+                continue
+            self.bytes_read += len(data)
+            registry.inc("streamrecord_capture_bytes_total", len(data))
             with self.raw_data_lock:
                 self.raw_data.extend(data)
+            if self.noise_floor is not None:
+                self.noise_floor.update(data)
         self.thread_end.wait()
         logging.info("End event set")
         logging.info("Exit")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Implementation of the thread watching the liveness of the other ones, and
+restarting the stalled components without touching the shared buffer and
+task queue
+"""
+
+import time
+import logging
+import threading
+import collections
+
+if __package__ == "":
+    from metrics import registry
+elif __package__ == "streamrecord":
+    from streamrecord.metrics import registry
+
+CHECK_INTERVAL = 1 # Seconds between two checks
+CAPTURE_TIMEOUT = 5 # Seconds without captured audio before restarting the capture
+INSPECTOR_TIMEOUT = 10 # Seconds without a detection before interrupting the inspector
+
+class Supervisor(threading.Thread):
+    """ Thread restarting the stalled components of a recording: the capture
+    (parec or the record stream), the application inspector (its connection to
+    the X server) and the encoder processes past their deadline. A dead component
+    thread stops the recording, instead of leaving the others waiting for it. """
+    def __init__(self, synchronization, data, components, encoder=None,
+                 interval=CHECK_INTERVAL, capture_timeout=CAPTURE_TIMEOUT,
+                 inspector_timeout=INSPECTOR_TIMEOUT):
+        """
+        synchronization: Dictionnary with the start barrier and end event of the components
+        data: Dictionnary with the raw data list and its lock, saved to a file
+            if the song writer dies
+        components: Dictionnary of the 'capture', 'inspector', 'loader' and 'writer' threads
+        encoder: If given, Encoder whose processes are killed past their deadline
+        """
+        super(Supervisor, self).__init__(name="Supervisor", daemon=True)
+        self.thread_start = synchronization['start']
+        self.thread_end = synchronization['end']
+        self.raw_data = data['raw_data']
+        self.raw_data_lock = data['lock']
+        self.components = components
+        self.encoder = encoder
+        self.interval = interval
+        self.capture_timeout = capture_timeout
+        self.inspector_timeout = inspector_timeout
+        self.restarts = collections.Counter() # Restarts by component
+        self.bytes_read = None # Capture progress at the last check...
+        self.capture_progress = None # ... and when it last changed
+        self.inspector_interrupted = None # Time of the last interruption of the inspector
+
+    def run(self):
+        while not self.thread_end.wait(self.interval):
+            self.check()
+        logging.info("Exit")
+
+    def check(self, now=None):
+        """ Check every component once """
+        if now is None:
+            now = time.monotonic()
+        self.check_threads()
+        self.check_capture(now)
+        self.check_inspector(now)
+        self.check_encodes(now)
+
+    def restarted(self, component):
+        """ Account a restart of component """
+        self.restarts[component] += 1
+        registry.inc("streamrecord_restarts_total", component=component)
+
+    def check_threads(self):
+        """ Stop the recording if a component thread died """
+        for name, thread in self.components.items():
+            if (not isinstance(thread, threading.Thread) or thread.ident is None or
+                    thread.is_alive() or self.thread_end.is_set()):
+                continue
+            logging.error("%s died, stopping the recording", thread.name)
+            if name == 'writer':
+                self.rescue_buffer()
+            # The threads still waiting for the dead one to start give up
+            self.thread_start.abort()
+            self.thread_end.set()
+
+    def rescue_buffer(self):
+        """ Save the buffered audio, which nobody will write anymore """
+        with self.raw_data_lock:
+            data = bytes(self.raw_data)
+            del self.raw_data[:]
+        if not data:
+            return
+        path = "streamrecord-rescue-{}.raw".format(int(time.time()))
+        with open(path, 'wb') as rescue_file:
+            rescue_file.write(data)
+        logging.error("%d bytes of buffered audio saved to '%s'", len(data), path)
+
+    def check_capture(self, now):
+        """ Restart the capture if no audio was read for capture_timeout seconds """
+        loader = self.components.get('loader')
+        if loader is None or not getattr(loader, 'capturing', False):
+            return
+        if loader.bytes_read != self.bytes_read:
+            self.bytes_read = loader.bytes_read
+            self.capture_progress = now
+            return
+        if now - self.capture_progress < self.capture_timeout:
+            return
+        self.capture_progress = now # Wait again before the next restart
+        restart = getattr(self.components.get('capture'), 'restart_capture', None)
+        if restart is None:
+            logging.debug("No audio captured for %ds", self.capture_timeout)
+            return
+        logging.warning("No audio captured for %ds, restarting the capture",
+                        self.capture_timeout)
+        restart()
+        self.restarted('capture')
+
+    def check_inspector(self, now):
+        """ Interrupt the inspector if it did not beat for inspector_timeout seconds,
+        for it to reconnect """
+        inspector = self.components.get('inspector')
+        interrupt = getattr(inspector, 'interrupt', None)
+        heartbeat = getattr(inspector, 'heartbeat', None)
+        if interrupt is None or heartbeat is None:
+            return
+        last = max(heartbeat, self.inspector_interrupted or heartbeat)
+        if now - last < self.inspector_timeout:
+            return
+        logging.warning("Inspector stalled for %ds, reconnecting it",
+                        now - heartbeat)
+        self.inspector_interrupted = now
+        interrupt()
+        self.restarted('inspector')
+
+    def check_encodes(self, now):
+        """ Kill the encoder processes past their deadline """
+        if self.encoder is None:
+            return
+        for process in self.encoder.kill_expired(now):
+            logging.error("Encoder %d timed out, killed: %s", process.pid, process.args)
+            self.restarted('encoder')
@@ -0,0 +1,36 @@
+#! /usr/bin/env python3
+""" Test module for the audio format """
+
+import array
+
+import pytest
+
+from audioformat import AudioFormat, DEFAULT_FORMAT
+
+def test_default_format():
+    assert DEFAULT_FORMAT == AudioFormat(44100, 2, 2)
+    assert DEFAULT_FORMAT.bytes_per_second == 2 * 2 * 44100
+    assert str(DEFAULT_FORMAT) == "s16le 2ch 44100Hz"
+
+def test_unsupported_sample_width():
+    with pytest.raises(ValueError):
+        AudioFormat(sample_width=1)
+
+def test_from_sample_spec():
+    assert AudioFormat.from_sample_spec("float32le 1ch 48000Hz") == AudioFormat(48000, 1)
+    assert AudioFormat.from_sample_spec("s16le 2ch 44100Hz", 3) == AudioFormat(44100, 2, 3)
+    assert AudioFormat.from_sample_spec(None) is None
+
+def test_round():
+    assert AudioFormat(channels=1).round(13) == 12
+    assert AudioFormat(sample_width=3).round(13) == 12
+    assert AudioFormat(sample_width=3).round(11) == 6
+
+def test_samples():
+    data = array.array('h', [1, -2, 3, -4, 5]).tobytes() # The last sample is incomplete
+    assert DEFAULT_FORMAT.samples(data).tolist() == [[1, -2], [3, -4]]
+
+def test_samples_24_bits():
+    """ 24 bits samples are scaled to 16 bits """
+    data = b"".join(value.to_bytes(3, 'little', signed=True) for value in (256, -512, -128))
+    assert AudioFormat(channels=1, sample_width=3).samples(data).tolist() == [[1], [-2], [-0.5]]
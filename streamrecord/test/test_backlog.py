@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+""" Test module for the compressed backlog of buffered audio """
+
+import time
+import queue
+import threading
+
+import pytest
+
+import backlog as backlog_module
+from backlog import CompressedBacklog, pack, unpack
+from audioformat import AudioFormat
+from songwriter import SongWriter
+from encoder import DebugEncoder
+from clock import VirtualClock
+from test_fingerprint import song
+
+ONE_SECOND = 44100 * 2 * 2
+
+def test_pack():
+    data = song(1, 0)
+    packed = pack(data)
+    assert packed[:1] == b"d" and len(packed) < len(data)
+    assert unpack(packed) == data
+    # Neither 16 bits nor whole frames: zlib only
+    mono24 = AudioFormat(44100, 1, 3)
+    assert unpack(pack(data[:300], mono24), mono24) == data[:300]
+    assert unpack(pack(data[:301])) == data[:301]
+
+def test_slices_and_deletion():
+    data = song(5, 1)
+    backlog = CompressedBacklog(compress_after=1, chunk_seconds=1)
+    for start in range(0, len(data), 10000):
+        backlog.extend(data[start:start + 10000])
+    assert len(backlog) == len(data)
+    assert backlog.compress_old_chunks() == 4 # The last second stays raw
+    assert backlog.memory() < len(data)
+    assert bytes(backlog) == data
+    assert backlog[ONE_SECOND // 2:3 * ONE_SECOND + 8] == data[ONE_SECOND // 2:3 * ONE_SECOND + 8]
+    del backlog[0:ONE_SECOND + 400]
+    assert backlog[0:100] == data[ONE_SECOND + 400:ONE_SECOND + 500]
+    assert backlog[100:ONE_SECOND] == data[ONE_SECOND + 500:2 * ONE_SECOND + 400]
+    del backlog[0:3 * ONE_SECOND]
+    assert bytes(backlog) == data[4 * ONE_SECOND + 400:]
+    with pytest.raises(ValueError):
+        del backlog[4:8]
+    del backlog[:]
+    assert len(backlog) == 0 and backlog.memory() == 0
+
+def test_compressor_thread():
+    backlog = CompressedBacklog(compress_after=1, chunk_seconds=1)
+    backlog.start()
+    data = song(4, 2)
+    backlog.extend(data)
+    deadline = time.time() + 10
+    while backlog.memory() == len(data) and time.time() < deadline:
+        time.sleep(0.01)
+    backlog.close()
+    assert not backlog.compressor.is_alive()
+    assert backlog.memory() < len(data)
+    assert bytes(backlog) == data
+def test_unpack_unlocked(monkeypatch):
+    """ Reads decompress without holding the lock, which would stall extend """
+    data = song(3, 1)
+    backlog = CompressedBacklog(compress_after=1, chunk_seconds=1)
+    backlog.extend(data)
+    backlog.compress_old_chunks()
+    locked = []
+    def checked_unpack(packed, audio_format):
+        locked.append(backlog.lock.locked())
+        return unpack(packed, audio_format)
+    monkeypatch.setattr(backlog_module, "unpack", checked_unpack)
+    del backlog[0:ONE_SECOND // 2]
+    assert bytes(backlog) == data[ONE_SECOND // 2:]
+    assert locked == [False, False]
+
+def test_song_writer():
+    """ The song writer cuts songs out of a compressed backlog """
+    data = song(6, 3)
+    backlog = CompressedBacklog(compress_after=1, chunk_seconds=1)
+    backlog.extend(data)
+    backlog.compress_old_chunks()
+    synchronization = {
+        'start': threading.Barrier(1),
+        'end': threading.Event(),
+        'tasks': queue.Queue()
+        }
+    encoder = DebugEncoder()
+    songwriter = SongWriter(
+        synchronization, {'raw_data': backlog, 'lock': threading.Lock()}, encoder,
+        VirtualClock())
+    try:
+        wrote_length = songwriter.write_data("backlog", 4, is_hard_length=True)
+        with open("backlog.raw", 'rb') as raw_file:
+            assert raw_file.read() == data[:4 * ONE_SECOND]
+        assert wrote_length == 4
+        assert bytes(backlog) == data[4 * ONE_SECOND:]
+    finally:
+        encoder.encoded["backlog"] = None
+        encoder.clear()
@@ -0,0 +1,72 @@
+#! /usr/bin/env python3
+""" Test module for the spectral confirmation of the cut points """
+
+import numpy
+
+from boundary import spectral_flux_scores
+from songwriter import find_breaking_byte, find_breaking_bytes
+
+ONE_SECOND = 2 * 2 * 44100
+
+def tones(seconds, frequencies, amplitude, seed=0):
+    """ Return seconds of stereo 16 bits audio: tones at frequencies, and a light noise """
+    time = numpy.arange(int(seconds * 44100)) / 44100
+    signal = sum(numpy.sin(2 * numpy.pi * frequency * time) for frequency in frequencies)
+    signal = amplitude * signal / len(frequencies)
+    signal += numpy.random.RandomState(seed).normal(0, 5, len(time))
+    return numpy.repeat(signal.astype('<i2'), 2).tobytes()
+
+SONG_A = (440, 880)
+SONG_B = (1500, 2500)
+
+def test_spectral_flux_scores():
+    """ Scores are high between different songs, whatever the loudness """
+    data = tones(0.5, SONG_A, 8000) + tones(0.5, SONG_A, 300) + tones(0.5, SONG_B, 8000)
+    frames = len(data) // 4
+    quarter = frames // 6
+    scores = spectral_flux_scores(
+        data, [(2 * quarter, 2 * quarter), (4 * quarter, 4 * quarter), (0, 0)])
+    assert scores[0] < 0.2
+    assert scores[1] > 1
+    assert scores[2] == 0 # Nothing before the data
+
+def test_crossfade_is_preferred_to_quiet_passage():
+    """ The quietest part is a quiet passage of the first song, the boundary
+    being a louder crossfade, both being under the silence threshold """
+    data = list(
+        tones(0.6, SONG_A, 8000) + tones(0.2, SONG_A, 150, 1) + tones(0.4, SONG_A, 8000, 2) +
+        tones(0.1, SONG_A, 600, 3) + tones(0.1, SONG_B, 600, 4) + tones(0.6, SONG_B, 8000, 5))
+    assert abs(find_breaking_byte(data) - 0.7 * ONE_SECOND) < 0.1 * ONE_SECOND
+    # Much louder than the quiet passage: not compared without a threshold
+    assert abs(find_breaking_byte(data, candidates=4) - 0.7 * ONE_SECOND) < 0.1 * ONE_SECOND
+    breaking_byte = find_breaking_byte(data, threshold=400 ** 2, candidates=4)
+    assert abs(breaking_byte - 1.3 * ONE_SECOND) < 0.1 * ONE_SECOND
+    assert breaking_byte % 4 == 0
+
+def test_silent_gap_is_kept():
+    """ A silent gap between similar songs wins over louder spans of the songs,
+    even more discontinuous ones, or at the edge of the data """
+    noise = numpy.random.RandomState(0).randint(-8000, 8000, 2 * 44100 * 3, dtype='<i2')
+    data = noise[:2 * 44100].tobytes() + bytes(ONE_SECOND // 2) + noise[:44100].tobytes()
+    assert abs(find_breaking_byte(data) - 1.25 * ONE_SECOND) < 0.05 * ONE_SECOND
+    assert find_breaking_byte(data, candidates=4) == find_breaking_byte(data)
+    song = noise[2 * 44100:].tobytes()
+    end = len(song) + len(data)
+    assert find_breaking_bytes(song + data, [end], candidates=4) == [
+        len(song) + find_breaking_byte(data)]
+
+def test_batched_search():
+    """ The batched search cuts every part as find_breaking_byte would """
+    parts = [
+        tones(1.2, SONG_A, 8000) + tones(0.1, SONG_A, 100, 1) + tones(0.7, SONG_B, 8000, 2),
+        tones(0.4, SONG_B, 8000, 3) + tones(0.2, SONG_B, 100, 4) + tones(1.4, SONG_A, 8000, 5)
+    ]
+    parts = [(part + bytes(ONE_SECOND))[:2 * ONE_SECOND] for part in parts]
+    data = tones(1, SONG_A, 8000, 6) + parts[0] + tones(3, SONG_B, 8000, 7) + parts[1]
+    ends = [len(data) - 5 * ONE_SECOND, len(data)]
+    assert find_breaking_bytes(data, ends) == [
+        ends[0] - 2 * ONE_SECOND + find_breaking_byte(parts[0]),
+        ends[1] - 2 * ONE_SECOND + find_breaking_byte(parts[1])]
+    cuts = find_breaking_bytes(data, ends, candidates=4)
+    assert abs(cuts[0] - (ends[0] - 0.75 * ONE_SECOND)) < 0.1 * ONE_SECOND
+    assert abs(cuts[1] - (ends[1] - 1.5 * ONE_SECOND)) < 0.1 * ONE_SECOND
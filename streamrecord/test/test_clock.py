@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+""" Test module for the clocks, and for long sessions run in virtual time"""
+
+import re
+import time
+import queue
+import threading
+
+from clock import Clock, VirtualClock
+from appinspector import PollAppInspector
+
+class PlaylistInspector(PollAppInspector):
+    """ Poll inspector reading titles from a virtual playlist instead of X """
+    def __init__(self, *args, tracks=1, track_length=1, **kwargs):
+        super(PlaylistInspector, self).__init__(*args, **kwargs)
+        self.tracks = tracks
+        self.track_length = track_length
+
+    def get_x_win_title(self):
+        track = int(self.clock.time() // self.track_length) % self.tracks
+        return "Title {} - Artist {} - Deezer".format(track, track)
+
+def test_real_clock():
+    clock = Clock()
+    before = clock.time()
+    clock.sleep(0.01)
+    assert clock.time() - before >= 0.01
+
+def test_virtual_clock():
+    clock = VirtualClock(start=100)
+    start = time.time()
+    clock.sleep(3600)
+    clock.advance(10)
+    clock.advance(-5)
+    assert clock.time() == 100 + 3600 + 10
+    assert time.time() - start < 1
+
+def test_concurrent_sleeps():
+    """ Threads sleeping at the same time move the time forward as the longest one """
+    clock = VirtualClock()
+    barrier = threading.Barrier(2)
+    wakeups = {}
+    def sleeper(name, seconds, times):
+        clock.sleep(0) # Starting from the time 0
+        barrier.wait(timeout=5)
+        wakeups[name] = []
+        for _ in range(times):
+            clock.sleep(seconds)
+            wakeups[name].append(clock.time())
+    threads = [threading.Thread(target=sleeper, args=("short", 1, 10)),
+               threading.Thread(target=sleeper, args=("long", 2, 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert clock.time() == 10
+    assert all(wakeup >= index + 1 for index, wakeup in enumerate(wakeups["short"]))
+    assert all(wakeup >= 2 * (index + 1) for index, wakeup in enumerate(wakeups["long"]))
+
+def test_thousand_tracks_playlist():
+    """ A whole playlist of 1000 tracks, looping back to the first one, in virtual time """
+    tracks = 1000
+    track_length = 10
+    synchronization = {
+        'start': threading.Barrier(1),
+        'end': threading.Event(),
+        'tasks': queue.Queue()
+        }
+    data = {
+        'raw_data': [],
+        'lock': threading.Lock()
+        }
+    inspector = PlaylistInspector(
+        synchronization, data, {
+            'win_id': "0x0",
+            'title_regex': re.compile(r"(?P<title>.+) - (?P<artist>.+) - .*")
+        },
+        clock=VirtualClock(),
+        tracks=tracks,
+        track_length=track_length)
+
+    start = time.time()
+    inspector.start()
+    tasks = []
+    while inspector.is_alive() or not synchronization['tasks'].empty():
+        try:
+            tasks.append(synchronization['tasks'].get(timeout=0.1))
+            synchronization['tasks'].task_done()
+        except queue.Empty:
+            pass
+    inspector.join()
+
+    # Every track, then the first one again
+    assert len(tasks) == tracks + 1
+    assert [task['infos']['title'] for task in tasks[:2]] == ["Title 0", "Title 1"]
+    assert tasks[-1]['infos']['title'] == "Title 0"
+    assert all(task['length'] == track_length for task in tasks)
+    assert time.time() - start < 30
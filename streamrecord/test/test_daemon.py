@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+""" Test module for the recorder daemon and its control socket client """
+
+import json
+import time
+import socket
+import threading
+
+import pytest
+
+import daemon
+from daemon import RecorderDaemon
+from client import send_command
+
+class FakeRecording:
+    """ Recording whose threads only wait for the end event """
+    def __init__(self, win_id, *args, **kwargs):
+        self.win_id = win_id
+        self.kwargs = kwargs
+        self.end_event = threading.Event()
+        self.threads = []
+        self.thread = threading.Thread(target=self.end_event.wait)
+        self.joined = False
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.end_event.set()
+
+    def join(self):
+        self.thread.join()
+        time.sleep(0.1) # Writing the last songs
+        self.joined = True
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def status(self):
+        return {
+            'win_id': self.win_id,
+            'running': self.is_alive(),
+            'stopping': self.end_event.is_set()
+        }
+
+@pytest.fixture()
+def running_daemon(tmpdir, monkeypatch):
+    """ Daemon serving a control socket in tmpdir, with fake recordings """
+    monkeypatch.setattr(daemon, "Recording", FakeRecording)
+    socket_path = str(tmpdir.join("streamrecord.sock"))
+    server = RecorderDaemon(socket_path)
+    serving = threading.Thread(target=server.serve_forever)
+    serving.start()
+    yield server, socket_path
+    if serving.is_alive():
+        server.shutdown()
+        serving.join()
+    server.server_close()
+
+def test_round_trip(running_daemon):
+    """ Start, status, stop and shutdown through the socket """
+    server, socket_path = running_daemon
+    assert send_command(socket_path, {'command': "status"}) == {'recording': None, 'ok': True}
+
+    answer = send_command(socket_path, {'command': "start", 'win_id': "0x42", 'poll': True})
+    assert answer['ok'] and answer['win_id'] == "0x42" and answer['running']
+    assert server.recording.kwargs['interactive'] is False
+    answer = send_command(socket_path, {'command': "start", 'win_id': "0x43"})
+    assert answer == {'ok': False, 'error': "A recording is already running"}
+
+    answer = send_command(socket_path, {'command': "status"})
+    assert answer['ok'] and answer['recording']['win_id'] == "0x42"
+
+    answer = send_command(socket_path, {'command': "stop"})
+    assert answer['ok'] and answer['stopping']
+    server.recording.join()
+    answer = send_command(socket_path, {'command': "stop"})
+    assert answer == {'ok': False, 'error': "No recording is running"}
+    answer = send_command(socket_path, {'command': "status"})
+    assert answer['recording']['running'] is False
+
+    assert send_command(socket_path, {'command': "shutdown"}) == {'ok': True}
+
+def test_errors(running_daemon):
+    """ Failed commands are reported, the connection being kept """
+    _, socket_path = running_daemon
+    answer = send_command(socket_path, {'command': "rewind"})
+    assert answer == {'ok': False, 'error': "Unknown command 'rewind'"}
+    answer = send_command(socket_path, {'command': "stop"})
+    assert answer == {'ok': False, 'error': "No recording is running"}
+    answer = send_command(socket_path, {'command': "start"}) # No window id
+    assert not answer['ok'] and "win_id" in answer['error']
+    assert send_command(socket_path, {'command': "metrics"})['ok']
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rwb') as stream:
+            stream.write(b"not json\n" + json.dumps({'command': "status"}).encode() + b"\n")
+            stream.flush()
+            assert not json.loads(stream.readline().decode())['ok']
+            assert json.loads(stream.readline().decode()) == {'recording': None, 'ok': True}
+
+def test_end_recording(running_daemon):
+    """ Once shut down, the daemon waits for the recording to be reaped """
+    server, socket_path = running_daemon
+    assert send_command(socket_path, {'command': "start", 'win_id': "0x42"})['ok']
+    assert send_command(socket_path, {'command': "shutdown"}) == {'ok': True}
+    server.end_recording()
+    assert server.recording.joined and not server.reaper.is_alive()
+    with pytest.raises(RuntimeError):
+        server.do_start({'win_id': "0x43"})
@@ -0,0 +1,65 @@
+#! /usr/bin/env python3
+""" Test module for the audio fingerprints and their index """
+
+import numpy
+
+from fingerprint import Fingerprinter, FingerprintIndex, fingerprint
+from audioformat import AudioFormat
+
+def song(seconds, seed):
+    """ Return seconds of a stereo 16 bits song: a new chord every quarter of second """
+    rng = numpy.random.RandomState(seed)
+    time = numpy.arange(int(seconds * 44100)) / 44100
+    signal = 0.05 * rng.standard_normal(len(time))
+    for start in range(0, len(time), 44100 // 4):
+        chord = time[start:start + 44100 // 4]
+        for frequency in rng.uniform(200, 3000, 3):
+            signal[start:start + len(chord)] += numpy.sin(2 * numpy.pi * frequency * chord)
+    samples = (signal / numpy.abs(signal).max() * 16000).astype('<i2')
+    return numpy.repeat(samples, 2).tobytes()
+
+def fingerprinted(data, audio_format=AudioFormat()):
+    fingerprinter = Fingerprinter(audio_format)
+    for index in range(0, len(data), 17640):
+        fingerprinter.update(data[index:index + 17640])
+    return fingerprinter
+
+def test_fingerprint_length():
+    assert len(fingerprint(song(1, 0))) == (44100 - 4096) // 2048
+    assert len(fingerprint(song(0.05, 0))) == 0
+
+def test_match():
+    """ Songs are recognized even if cut elsewhere, with another gain and some noise """
+    songs = [song(16, seed) for seed in range(4)]
+    index = FingerprintIndex()
+    for number, data in enumerate(songs):
+        index.add("song {}".format(number), fingerprinted(data).indexed_hashes())
+
+    rng = numpy.random.RandomState(42)
+    for number, data in enumerate(songs):
+        shifted = numpy.frombuffer(data[4 * 7777:], dtype='<i2') * 0.8
+        shifted += rng.normal(0, 20, len(shifted))
+        query = fingerprinted(shifted.astype('<i2').tobytes()).searched_hashes()
+        assert index.match(query) == "song {}".format(number)
+    assert index.match(fingerprinted(song(16, 10)).searched_hashes()) is None
+
+def test_match_other_format():
+    """ Hashes do not depend on the capture rate and channels """
+    data = song(16, 0)
+    index = FingerprintIndex()
+    index.add("song", fingerprinted(data).indexed_hashes())
+    # Left channel, resampled to 48kHz
+    left = numpy.frombuffer(data, dtype='<i2')[::2]
+    resampled = numpy.interp(
+        numpy.arange(len(left) * 48000 // 44100) / 48000, numpy.arange(len(left)) / 44100, left)
+    query = fingerprinted(resampled.astype('<i2').tobytes(), AudioFormat(48000, 1))
+    assert index.match(query.searched_hashes()) == "song"
+
+def test_persistence(tmpdir):
+    path = str(tmpdir.join("fingerprints.npz"))
+    assert len(FingerprintIndex.load(path)) == 0
+    data = song(16, 0)
+    index = FingerprintIndex()
+    index.add("song", fingerprinted(data).indexed_hashes())
+    index.save(path)
+    assert FingerprintIndex.load(path).match(fingerprinted(data).searched_hashes()) == "song"
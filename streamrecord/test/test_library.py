@@ -0,0 +1,28 @@
+#! /usr/bin/env python3
+""" Test module for the library index """
+
+import os
+
+from library import Library
+
+SONG = {'title': "Song", 'artist': "Artist"}
+
+def test_contains(tmpdir):
+    library = Library(str(tmpdir.join("library.json")))
+    assert not library.contains(SONG, 200)
+    library.add(SONG, 200)
+    assert library.contains(SONG, 201.5)
+    assert not library.contains(SONG, 210)
+    assert not library.contains({'title': "Other song", 'artist': "Artist"}, 200)
+
+def test_persistence(tmpdir):
+    path = str(tmpdir.join("library.json"))
+    Library(path).add(SONG, 200)
+    assert os.listdir(str(tmpdir)) == ["library.json"]
+    assert Library(path).contains({'title': "song", 'artist': "ARTIST"}, 200)
+
+def test_unknown_song(tmpdir):
+    library = Library(str(tmpdir.join("library.json")))
+    library.add({}, 200)
+    assert not library.contains({}, 200)
+    assert not os.path.exists(library.path)
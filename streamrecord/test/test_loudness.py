@@ -0,0 +1,47 @@
+#! /usr/bin/env python3
+""" Test module for the loudness measurement """
+
+import numpy
+
+from loudness import LoudnessMeter, k_weighting_power
+
+def sine(seconds, amplitude, frequency=997):
+    """ Return seconds of a stereo 16 bits sine at amplitude (1.0 being the full scale) """
+    time = numpy.arange(int(seconds * 44100)) / 44100
+    samples = (amplitude * 32767 * numpy.sin(2 * numpy.pi * frequency * time)).astype('<i2')
+    return numpy.repeat(samples, 2).tobytes()
+
+def test_k_weighting():
+    """ K-weighting is flat around 1kHz, cuts basses and boosts trebles """
+    power = 10 * numpy.log10(k_weighting_power([997, 20, 10000]))
+    assert abs(power[0] - 0.7) < 0.1
+    assert power[1] < -10
+    assert power[2] > 3
+
+def test_sine_loudness():
+    """ A stereo sine at -20 dBFS is at -20 LUFS, whatever the chunks it is fed by """
+    data = sine(5, 0.1)
+    meter = LoudnessMeter()
+    for index in range(0, len(data), 12345 * 4):
+        meter.update(data[index:index + 12345 * 4])
+    assert abs(meter.integrated_loudness() + 20) < 0.1
+    assert abs(meter.peak() - 0.1) < 0.001
+    gain = meter.replaygain_tags()['replaygain_track_gain']
+    assert gain.endswith(" dB") and abs(float(gain[:-3]) - 2) < 0.1
+
+def test_gating():
+    """ Silences and quiet parts are gated out of the loudness """
+    meter = LoudnessMeter()
+    meter.update(sine(5, 0.1) + bytes(5 * 44100 * 4) + sine(5, 0.001) + sine(5, 0.1))
+    # Only the blocks overlapping the end of the loud parts lower it a bit
+    assert abs(meter.integrated_loudness() + 20) < 0.2
+
+def test_silence():
+    """ No gain is given for silent or too short songs """
+    meter = LoudnessMeter()
+    meter.update(bytes(44100 * 4))
+    assert meter.integrated_loudness() is None
+    assert meter.replaygain_tags() == {}
+    meter = LoudnessMeter()
+    meter.update(sine(0.3, 0.1))
+    assert meter.integrated_loudness() is None
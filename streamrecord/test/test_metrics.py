@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+""" Test module for the metrics registry and exporter"""
+
+import json
+import threading
+
+from metrics import Metrics, InstrumentedLock, MetricsExporter
+
+def test_prometheus_format():
+    metrics = Metrics()
+    metrics.describe("test_bytes_total", "Test bytes")
+    metrics.inc("test_bytes_total", 10)
+    metrics.inc("test_bytes_total", 5)
+    metrics.set("test_depth", 3, queue="tasks")
+    metrics.observe("test_seconds", 1.5, encoder="Mp3LameEncoder")
+    metrics.observe("test_seconds", 0.5, encoder="Mp3LameEncoder")
+    lines = metrics.to_prometheus().splitlines()
+    assert "# HELP test_bytes_total Test bytes" in lines
+    assert "# TYPE test_bytes_total counter" in lines
+    assert "test_bytes_total 15" in lines
+    assert 'test_depth{queue="tasks"} 3' in lines
+    assert "# TYPE test_seconds summary" in lines
+    assert 'test_seconds_count{encoder="Mp3LameEncoder"} 2' in lines
+    assert 'test_seconds_sum{encoder="Mp3LameEncoder"} 2.0' in lines
+    assert 'test_seconds_max{encoder="Mp3LameEncoder"} 1.5' in lines
+
+def test_collectors():
+    metrics = Metrics()
+    collector = lambda registry: registry.set("test_gauge", 42)
+    metrics.add_collector(collector)
+    metrics.collect()
+    assert metrics.to_json()['gauges']['test_gauge'] == [{'labels': {}, 'value': 42}]
+    metrics.remove_collector(collector)
+    metrics.clear()
+    metrics.collect()
+    assert metrics.to_json()['gauges'] == {}
+
+def test_instrumented_lock():
+    metrics = Metrics()
+    lock = InstrumentedLock("test_lock", metrics)
+    with lock:
+        assert lock.locked()
+    assert not lock.locked()
+    assert lock.acquire(blocking=False)
+    waiter = threading.Thread(target=lambda: lock.acquire() and lock.release())
+    waiter.start()
+    lock.release()
+    waiter.join()
+    summaries = metrics.to_json()['summaries']
+    assert summaries['streamrecord_lock_wait_seconds'][0]['labels'] == {'lock': "test_lock"}
+    assert summaries['streamrecord_lock_wait_seconds'][0]['value']['count'] == 3
+    assert summaries['streamrecord_lock_hold_seconds'][0]['value']['count'] == 3
+
+def test_json_export(tmpdir):
+    metrics = Metrics()
+    metrics.inc("streamrecord_capture_bytes_total", 100)
+    path = str(tmpdir.join("metrics.json"))
+    exporter = MetricsExporter(path, interval=60, metrics=metrics)
+    exporter.start()
+    exporter.stop()
+    with open(path) as metrics_file:
+        exported = json.load(metrics_file)
+    assert exported['counters']['streamrecord_capture_bytes_total'][0]['value'] == 100
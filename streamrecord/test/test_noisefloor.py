@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+""" Test module for the noise floor estimation and its use to find gaps """
+
+import array
+import random
+
+from noisefloor import NoiseFloorEstimator, window_energies
+from songwriter import find_breaking_byte
+from audioformat import AudioFormat
+
+ONE_SECOND = 2 * 2 * 44100
+
+def noise(seconds, amplitude, seed=0):
+    """ Return seconds of stereo 16 bits uniform noise """
+    rng = random.Random(seed)
+    samples = int(seconds * 44100) * 2
+    return array.array('h', (rng.randint(-amplitude, amplitude) for _ in range(samples))).tobytes()
+
+def test_window_energies():
+    """ Windows are aligned on the end and returned from the end """
+    data = array.array('h', [0] * 8 + [10] * 4).tobytes() # 6 stereo frames
+    assert list(window_energies(data, 2)) == [100, 0, 0]
+    assert list(window_energies(data, 4, 1)) == [50, 25, 0]
+
+def test_noise_floor_needs_enough_audio():
+    """ No threshold is given before min_seconds of audio """
+    estimator = NoiseFloorEstimator(min_seconds=1)
+    estimator.update(noise(0.5, 100))
+    assert estimator.noise_floor_db() is None
+    assert estimator.silence_energy() is None
+    estimator.update(noise(0.55, 100))
+    assert estimator.noise_floor_db() is not None
+
+def test_noise_floor_follows_stream():
+    """ The noise floor of a stream is its quietest part """
+    estimator = NoiseFloorEstimator(min_seconds=1)
+    estimator.update(noise(10, 8000) + noise(1, 300) + noise(10, 8000))
+    # Uniform noise of amplitude A has a mean square value of A²/3: -45.5 dBFS for 300
+    assert abs(estimator.noise_floor_db() + 45.5) <= 1
+    assert estimator.silence_amplitude() < 8000
+
+def test_noise_floor_half_life():
+    """ With a half life, the previous quiet parts are forgotten """
+    estimator = NoiseFloorEstimator(min_seconds=1, half_life=1)
+    estimator.update(noise(1, 10) + noise(20, 8000))
+    assert estimator.noise_floor_db() > -30
+
+def test_breaking_byte_on_noise_floor_gap():
+    """ With a threshold, the longest gap over the noise floor is chosen, not the quietest """
+    estimator = NoiseFloorEstimator(min_seconds=1)
+    estimator.update(noise(10, 8000) + noise(1, 200))
+    # The gap is 0.5 second of noise floor, followed by a short digital drop out
+    data = list(noise(0.5, 8000) + noise(0.5, 200) + noise(0.4, 8000, 1) +
+                noise(0.2, 20) + noise(0.4, 8000, 2))
+    # Without threshold, the quietest part is chosen
+    assert abs(find_breaking_byte(data) - 1.5 * ONE_SECOND) < 0.05 * ONE_SECOND
+    breaking_byte = find_breaking_byte(data, threshold=estimator.silence_energy())
+    assert abs(breaking_byte - 0.75 * ONE_SECOND) < 0.05 * ONE_SECOND
+    assert breaking_byte % 4 == 0
+
+def test_breaking_byte_other_format():
+    """ Gaps are found in mono audio at 48kHz too """
+    mono = AudioFormat(48000, 1)
+    # noise() gives stereo frames at 44.1kHz: half as many mono ones at 48kHz
+    data = noise(0.8, 8000) + noise(0.4, 20) + noise(0.8, 8000, 1)
+    breaking_byte = find_breaking_byte(data, audio_format=mono)
+    assert len(noise(0.8, 8000)) < breaking_byte < len(noise(1.2, 8000))
+    assert breaking_byte % 2 == 0
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+""" Test module for the schedules of the window title polls """
+
+import re
+import queue
+import threading
+
+import pytest
+
+from pollschedule import PollSchedule, AdaptivePollSchedule
+from clock import VirtualClock
+from test_clock import PlaylistInspector
+
+def test_fixed_schedule():
+    schedule = PollSchedule(2)
+    schedule.track_started(0, {'title': "Title", 'artist': "Artist"})
+    assert schedule.next_interval(100) == 2
+    assert schedule.change_time(99, 100) == 100
+
+def test_adaptive_intervals():
+    schedule = AdaptivePollSchedule()
+    schedule.track_started(0)
+    assert schedule.next_interval(10) == 1 # Playing before the recording: fixed
+    assert schedule.change_time(99, 100) == 99.5 # Between the two polls
+    schedule.track_started(99.5)
+    assert schedule.next_interval(110) == 1 # No length known yet
+    schedule.change_time(279, 280)
+    assert list(schedule.lengths) == [180]
+    schedule.track_started(279.5)
+    assert schedule.next_interval(279.5) == 4 # Far from the expected end
+    assert schedule.next_interval(279.5 + 170) == pytest.approx(9 * 0.2)
+    assert schedule.next_interval(279.5 + 179.5) == 0.05 # Near the expected end
+    assert schedule.next_interval(279.5 + 190) == 1 # Late
+    # The poll cost bounds the interval
+    schedule.polled(0.02)
+    assert schedule.next_interval(279.5 + 179.5) == pytest.approx(0.2)
+
+def test_known_length():
+    lengths = {"Short": 60}
+    schedule = AdaptivePollSchedule(known_length=lambda infos: lengths.get(infos['title']))
+    schedule.track_started(0)
+    schedule.change_time(None, 10)
+    schedule.track_started(10, {'title': "Short", 'artist': "Artist"})
+    assert schedule.expected == (60, 1)
+    schedule.change_time(69, 71)
+    schedule.track_started(70, {'title': "Long", 'artist': "Artist"})
+    assert schedule.expected == (60, 1) # Median of the previous tracks
+    schedule.change_time(249, 251)
+    schedule.track_started(250)
+    assert schedule.expected == (120, 60)
+    assert schedule.next_interval(250 + 120) == 3 # Too uncertain to poll fast
+
+def run_playlist(schedule, tracks=20, track_length=180):
+    """ Return the tasks and the number of polls of a playlist recorded in virtual time """
+    polls = []
+    class CountingInspector(PlaylistInspector):
+        def get_x_win_title(self):
+            polls.append(self.clock.time())
+            return super(CountingInspector, self).get_x_win_title()
+
+    synchronization = {
+        'start': threading.Barrier(1),
+        'end': threading.Event(),
+        'tasks': queue.Queue()
+        }
+    inspector = CountingInspector(
+        synchronization, {'raw_data': [], 'lock': threading.Lock()}, {
+            'win_id': "0x0",
+            'title_regex': re.compile(r"(?P<title>.+) - (?P<artist>.+) - .*")
+        },
+        clock=VirtualClock(),
+        tracks=tracks,
+        track_length=track_length,
+        schedule=schedule)
+    inspector.start()
+    tasks = []
+    while inspector.is_alive() or not synchronization['tasks'].empty():
+        try:
+            tasks.append(synchronization['tasks'].get(timeout=0.1))
+            synchronization['tasks'].task_done()
+        except queue.Empty:
+            pass
+    inspector.join()
+    return tasks, len(polls)
+
+def test_adaptive_playlist():
+    """ Fewer polls than the fixed schedule, and more accurate boundaries """
+    fixed_tasks, fixed_polls = run_playlist(PollSchedule())
+    tasks, polls = run_playlist(AdaptivePollSchedule())
+    assert len(tasks) == len(fixed_tasks) == 21
+    assert polls < fixed_polls / 1.5
+    # Once a track length is known
+    errors = [min(task['id'] % 180, 180 - task['id'] % 180) for task in tasks]
+    assert max(errors[2:]) < 0.05
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+""" Test module for the profiling mode"""
+
+import os
+import time
+import pstats
+import threading
+
+import profiling
+from profiling import Profiler, component_filename
+from backlog import CompressedBacklog
+
+def busy_wait(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+def test_component_filename():
+    assert component_filename("Song Writer") == "song_writer"
+    assert component_filename("PulseAudio Manager") == "pulseaudio_manager"
+
+def test_cprofile_per_thread(tmpdir, monkeypatch):
+    monkeypatch.setattr(profiling, "PROCESS_WIDE_CPROFILE", False) # One thread at a time
+    profiler = Profiler(str(tmpdir))
+    for _ in range(2):
+        thread = threading.Thread(target=busy_wait, args=(0.05,), name="Song Writer")
+        profiler.profile(thread)
+        thread.start()
+        thread.join()
+    profiler.stop()
+    stats = pstats.Stats(str(tmpdir.join("song_writer.prof")))
+    assert any(function[2] == "busy_wait" for function in stats.stats)
+    assert stats.total_calls > 0
+
+def test_sampling(tmpdir):
+    profiler = Profiler(str(tmpdir), sampling_interval=0.005)
+    thread = threading.Thread(target=busy_wait, args=(0.2,), name="Stream Loader")
+    profiler.profile(thread)
+    thread.start()
+    thread.join()
+    profiler.stop()
+    assert not os.path.exists(str(tmpdir.join("stream_loader.prof")))
+    with open(str(tmpdir.join("stream_loader.folded"))) as folded_file:
+        lines = folded_file.read().splitlines()
+    assert lines
+    assert any("busy_wait" in line for line in lines)
+
+def profile_concurrently(profiler, names, seconds=0.2):
+    """ Run a busy thread for each of names at the same time, under profiler """
+    barrier = threading.Barrier(len(names))
+    def run():
+        barrier.wait(timeout=5)
+        busy_wait(seconds)
+    threads = [threading.Thread(target=run, name=name) for name in names]
+    for thread in threads:
+        profiler.profile(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    profiler.stop()
+
+def test_concurrent_threads(tmpdir):
+    """ Threads profiled at the same time each get their stats, in the same
+    format whatever the Python version """
+    profile_concurrently(Profiler(str(tmpdir)), ["Song Writer", "Stream Loader"])
+    extension = ".folded" if profiling.PROCESS_WIDE_CPROFILE else ".prof"
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        "song_writer" + extension, "stream_loader" + extension]
+
+def test_process_wide_cprofile(tmpdir, monkeypatch):
+    """ Where cProfile covers every thread, they are all sampled from the start """
+    monkeypatch.setattr(profiling, "PROCESS_WIDE_CPROFILE", True)
+    profile_concurrently(Profiler(str(tmpdir)), ["Song Writer", "Stream Loader"])
+    assert sorted(path.basename for path in tmpdir.listdir()) == [
+        "song_writer.folded", "stream_loader.folded"]
+
+def test_backlog_compressor(tmpdir):
+    """ The compressor thread exists before the backlog starts, to be profiled """
+    profiler = Profiler(str(tmpdir), sampling_interval=0.005)
+    backlog = CompressedBacklog()
+    profiler.profile(backlog.compressor)
+    backlog.start()
+    time.sleep(0.1)
+    backlog.close()
+    profiler.stop()
+    assert tmpdir.join("backlog_compressor.folded").exists()
@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+""" Test module for the sink inputs helpers of the PulseAudio manager"""
+
+import os
+
+import pulseaudiomanager
+from audioformat import AudioFormat
+
+PACMD_OUTPUT = """2 sink input(s) available.
+    index: 7
+	driver: <protocol-native.c>
+	flags: START_CORKED
+	state: RUNNING
+	sink: 0 <alsa_output.pci-0000_00_1b.0.analog-stereo>
+	volume: front-left: 65536 / 100% / 0,00 dB,   front-right: 65536 / 100% / 0,00 dB
+	properties:
+		media.name = "Playback"
+		application.name = "Firefox"
+		application.process.id = "{other_pid}"
+		application.process.binary = "firefox"
+    index: 12
+	driver: <protocol-native.c>
+	state: RUNNING
+	sample spec: float32le 1ch 48000Hz
+	properties:
+		media.name = "AudioStream"
+		application.name = "Python"
+		application.process.id = "{pid}"
+		application.process.binary = "mpv"
+"""
+
+def test_parse_sink_inputs():
+    sink_inputs = pulseaudiomanager.parse_sink_inputs(
+        PACMD_OUTPUT.format(pid=1234, other_pid=4321))
+    assert sorted(sink_inputs.keys()) == [7, 12]
+    assert sink_inputs[7]['state'] == "RUNNING"
+    assert sink_inputs[7]['properties']['application.name'] == "Firefox"
+    assert sink_inputs[12]['properties']['application.process.id'] == "1234"
+    assert 'driver' not in sink_inputs[7]['properties']
+
+def test_parse_sink_inputs_empty():
+    assert pulseaudiomanager.parse_sink_inputs("0 sink input(s) available.\n") == {}
+
+def test_match_sink_input_by_pid():
+    sink_inputs = pulseaudiomanager.parse_sink_inputs(
+        PACMD_OUTPUT.format(pid=os.getpid(), other_pid=1))
+    assert pulseaudiomanager.match_sink_input(sink_inputs, os.getpid()) == 12
+
+def test_match_sink_input_by_child():
+    # This process is a child of its parent: it must be chosen over a same-named binary
+    sink_inputs = pulseaudiomanager.parse_sink_inputs(
+        PACMD_OUTPUT.format(pid=os.getpid(), other_pid=1))
+    assert pulseaudiomanager.match_sink_input(sink_inputs, os.getppid()) == 12
+
+def test_match_sink_input_none():
+    sink_inputs = pulseaudiomanager.parse_sink_inputs(
+        PACMD_OUTPUT.format(pid=1, other_pid=1))
+    assert pulseaudiomanager.match_sink_input(sink_inputs, os.getpid()) is None
+
+def test_negotiate_format(monkeypatch):
+    """ The format of the sink input is captured, unless another one is requested """
+    monkeypatch.setattr(
+        pulseaudiomanager, "list_sink_inputs",
+        lambda: pulseaudiomanager.parse_sink_inputs(PACMD_OUTPUT.format(pid=1, other_pid=1)))
+    assert pulseaudiomanager.negotiate_format(12) == AudioFormat(48000, 1, 2)
+    assert pulseaudiomanager.negotiate_format(12, channels=2) == AudioFormat(48000, 2, 2)
+    assert pulseaudiomanager.negotiate_format(12, 44100, 2, 3) == AudioFormat(44100, 2, 3)
+    # No sample spec
+    assert pulseaudiomanager.negotiate_format(7) == AudioFormat()
+    assert pulseaudiomanager.negotiate_format() == AudioFormat()
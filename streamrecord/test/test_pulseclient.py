@@ -0,0 +1,107 @@
+#! /usr/bin/env python3
+""" Test module for the libpulse client, against a private PulseAudio server
+running only a null sink (skipped if pulseaudio or libpulse is not installed) """
+
+import os
+import time
+import shutil
+import subprocess
+import pytest
+
+import pulseclient
+import pulseaudiomanager
+from pulseclient import PulseClient, RecordStream, PulseError
+from audioformat import AudioFormat
+
+needs_server = pytest.mark.skipif(
+    shutil.which("pulseaudio") is None or not pulseclient.available(),
+    reason="pulseaudio or libpulse is not installed")
+
+@pytest.fixture()
+def server(tmpdir, monkeypatch):
+    """ Start a PulseAudio server of its own, with a null sink, for the test """
+    socket = str(tmpdir.join("native"))
+    monkeypatch.setenv("PULSE_SERVER", "unix:{}".format(socket))
+    monkeypatch.setenv("PULSE_RUNTIME_PATH", str(tmpdir))
+    monkeypatch.setenv("HOME", str(tmpdir))
+    process = subprocess.Popen([
+        "pulseaudio", "--daemonize=no", "--exit-idle-time=-1", "-n", "--disallow-exit",
+        "--use-pid-file=no", "--system=no",
+        "--load=module-native-protocol-unix socket={}".format(socket),
+        "--load=module-null-sink sink_name=output"])
+    deadline = time.time() + 10
+    while not os.path.exists(socket):
+        if time.time() > deadline or process.poll() is not None:
+            process.kill()
+            pytest.skip("Unable to start pulseaudio")
+        time.sleep(0.05)
+    yield socket
+    process.terminate()
+    process.wait()
+
+def test_capture_backend(monkeypatch):
+    monkeypatch.setattr(pulseaudiomanager.pulseclient, "available", lambda: False)
+    assert pulseaudiomanager.capture_backend() is pulseaudiomanager.PulseAudioManager
+    monkeypatch.setattr(pulseaudiomanager.pulseclient, "available", lambda: True)
+    assert pulseaudiomanager.capture_backend() is pulseaudiomanager.NativePulseAudioManager
+    assert pulseaudiomanager.capture_backend("subprocess") is pulseaudiomanager.PulseAudioManager
+
+@needs_server
+def test_modules(server):
+    with PulseClient() as client:
+        assert client.list_sink_inputs() == {}
+        index = client.load_module("module-null-sink", "sink_name=recorder")
+        client.unload_module(index)
+        with pytest.raises(PulseError):
+            client.unload_module(index)
+        with pytest.raises(PulseError):
+            client.load_module("module-which-does-not-exist")
+
+@needs_server
+def test_sink_inputs(server):
+    """ A playing stream is listed with the same fields as from pacmd """
+    if shutil.which("pacat") is None:
+        pytest.skip("pacat is not installed")
+    player = subprocess.Popen(
+        ["pacat", "--playback", "--raw", "--rate=48000", "--channels=1", "-d", "output"],
+        stdin=subprocess.PIPE)
+    try:
+        player.stdin.write(bytes(48000 * 2))
+        player.stdin.flush()
+        with PulseClient() as client:
+            deadline = time.time() + 10
+            sink_inputs = client.list_sink_inputs()
+            while not sink_inputs and time.time() < deadline:
+                time.sleep(0.05)
+                sink_inputs = client.list_sink_inputs()
+            (sink_input,) = sink_inputs.values()
+            assert int(sink_input['properties']['application.process.id']) == player.pid
+            assert AudioFormat.from_sample_spec(sink_input['sample spec']) == AudioFormat(
+                48000, 1, 2)
+            index = client.load_module("module-null-sink", "sink_name=recorder")
+            client.move_sink_input(list(sink_inputs)[0], "recorder")
+            client.move_sink_input(list(sink_inputs)[0], int(sink_input['sink']))
+            client.unload_module(index)
+    finally:
+        player.kill()
+        player.wait()
+
+@needs_server
+def test_record_stream(server):
+    audio_format = AudioFormat(48000, 1, 2)
+    with PulseClient() as client:
+        index = client.load_module("module-null-sink", "sink_name=recorder")
+        stream = RecordStream("recorder.monitor", audio_format, fragment_seconds=0.02)
+        try:
+            start = time.time()
+            data = stream.read(audio_format.bytes_per_second // 10)
+            assert len(data) >= audio_format.bytes_per_second // 10
+            assert len(data) % audio_format.frame_bytes == 0
+            assert data == bytes(len(data)) # Nothing plays
+            assert time.time() - start < 1
+            # Removing the source ends the stream
+            client.unload_module(index)
+            while stream.read(audio_format.bytes_per_second):
+                pass
+        finally:
+            stream.close()
@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+""" Test module for the retagging of encoded songs """
+
+import os
+import json
+import struct
+import pytest
+
+from retag import (ID3Tag, FlacMetadata, read_tags, write_tags, retag_file, Retagger,
+                   update_id3v1, PADDING)
+from library import Library
+
+AUDIO = bytes(range(256)) * 64 # Stands for the encoded audio frames
+INFOS = {'title': "Song", 'artist': "Artist", 'replaygain_track_gain': "-3.20 dB"}
+
+def id3v23_song(path, frames=()):
+    """ Write a MP3 file with an ID3v2.3 tag holding frames and 16 bytes of padding,
+    and an ID3v1 tag """
+    body = b"".join(frame_id + struct.pack(">I", len(data)) + b"\0\0" + data
+                    for frame_id, data in frames) + bytes(16)
+    size = bytes((len(body) >> shift) & 0x7f for shift in (21, 14, 7, 0))
+    id3v1 = b"TAG" + b"Old".ljust(30, b"\0") + bytes(94) + b"\x0c"
+    with open(path, 'wb') as mp3_file:
+        mp3_file.write(b"ID3\3\0\0" + size + body + AUDIO + id3v1)
+
+def flac_song(path, comments=(), padding=16):
+    """ Write a FLAC file with a STREAMINFO block, Vorbis comments and padding """
+    vendor = b"reference libFLAC"
+    encoded = [comment.encode() for comment in comments]
+    comment_block = (struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(encoded)) +
+                     b"".join(struct.pack("<I", len(comment)) + comment for comment in encoded))
+    with open(path, 'wb') as flac_file:
+        flac_file.write(b"fLaC" + b"\0" + (34).to_bytes(3, 'big') + b"\x11" * 34)
+        flac_file.write(b"\4" + len(comment_block).to_bytes(3, 'big') + comment_block)
+        flac_file.write(b"\x81" + padding.to_bytes(3, 'big') + bytes(padding) + AUDIO)
+
+def audio(path, header_class):
+    """ Return the data following the tags of path (ID3v1 tag excluded) """
+    with open(path, 'rb') as song_file:
+        header = header_class.read(song_file)
+        song_file.seek(header.size)
+        data = song_file.read()
+    return data[:-128] if header_class is ID3Tag else data
+
+def test_mp3_in_place(tmpdir):
+    path = str(tmpdir.join("song.mp3"))
+    id3v23_song(path, [(b"TIT2", b"\0Old title\0"), (b"TPE1", b"\0Artist"),
+                       (b"TPOS", b"\x001/2")])
+    size = os.path.getsize(path)
+    assert read_tags(path) == {'title': "Old title", 'artist': "Artist"}
+    assert write_tags(path, {'title': "Song", 'artist': "Artist"})
+    assert os.path.getsize(path) == size
+    assert read_tags(path) == {'title': "Song", 'artist': "Artist"}
+    assert audio(path, ID3Tag) == AUDIO
+    with open(path, 'rb') as mp3_file:
+        assert ("TPOS", b"\0\0", b"\x001/2") in ID3Tag.read(mp3_file).frames
+        mp3_file.seek(-128, os.SEEK_END)
+        assert mp3_file.read(128)[3:33] == b"Song".ljust(30, b"\0")
+
+def test_mp3_grown(tmpdir):
+    path = str(tmpdir.join("song.mp3"))
+    id3v23_song(path)
+    infos = dict(INFOS, comment="é" * 20, album="Album", year="2019", track="3")
+    assert not write_tags(path, infos)
+    assert read_tags(path) == infos
+    assert audio(path, ID3Tag) == AUDIO
+    with open(path, 'rb') as mp3_file:
+        assert ID3Tag.read(mp3_file).size > PADDING
+    # Now in place
+    assert write_tags(path, INFOS)
+    assert read_tags(path) == INFOS
+
+def test_mp3_without_tag(tmpdir):
+    path = str(tmpdir.join("song.mp3"))
+    with open(path, 'wb') as mp3_file:
+        mp3_file.write(AUDIO)
+    assert read_tags(path) == {}
+    assert not write_tags(path, INFOS)
+    assert read_tags(path) == INFOS
+    with open(path, 'rb') as mp3_file:
+        mp3_file.seek(ID3Tag.read(mp3_file).size)
+        assert mp3_file.read() == AUDIO
+
+def test_id3v1_short_file(tmpdir):
+    """ A file shorter than an ID3v1 tag is left untouched """
+    path = tmpdir.join("short.mp3")
+    path.write_binary(b"\xff\xfb" * 10)
+    with open(str(path), 'r+b') as mp3_file:
+        update_id3v1(mp3_file, INFOS)
+    assert path.read_binary() == b"\xff\xfb" * 10
+
+def test_flac(tmpdir):
+    path = str(tmpdir.join("song.flac"))
+    flac_song(path, ["TITLE=Old title", "ARTIST=Artist", "ENCODER=flac"])
+    assert read_tags(path) == {'title': "Old title", 'artist': "Artist"}
+    size = os.path.getsize(path)
+    assert write_tags(path, {'title': "Song", 'artist': "Artist"})
+    assert os.path.getsize(path) == size
+    assert read_tags(path) == {'title': "Song", 'artist': "Artist"}
+    assert not write_tags(path, dict(INFOS, comment="x" * 100))
+    assert read_tags(path) == dict(INFOS, comment="x" * 100)
+    assert audio(path, FlacMetadata) == AUDIO
+    with open(path, 'rb') as flac_file:
+        metadata = FlacMetadata.read(flac_file)
+    assert metadata.blocks[0] == (0, b"\x11" * 34)
+    assert "ENCODER=flac" in metadata.get_comments()[1]
+
+def test_unsupported(tmpdir):
+    path = str(tmpdir.join("song.opus"))
+    open(path, 'wb').close()
+    with pytest.raises(ValueError):
+        read_tags(path)
+
+def test_retag_file(tmpdir):
+    path = str(tmpdir.join("song.flac"))
+    flac_song(path, ["TITLE=Artist", "ARTIST=Song"])
+    swap = lambda infos: dict(infos, title=infos['artist'], artist=infos['title'])
+    infos, new_infos, new_path = retag_file(path, swap)
+    assert new_infos == {'title': "Song", 'artist': "Artist"}
+    assert new_path == str(tmpdir.join("artist-song.flac"))
+    assert os.listdir(str(tmpdir)) == ["artist-song.flac"]
+    flac_song(path, ["TITLE=Artist", "ARTIST=Song"])
+    with pytest.raises(FileExistsError):
+        retag_file(path, swap)
+    assert sorted(os.listdir(str(tmpdir))) == ["artist-song.flac", "song.flac"]
+
+def test_retagger(tmpdir):
+    songs = tmpdir.mkdir("songs")
+    for index in range(20):
+        flac_song(str(songs.join("{}.flac".format(index))),
+                  ["TITLE=Artist {}".format(index), "ARTIST=Song {}".format(index)])
+    id3v23_song(str(songs.join("20.mp3")), [(b"TIT2", b"\0Artist 20"), (b"TPE1", b"\0Song 20")])
+    library = Library(str(tmpdir.join("library.json")))
+    library.add({'title': "Artist 3", 'artist': "Song 3"}, 200)
+
+    def swap(infos):
+        return dict(infos, title=infos['artist'], artist=infos['title'])
+    report = Retagger(swap, library=library).run([str(songs)], jobs=4)
+    assert report['retagged'] == report['renamed'] == 21
+    assert report['failed'] == []
+    assert "artist_20-song_20.mp3" in os.listdir(str(songs))
+    assert read_tags(str(songs.join("artist_7-song_7.flac"))) == {
+        'title': "Song 7", 'artist': "Artist 7"}
+    assert library.contains({'title': "Song 3", 'artist': "Artist 3"}, 200)
+    with open(library.path) as library_file:
+        assert list(json.load(library_file)) == ["artist_3-song_3"]
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+""" Test module for the drop rules of the non-music segments """
+
+import json
+import queue
+import pytest
+
+from rules import DropRule, DropRules
+from appinspector import AppInspector
+
+def task(window_title, length, title=None, artist=None):
+    """ Return a task as created by AppInspector.run """
+    return {
+        'id': 0,
+        'length': length,
+        'window_title': window_title,
+        'infos': {'title': title, 'artist': artist}
+    }
+
+def test_patterns():
+    rule = DropRule(title=r"^advert", artist="deezer")
+    assert rule.matches(task("x", 30, "Advertisement", "Deezer"))
+    assert not rule.matches(task("x", 30, "Advertisement", "Someone"))
+    assert not rule.matches(task("x", 30, "My Advertisement", "Deezer"))
+    assert DropRule(window="loading").matches(task("Loading… - Deezer", 2))
+    assert not DropRule(window="loading").matches(task("Title - Artist - Deezer", 2))
+
+def test_length_bounds():
+    rule = DropRule(min_length=5, max_length=40)
+    assert [rule.matches(task("x", length)) for length in (4, 5, 40, 41)] == [
+        False, True, True, False]
+    assert DropRule(title="jingle", max_length=10).matches(task("x", 8, "Jingle"))
+    assert not DropRule(title="jingle", max_length=10).matches(task("x", 200, "Jingle"))
+
+def test_empty_rule():
+    with pytest.raises(ValueError):
+        DropRule(name="everything")
+
+def test_load(tmpdir):
+    path = tmpdir.join("rules.json")
+    path.write(json.dumps([
+        {"name": "ads", "title": "^ad$"},
+        {"max_length": 3}
+    ]))
+    rules = DropRules.load(str(path))
+    assert len(rules) == 2
+    assert rules.match(task("x", 30, "Ad")).name == "ads"
+    assert rules.match(task("x", 2, "Song")).name == "length<=3s"
+    assert rules.match(task("x", 200, "Song")) is None
+
+def test_launch_task():
+    """ Matching tasks are still queued, marked to be dropped """
+    tasks = queue.Queue()
+    inspector = AppInspector(
+        {'start': None, 'end': None, 'tasks': tasks}, {},
+        {'win_id': "0x0", 'title_regex': None},
+        rules=DropRules([DropRule(name="ads", title="^ad$")]))
+    inspector.launch_task(task("Ad - Deezer - Deezer", 30, "Ad", "Deezer"))
+    inspector.launch_task(task("Song - Artist - Deezer", 200, "Song", "Artist"))
+    assert tasks.get()['drop'] == "ads"
+    assert 'drop' not in tasks.get()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+""" Test module for the scheduling policies of the capture and the encoders """
+
+import os
+import subprocess
+import threading
+import pytest
+
+import scheduling
+from scheduling import SchedulingPolicy, default_policies, parse_ionice, get_ionice
+from encoder import Encoder
+
+def test_parse_ionice():
+    assert parse_ionice("idle") == ("idle", 0)
+    assert parse_ionice("best-effort:7") == ("best-effort", 7)
+    with pytest.raises(ValueError):
+        parse_ionice("fast")
+
+def test_default_policies():
+    cpus = sorted(os.sched_getaffinity(0))
+    capture, encoder = default_policies()
+    if len(cpus) > 1:
+        assert capture.cpus == {cpus[-1]}
+        assert encoder.cpus == set(cpus[:-1])
+    else:
+        assert capture.cpus is None and encoder.cpus is None
+    capture, encoder = default_policies(-1)
+    assert capture.cpus is None and encoder.cpus is None
+    assert encoder.nice > 0 > capture.nice
+
+def test_apply_to_process():
+    """ Lowering the priority of a child is always permitted """
+    cpu = sorted(os.sched_getaffinity(0))[0]
+    policy = SchedulingPolicy({cpu}, nice=15, ionice=("best-effort", 6))
+    process = subprocess.Popen(["sleep", "5"])
+    try:
+        effective = policy.apply(process.pid, "sleep")
+        assert effective['cpus'] == [cpu]
+        assert effective['nice'] == os.getpriority(os.PRIO_PROCESS, process.pid) == 15
+        if 'ionice' in effective: # ioprio syscalls are known on this machine
+            assert get_ionice(process.pid) == ("best-effort", 6)
+    finally:
+        process.kill()
+        process.wait()
+
+def test_apply_to_thread():
+    """ Only the thread applying the policy is changed """
+    nice = os.getpriority(os.PRIO_PROCESS, 0)
+    effective = {}
+    def run():
+        effective.update(SchedulingPolicy(nice=nice + 1).apply())
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert effective['nice'] == nice + 1
+    assert os.getpriority(os.PRIO_PROCESS, threading.get_native_id()) == nice
+
+def test_not_permitted(monkeypatch, caplog):
+    def refuse(*arguments):
+        raise PermissionError(1, "Operation not permitted")
+    monkeypatch.setattr(scheduling, "set_ionice", refuse)
+    effective = SchedulingPolicy(ionice=("realtime", 0)).apply()
+    assert "nice" in effective
+    assert "Unable to set the I/O priority" in caplog.text
+
+def test_encoder_spawn():
+    encoder = Encoder()
+    encoder.scheduling = SchedulingPolicy(nice=12)
+    process = encoder.spawn(["sleep", "5"])
+    try:
+        assert os.getpriority(os.PRIO_PROCESS, process.pid) == 12
+    finally:
+        process.kill()
+        process.wait()
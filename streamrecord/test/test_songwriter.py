@@ -1,13 +1,24 @@
 #! /usr/bin/env python3
 """ Test module for the SongWriter class"""
 
+import os
 import time
 import queue
+import subprocess
 import pytest
 import threading
 
+import numpy
+
 from songwriter import SongWriter
 from encoder import DebugEncoder as Encoder
+from clock import VirtualClock
+from library import Library
+from fingerprint import FingerprintIndex
+from noisefloor import NoiseFloorEstimator
+from test_fingerprint import song
+
+ONE_SECOND = 44100 * 2 * 2
 
 @pytest.fixture()
 def shared_ressources(request):
@@ -24,6 +35,7 @@ def shared_ressources(request):
         'lock': threading.Lock()
         }
     encoder = Encoder()
+    clock = VirtualClock()
     def fin():
         """
         Funcion called after the test when fixture is at the end of its life
@@ -33,9 +45,19 @@ def shared_ressources(request):
     return {
         'data': data,
         'synchronization': synchronization,
-        'encoder': encoder
+        'encoder': encoder,
+        'clock': clock
         }
 
+def noise(seconds, seed=0):
+    """ Return seconds of loud random bytes """
+    return numpy.random.RandomState(seed).randint(
+        128, 256, int(seconds * ONE_SECOND), dtype=numpy.uint8).tobytes()
+
+def silence(seconds):
+    """ Return seconds of digital silence """
+    return bytes(int(seconds * ONE_SECOND))
+
 def test_ending(shared_ressources):
     """
     Test that a song writer stops when the end event is set.
@@ -43,7 +65,7 @@ def test_ending(shared_ressources):
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    songwriter = SongWriter(synchronization, data, encoder)
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
     synchronization['end'].set()
     songwriter.start()
     songwriter.join()
@@ -56,7 +78,7 @@ def test_do_task(shared_ressources):
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    songwriter = SongWriter(synchronization, data, encoder)
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
     songwriter.start()
     time.sleep(0.1)
     synchronization['end'].set()
@@ -76,13 +98,10 @@ def test_detect_no_gap(shared_ressources):
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    length = 44100 * 2 * 2
+    length = ONE_SECOND
+    data['raw_data'].extend(noise(1))
 
-    from random import randint
-    for _ in range(0, length):
-        data['raw_data'].append(randint(128, 255))
-
-    songwriter = SongWriter(synchronization, data, encoder)
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
     songwriter.start()
     time.sleep(0.1)
     synchronization['end'].set()
@@ -94,160 +113,325 @@ def test_detect_no_gap(shared_ressources):
     synchronization['tasks'].join()
     assert encoder.encoded[0].st_size == length
 
+def write_songs(shared_ressources, stream, lengths, noise_floor=False, cut_candidates=None):
+    """ Write the songs of lengths (in seconds, the last one being cut hard) out of
+    stream, and return the lengths of the written songs, in seconds """
+    synchronization = shared_ressources['synchronization']
+    data = shared_ressources['data']
+    encoder = shared_ressources['encoder']
+    data['raw_data'] = bytearray(stream)
+    if noise_floor:
+        data['noise_floor'] = NoiseFloorEstimator(min_seconds=0)
+        data['noise_floor'].update(stream)
+    kwargs = {} if cut_candidates is None else {'cut_candidates': cut_candidates}
+    songwriter = SongWriter(
+        synchronization, data, encoder, shared_ressources['clock'], **kwargs)
+    songwriter.start()
+    for task_id, length in enumerate(lengths):
+        synchronization['tasks'].put({
+            'id': task_id,
+            'length': length,
+            'hard_length': task_id == len(lengths) - 1,
+            'infos': {},
+            })
+    # The end is set once the songs are written: the gaps are searched
+    synchronization['tasks'].join()
+    synchronization['end'].set()
+    return [encoder.encoded[task_id].st_size / ONE_SECOND for task_id in range(len(lengths))]
+
 def test_detect_one_gap(shared_ressources):
     """
     Test that song writer detects gap and split on the middle.
     """
+    stream = noise(6) + silence(1) + noise(6, 1)
+    lengths = write_songs(shared_ressources, stream, [7, 6])
+    assert lengths == [6.5, 6.5]
+
+def test_detect_longest_gap_after(shared_ressources):
+    """
+    Test that song writer doesn't split on the first but on the longest gap.
+    """
+    stream = noise(1) + silence(0.4) + noise(1, 1) + silence(0.8) + noise(2, 2)
+    lengths = write_songs(shared_ressources, stream, [3.2, 2], noise_floor=True, cut_candidates=1)
+    assert lengths == pytest.approx([2.8, 2.4])
+
+def test_detect_longest_gap_before(shared_ressources):
+    """
+    Test that song writer split on longest gap, not the latest.
+    """
+    stream = noise(1) + silence(0.8) + noise(1, 1) + silence(0.4) + noise(2, 2)
+    lengths = write_songs(shared_ressources, stream, [3, 2.2], noise_floor=True, cut_candidates=1)
+    assert lengths == pytest.approx([1.4, 3.8])
+
+@pytest.mark.long
+def test_long_track(shared_ressources):
+    """
+    Test song writer handles long stream of data (~4min)
+    """
+    stream = silence(5) + bytes([200]) * (4 * 60 * ONE_SECOND) + silence(1) + noise(10)
+    lengths = write_songs(shared_ressources, stream, [4 * 60 + 6, 10])
+    assert lengths == [245.5, 10.5]
+
+def test_skip_existing(shared_ressources, tmpdir):
+    """
+    Test that songs in the library are dropped from the buffer, not written nor encoded.
+    """
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    length_seconds = 6
-    part = (44100 * 2 * 2) * length_seconds
-    silence_part = (44100 * 2 * 2)
-    length = part + 0.5*silence_part
-    length2 = 0.5*silence_part + part
-
-    from random import randint
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-    for _ in range(0, silence_part):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-
-    songwriter = SongWriter(synchronization, data, encoder)
+    part = 44100 * 2 * 2 * 3
+    library = Library(str(tmpdir.join("library.json")))
+    library.add({'title': "Known", 'artist': "Artist"}, 3)
+
+    data['raw_data'].extend([200] * (2 * part))
+
+    songwriter = SongWriter(
+        synchronization, data, encoder, shared_ressources['clock'], library)
     songwriter.start()
-    time.sleep(0.1)
     synchronization['tasks'].put({
         'id': 0,
-        'length': length_seconds,
-        'infos': {},
+        'length': 3,
+        'hard_length': True,
+        'infos': {'title': "Known", 'artist': "Artist"},
         })
     synchronization['tasks'].put({
         'id': 1,
-        'length': length_seconds,
-        'infos': {},
+        'length': 3,
+        'hard_length': True,
+        'infos': {'title': "New", 'artist': "Artist"},
         })
-    synchronization['end'].set()
     synchronization['tasks'].join()
-    assert encoder.encoded[0].st_size == length
-    assert encoder.encoded[1].st_size == length2
+    synchronization['end'].set()
+    assert list(encoder.encoded) == [1]
+    assert encoder.encoded[1].st_size == part
+    assert songwriter.songs_skipped == 1
+    assert library.contains({'title': "New", 'artist': "Artist"}, 3)
 
-def test_detect_longest_gap_after(shared_ressources):
+def test_drop_rule(shared_ressources):
     """
-    Test that song writer doesn't split on the first but on the longest gap.
+    Test that segments matching a drop rule are dropped from the buffer, not written nor encoded.
     """
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    part = 44100 * 2 * 2
-    length = part + 0.4*part + part + 0.4 * part
-    length2 = 0.4*part + part
-
-    from random import randint
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-    for _ in range(0, int(0.4 * part)):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-    for _ in range(0, int(0.8 * part)):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-
-    songwriter = SongWriter(synchronization, data, encoder)
+    part = 44100 * 2 * 2 * 3
+
+    data['raw_data'].extend([200] * (2 * part))
+
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
     songwriter.start()
-    time.sleep(0.1)
     synchronization['tasks'].put({
         'id': 0,
-        'length': 2,
-        'infos': {},
+        'length': 3,
+        'hard_length': True,
+        'drop': "ads",
+        'infos': {'title': "Ad", 'artist': "Deezer"},
         })
     synchronization['tasks'].put({
         'id': 1,
-        'length': 1,
-        'infos': {},
+        'length': 3,
+        'hard_length': True,
+        'infos': {'title': "Song", 'artist': "Artist"},
         })
-    synchronization['end'].set()
     synchronization['tasks'].join()
-    assert encoder.encoded[0].st_size == length
-    assert encoder.encoded[1].st_size == length2
+    synchronization['end'].set()
+    assert list(encoder.encoded) == [1]
+    assert encoder.encoded[1].st_size == part
+    assert not os.path.exists("0.raw")
+    assert songwriter.songs_dropped == 1
 
-def test_detect_longest_gap_before(shared_ressources):
+def test_stop_on_loop(shared_ressources):
     """
-    Test that song writer split on longest gap, not the latest.
+    Test that a song heard again is not encoded and stops the recording.
     """
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
     encoder = shared_ressources['encoder']
-    part = 44100 * 2 * 2
-    silence_part = 0.4*part
-    length = part + silence_part
-    length2 = silence_part + part + silence_part + part
-
-    from random import randint
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-    for _ in range(0, int(2 * silence_part)):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-    for _ in range(0, int(silence_part)):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(randint(128, 255))
-
-    songwriter = SongWriter(synchronization, data, encoder)
+    songs = [song(15, seed) for seed in range(2)]
+    for data_part in songs + songs[:1]:
+        data['raw_data'].extend(data_part)
+
+    songwriter = SongWriter(
+        synchronization, data, encoder, shared_ressources['clock'],
+        fingerprints=FingerprintIndex(), stop_on_loop=True)
+    songwriter.start()
+    for task_id in range(3):
+        synchronization['tasks'].put({
+            'id': task_id,
+            'length': 15,
+            'hard_length': True,
+            'infos': {'title': "Song {}".format(task_id), 'artist': "Artist"},
+            })
+    synchronization['tasks'].join()
+    assert sorted(encoder.encoded) == [0, 1]
+    assert synchronization['end'].is_set()
+
+class StreamingEncoder(Encoder):
+    """ Streaming encoder copying the raw data it receives in a '.stream' file """
+    STREAMING = True
+
+    def open_stream(self, basename, infos, output=None, audio_format=None):
+        with open("{}.stream".format(basename), 'wb') as output_file:
+            return subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=output_file)
+
+    def close_stream(self, process):
+        self.encoded[process.args[0]] = None
+        return super(StreamingEncoder, self).close_stream(process)
+
+def test_streaming_encoder(shared_ressources):
+    """
+    Test that songs are given to a streaming encoder without any raw file.
+    """
+    synchronization = shared_ressources['synchronization']
+    data = shared_ressources['data']
+    encoder = StreamingEncoder()
+    part = 44100 * 2 * 2 * 3
+    song = (bytes(range(256)) * (part // 256 + 1))[:part]
+    data['raw_data'].extend(song)
+
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
     songwriter.start()
-    time.sleep(0.1)
     synchronization['tasks'].put({
         'id': 0,
-        'length': 1,
+        'length': 3,
+        'hard_length': True,
         'infos': {},
         })
+    synchronization['tasks'].join()
+    synchronization['end'].set()
+    assert songwriter.songs_written == 1
+    assert not os.path.exists("0.raw")
+    with open("0.stream", 'rb') as stream_file:
+        assert stream_file.read() == song
+    os.unlink("0.stream")
+
+class FailingStreamingEncoder(StreamingEncoder):
+    """ Streaming encoder whose process reads its input and exits with an error """
+    def open_stream(self, basename, infos, output=None, audio_format=None):
+        return subprocess.Popen(["sh", "-c", "cat > /dev/null; exit 3"], stdin=subprocess.PIPE)
+
+def test_failing_streaming_encoder(shared_ressources):
+    """
+    Test that a failed streamed encoding is counted, and its task done.
+    """
+    synchronization = shared_ressources['synchronization']
+    data = shared_ressources['data']
+    data['raw_data'].extend(bytes(44100 * 2 * 2 * 2))
+    songwriter = SongWriter(
+        synchronization, data, FailingStreamingEncoder(), shared_ressources['clock'])
+    songwriter.start()
     synchronization['tasks'].put({
-        'id': 1,
+        'id': 0,
         'length': 2,
+        'hard_length': True,
         'infos': {},
         })
+    deadline = time.time() + 10
+    while synchronization['tasks'].unfinished_tasks and time.time() < deadline:
+        time.sleep(0.01)
     synchronization['end'].set()
-    synchronization['tasks'].join()
-    assert encoder.encoded[0].st_size == length
-    assert encoder.encoded[1].st_size == length2
+    assert synchronization['tasks'].unfinished_tasks == 0
+    assert songwriter.is_alive()
+    assert songwriter.songs_failed == 1 and songwriter.songs_written == 0
 
-@pytest.mark.long
-def test_long_track(shared_ressources):
+class FailingEncoder(Encoder):
+    """ Encoder failing to encode every song, as when lame exits with an error """
+    def encode(self, basename, infos, output=None, audio_format=None):
+        super(FailingEncoder, self).encode(basename, infos, output, audio_format)
+        return False
+
+def test_failing_encoder(shared_ressources, tmpdir):
     """
-    Test song writer handles long stream of data (~4min)
+    Test that a failed encoding is counted, and the song not added to the library.
     """
     synchronization = shared_ressources['synchronization']
     data = shared_ressources['data']
-    encoder = shared_ressources['encoder']
-    part = (44100 * 2 * 2) * 4*60
-    silence_part = 5*(44100*2*2)
-    length = silence_part + part + silence_part
-
-    print("Creating long stream of data...")
-    from random import randint
-    for _ in range(0, silence_part):
-        data['raw_data'].append(0)
-    for _ in range(0, part):
-        data['raw_data'].append(200)
-    for _ in range(0, int(2 * silence_part)):
-        data['raw_data'].append(0)
-    for _ in range(0, int(2 * silence_part)):
-        data['raw_data'].append(200)
-
-    songwriter = SongWriter(synchronization, data, encoder)
+    data['raw_data'].extend(bytes(44100 * 2 * 2 * 2))
+    encoder = FailingEncoder()
+    library = Library(str(tmpdir.join("library.json")))
+    songwriter = SongWriter(
+        synchronization, data, encoder, shared_ressources['clock'], library=library)
     songwriter.start()
-    time.sleep(0.1)
     synchronization['tasks'].put({
-        'id': 0,
-        'length': 4*60,
-        'infos': {},
+        'id': "failing",
+        'length': 2,
+        'hard_length': True,
+        'infos': {'title': "Song", 'artist': "Artist"},
         })
-    synchronization['end'].set()
     synchronization['tasks'].join()
-    assert encoder.encoded[0].st_size == length
+    synchronization['end'].set()
+    encoder.clear()
+    assert songwriter.songs_failed == 1 and songwriter.songs_written == 0
+    assert not library.contains({'title': "Song", 'artist': "Artist"}, 2)
 
+def test_batch(shared_ressources):
+    """
+    Test that songs already buffered are written in one batch, cut as one by one.
+    """
+    encoder = shared_ressources['encoder']
+    one_second = 44100 * 2 * 2
+    stream = b""
+    for seed in range(4):
+        stream += song(5, seed) + bytes(one_second // 2)
+    sizes = {}
+    for batch in (False, True):
+        synchronization = {
+            'start': threading.Barrier(1),
+            'end': threading.Event(),
+            'tasks': queue.Queue()
+            }
+        data = {'raw_data': list(stream), 'lock': threading.Lock()}
+        for task_id in range(4):
+            synchronization['tasks'].put({
+                'id': "{}-{}".format(batch, task_id),
+                'length': 5.5,
+                'infos': {},
+                })
+        songwriter = SongWriter(
+            synchronization, data, encoder, shared_ressources['clock'], cut_candidates=1,
+            batch=batch)
+        songwriter.start()
+        synchronization['tasks'].join()
+        synchronization['end'].set()
+        sizes[batch] = [encoder.encoded["{}-{}".format(batch, task_id)].st_size
+                        for task_id in range(4)]
+    assert sizes[True] == sizes[False]
+    for size, expected in zip(sizes[True], (5.25, 5.5, 5.5)):
+        assert abs(size - expected * one_second) < 0.1 * one_second
+
+class WatchedBuffer(list):
+    """ Raw data list recording the length of the slices read while its lock is held """
+    def __init__(self, data, lock):
+        super(WatchedBuffer, self).__init__(data)
+        self.lock = lock
+        self.locked_reads = []
+
+    def __getitem__(self, index):
+        part = super(WatchedBuffer, self).__getitem__(index)
+        if isinstance(index, slice) and self.lock.locked():
+            self.locked_reads.append(len(part))
+        return part
+
+def test_batch_unlocked_copy(shared_ressources):
+    """
+    Test that the backlog written in one batch is not copied while holding the buffer lock.
+    """
+    encoder = shared_ressources['encoder']
+    one_second = 44100 * 2 * 2
+    synchronization = shared_ressources['synchronization']
+    lock = threading.Lock()
+    data = {'raw_data': WatchedBuffer(bytes(4 * 3 * one_second), lock), 'lock': lock}
+    for task_id in range(4):
+        synchronization['tasks'].put({
+            'id': "unlocked-{}".format(task_id),
+            'length': 3,
+            'hard_length': True,
+            'infos': {},
+            })
+    songwriter = SongWriter(synchronization, data, encoder, shared_ressources['clock'])
+    songwriter.start()
+    synchronization['tasks'].join()
+    synchronization['end'].set()
+    assert [encoder.encoded["unlocked-{}".format(task_id)].st_size
+            for task_id in range(4)] == [3 * one_second] * 4
+    assert data['raw_data'].locked_reads == []
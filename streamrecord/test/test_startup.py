@@ -0,0 +1,32 @@
+#! /usr/bin/env python3
+""" Test module for the command line startup time (see benchmarks/startup.py) """
+
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IMPORT_BUDGET = 0.3 # Seconds, far above the usual 50ms to allow slow machines
+HEAVY_MODULES = ("numpy", "Xlib", "slugify", "notify2", "dbus")
+
+def import_times(*arguments):
+    """ Return the self import time of each module loaded by the command line """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "streamrecord"] + list(arguments),
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "[us]" not in line:
+            self_time, _, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(self_time) / 1e6
+    return times
+
+def test_help_does_not_import_heavy_modules():
+    times = import_times("--help")
+    assert "streamrecord.appinspector" in times
+    assert [name for name in times if name.split(".")[0] in HEAVY_MODULES] == []
+    assert "streamrecord.recording" not in times
+
+def test_import_budget():
+    assert sum(import_times("--help").values()) < IMPORT_BUDGET
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+""" Test module for the supervisor restarting the stalled components """
+
+import os
+import time
+import types
+import threading
+
+from supervisor import Supervisor
+from encoder import Encoder
+
+class Capture:
+    """ Capture source counting its restarts """
+    def __init__(self):
+        self.restarts = 0
+
+    def restart_capture(self):
+        self.restarts += 1
+
+class Inspector:
+    """ Application inspector counting its interruptions """
+    def __init__(self):
+        self.heartbeat = None
+        self.interruptions = 0
+
+    def interrupt(self):
+        self.interruptions += 1
+
+def make_supervisor(components, encoder=None, parties=2):
+    synchronization = {'start': threading.Barrier(parties), 'end': threading.Event()}
+    data = {'raw_data': bytearray(), 'lock': threading.Lock()}
+    return Supervisor(synchronization, data, components, encoder), synchronization, data
+
+def test_restart_stalled_capture():
+    capture = Capture()
+    loader = types.SimpleNamespace(capturing=False, bytes_read=0)
+    supervisor, _, _ = make_supervisor({'capture': capture, 'loader': loader})
+    supervisor.check(100) # Not capturing yet
+    supervisor.check(110)
+    assert capture.restarts == 0
+    loader.capturing = True
+    supervisor.check(120)
+    loader.bytes_read = 4410
+    supervisor.check(124) # Audio flowing
+    supervisor.check(128)
+    assert capture.restarts == 0
+    supervisor.check(130) # Stalled for 6s
+    assert capture.restarts == 1
+    supervisor.check(131) # Given time to recover
+    assert capture.restarts == 1
+    supervisor.check(136)
+    assert capture.restarts == 2
+    assert supervisor.restarts['capture'] == 2
+
+def test_interrupt_stalled_inspector():
+    inspector = Inspector()
+    supervisor, _, _ = make_supervisor({'inspector': inspector})
+    supervisor.check(100) # Not detecting yet
+    inspector.heartbeat = 100
+    supervisor.check(105)
+    assert inspector.interruptions == 0
+    supervisor.check(111)
+    assert inspector.interruptions == 1
+    supervisor.check(115) # Reconnecting
+    assert inspector.interruptions == 1
+    inspector.heartbeat = 116
+    supervisor.check(120)
+    assert inspector.interruptions == 1
+
+def test_kill_expired_encode(tmpdir):
+    """ A hung encoder is killed, its raw file being kept """
+    encoder = Encoder()
+    encoder.timeout = 1
+    basename = str(tmpdir.join("song"))
+    with open("{}.raw".format(basename), 'wb') as raw_file:
+        raw_file.write(b"\0" * 16)
+    streaming = encoder.spawn(["sleep", "10"], deadline=False)
+    process = encoder.spawn(["sleep", "10"])
+    supervisor, _, _ = make_supervisor({}, encoder)
+    supervisor.check(time.monotonic())
+    assert process.poll() is None
+    supervisor.check(time.monotonic() + 2)
+    encoder.finish(process, basename)
+    assert process.returncode != 0
+    assert os.path.exists("{}.raw".format(basename))
+    assert streaming.poll() is None
+    assert supervisor.restarts['encoder'] == 1
+    streaming.kill()
+    streaming.wait()
+
+def test_dead_writer(tmpdir, monkeypatch):
+    """ A dead component stops the recording, the buffer is saved if it was the writer """
+    monkeypatch.chdir(tmpdir)
+    writer = threading.Thread(target=lambda: None)
+    writer.start()
+    writer.join()
+    supervisor, synchronization, data = make_supervisor({'writer': writer})
+    data['raw_data'].extend(b"\1" * 64)
+    supervisor.check()
+    assert synchronization['end'].is_set()
+    assert synchronization['start'].broken
+    assert not data['raw_data']
+    rescued = tmpdir.listdir(lambda path: path.basename.startswith("streamrecord-rescue-"))
+    assert len(rescued) == 1 and rescued[0].read_binary() == b"\1" * 64
@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+""" Test module for the pipeline tracer"""
+
+import json
+
+from tracing import Tracer
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    tracer.instant("title_change", song=0)
+    with tracer.span("encode", song=0):
+        pass
+    assert tracer.events == []
+
+def test_chrome_trace_export(tmpdir):
+    tracer = Tracer()
+    tracer.enable()
+    tracer.instant("title_change", 10.0, song=10.0)
+    with tracer.span("encode", song=10.0):
+        pass
+    tracer.complete("write", 11.0, 11.5, song=10.0)
+    path = str(tmpdir.join("trace.json"))
+    tracer.export(path)
+    with open(path) as trace_file:
+        events = json.load(trace_file)['traceEvents']
+    by_name = {event['name']: event for event in events}
+    assert by_name['title_change']['ph'] == "i"
+    assert by_name['title_change']['ts'] == 10.0e6
+    assert by_name['encode']['ph'] == "X"
+    assert by_name['write']['dur'] == 0.5e6
+    assert by_name['write']['args'] == {'song': 10.0}
+    assert by_name['thread_name']['ph'] == "M"
+
+def test_events_limit():
+    tracer = Tracer(max_events=2)
+    tracer.enable()
+    for i in range(5):
+        tracer.instant("title_change", song=i)
+    assert len(tracer.events) == 2
+    assert not tracer.enabled
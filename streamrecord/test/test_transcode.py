@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+""" Test module for the batch transcoding """
+
+import os
+
+import pytest
+
+import encoder as encoders
+import transcode
+from transcode import Transcoder, make_encoder, parse_vorbis_comments, transcode_file
+
+def create(path, content=b"\0" * 16, mtime=None):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as created_file:
+        created_file.write(content)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def test_make_encoder():
+    assert make_encoder("mp3", 2).quality == 2
+    assert make_encoder("flac", 8).compression_level == 8
+    assert make_encoder("mp3").keep_raw
+
+def test_parse_vorbis_comments():
+    infos = parse_vorbis_comments(
+        "TITLE=A title\nartist=An artist\nREPLAYGAIN_TRACK_GAIN=-3.20 dB\nUNKNOWN=1\n")
+    assert infos == {
+        'title': "A title",
+        'artist': "An artist",
+        'replaygain_track_gain': "-3.20 dB"
+    }
+
+def test_plan_mtime(tmpdir):
+    source_dir, output_dir = str(tmpdir.join("source")), str(tmpdir.join("output"))
+    create(os.path.join(source_dir, "a", "old.flac"), mtime=1000)
+    create(os.path.join(source_dir, "new.raw"), mtime=3000)
+    create(os.path.join(source_dir, "cover.jpg"))
+    create(os.path.join(output_dir, "a", "old.mp3"), mtime=2000)
+    create(os.path.join(output_dir, "new.mp3"), mtime=2000)
+    transcoder = Transcoder(source_dir, output_dir, "mp3")
+    assert transcoder.plan() == (["new.raw"], [os.path.join("a", "old.flac")])
+    assert transcoder.target("new.raw") == os.path.join(output_dir, "new")
+    assert Transcoder(source_dir, output_dir, "flac").plan()[1] == []
+    assert Transcoder(source_dir, output_dir, "mp3", check="none").plan()[1] == []
+
+def test_plan_hash(tmpdir):
+    source_dir, output_dir = str(tmpdir.join("source")), str(tmpdir.join("output"))
+    create(os.path.join(source_dir, "song.raw"), b"first")
+    create(os.path.join(output_dir, "song.mp3"))
+    transcoder = Transcoder(source_dir, output_dir, "mp3", check="hash")
+    assert transcoder.plan() == (["song.raw"], [])
+    transcoder.manifest["song.raw"] = transcoder.manifest_entry("song.raw")
+    transcoder.save_manifest()
+    assert Transcoder(source_dir, output_dir, "mp3", check="hash").plan() == ([], ["song.raw"])
+    assert Transcoder(source_dir, output_dir, "mp3", 2, check="hash").plan() == (["song.raw"], [])
+    create(os.path.join(source_dir, "song.raw"), b"second")
+    assert Transcoder(source_dir, output_dir, "mp3", check="hash").plan() == (["song.raw"], [])
+
+class FailingEncoder(encoders.FlacEncoder):
+    """ Encoder whose process always exits with an error """
+    def encode(self, basename, infos, output=None, audio_format=None):
+        return self.finish(self.spawn(["false"]), basename)
+
+def test_failed_encoding(tmpdir, monkeypatch):
+    """ A failed encoding is reported as such, and leaves no target """
+    monkeypatch.setitem(transcode.ENCODERS, "failing", (FailingEncoder, 'compression_level'))
+    source = str(tmpdir.join("song.raw"))
+    create(source)
+    target = str(tmpdir.join("output", "song"))
+    with pytest.raises(RuntimeError, match="FailingEncoder failed to encode"):
+        transcode_file(source, target, "failing")
+    assert os.listdir(str(tmpdir.join("output"))) == []
+    assert os.path.exists(source)
+
+def test_get_output():
+    encoder = encoders.FlacEncoder()
+    assert encoder.get_output("0", None) == "0.flac"
+    assert encoder.get_output("0", {'title': "T", 'artist': "A"}) == "a-t.flac"
+    assert encoder.get_output("0", {'title': "T", 'artist': "A"}, "out/song") == "out/song.flac"
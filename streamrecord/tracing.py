@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Opt-in tracing of the pipeline stages, exported in the Chrome trace-event
+format (loadable in chrome://tracing or https://ui.perfetto.dev)
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import contextlib
+
+class Tracer:
+    """ Collect timed events of all threads. Nothing is recorded until enabled. """
+    def __init__(self, max_events=1000000):
+        self.enabled = False
+        self.max_events = max_events
+        self.events = []
+        self.thread_names = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        """ Start recording events """
+        self.enabled = True
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event['pid'] = os.getpid()
+        event['tid'] = thread.ident
+        event['cat'] = "streamrecord"
+        with self.lock:
+            if len(self.events) >= self.max_events:
+                if self.enabled:
+                    logging.warning("Too many trace events, tracing stopped")
+                    self.enabled = False
+                return
+            self.thread_names[thread.ident] = thread.name
+            self.events.append(event)
+
+    def instant(self, name, timestamp=None, **args):
+        """ Record an event happening at timestamp (now by default) """
+        if not self.enabled:
+            return
+        self._add({
+            'name': name,
+            'ph': "i",
+            's': "t",
+            'ts': (time.time() if timestamp is None else timestamp) * 1e6,
+            'args': args
+        })
+
+    def complete(self, name, start, end, **args):
+        """ Record a span whose bounds (in seconds since epoch) were measured by the caller """
+        if not self.enabled:
+            return
+        self._add({
+            'name': name,
+            'ph': "X",
+            'ts': start * 1e6,
+            'dur': (end - start) * 1e6,
+            'args': args
+        })
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """ Context manager recording the time spent in its block """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.time(), **args)
+
+    def export(self, path):
+        """ Write all the recorded events to path """
+        with self.lock:
+            events = list(self.events)
+            events.extend(
+                {
+                    'name': "thread_name",
+                    'ph': "M",
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': name}
+                }
+                for tid, name in self.thread_names.items()
+            )
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, trace_file)
+        logging.info("%d trace events written to %s", len(events), path)
+
+tracer = Tracer()
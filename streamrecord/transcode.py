@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Batch transcoding of existing recordings (raw captures or FLAC files) with
+the encoders of the recorder, over a pool of processes
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+import concurrent.futures
+
+if __package__ == "":
+    from encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from audioformat import AudioFormat, DEFAULT_FORMAT
+elif __package__ == "streamrecord":
+    from streamrecord.encoder import Mp3LameEncoder, FlacEncoder, OpusEncoder
+    from streamrecord.audioformat import AudioFormat, DEFAULT_FORMAT
+
+ENCODERS = {
+    'mp3': (Mp3LameEncoder, 'quality'),
+    'flac': (FlacEncoder, 'compression_level'),
+    'opus': (OpusEncoder, 'bitrate')
+}
+SOURCE_EXTENSIONS = (".raw", ".flac")
+MANIFEST = ".streamrecord-transcode.json" # In the output directory
+
+def make_encoder(name, quality=None):
+    """ Return the encoder called name, with its quality setting if given """
+    encoder_class, quality_argument = ENCODERS[name]
+    if quality is None:
+        return encoder_class(keep_raw=True)
+    return encoder_class(keep_raw=True, **{quality_argument: quality})
+
+def find_sources(directory):
+    """ Return the paths, relative to directory, of the recordings it contains """
+    sources = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(SOURCE_EXTENSIONS):
+                sources.append(os.path.relpath(os.path.join(root, name), directory))
+    return sorted(sources)
+
+def file_hash(path):
+    """ Return the SHA-256 of the file content """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_vorbis_comments(text):
+    """ Return the infos (as given to the encoders) of metaflac --export-tags-to output """
+    keys = {tag: key for key, tag in FlacEncoder.SUPPORTED_TAGS.items()}
+    infos = {}
+    for line in text.splitlines():
+        tag, separator, value = line.partition("=")
+        if separator and tag.upper() in keys:
+            infos[keys[tag.upper()]] = value
+    return infos
+
+def read_infos(source):
+    """ Return the infos of a recording, from its tags if it has some """
+    if not source.endswith(".flac"):
+        return {}
+    output = subprocess.check_output(
+        ["/usr/bin/metaflac", "--export-tags-to=-", source],
+        universal_newlines=True)
+    return parse_vorbis_comments(output)
+
+def read_format(source, raw_format=DEFAULT_FORMAT):
+    """ Return the AudioFormat of a recording, raw_format for raw captures """
+    if not source.endswith(".flac"):
+        return raw_format
+    output = subprocess.check_output(
+        ["/usr/bin/metaflac", "--show-sample-rate", "--show-channels", "--show-bps", source],
+        universal_newlines=True)
+    rate, channels, bits = (int(value) for value in output.split())
+    return AudioFormat(rate, channels, bits // 8)
+
+def transcode_file(source, target, encoder_name, quality=None, raw_format=DEFAULT_FORMAT):
+    """ Transcode one recording to target (without extension), raw captures being
+    in raw_format. Run in a worker process, return the source and its duration in seconds. """
+    encoder = make_encoder(encoder_name, quality)
+    infos = read_infos(source)
+    audio_format = read_format(source, raw_format)
+    directory = os.path.dirname(target)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_dir = tempfile.mkdtemp(prefix="streamrecord-transcode-")
+    try:
+        basename = os.path.join(temporary_dir, "source")
+        if source.endswith(".flac"):
+            subprocess.check_call([
+                "/usr/bin/flac", "--silent", "--decode", "--force-raw-format",
+                "--endian=little", "--sign=signed",
+                "-o", "{}.raw".format(basename), source])
+        else:
+            os.symlink(os.path.abspath(source), "{}.raw".format(basename))
+        duration = os.path.getsize("{}.raw".format(basename)) / audio_format.bytes_per_second
+        # Encode next to the target, then move it, to never leave partial files
+        if not encoder.encode(basename, infos, "{}.part".format(target), audio_format):
+            raise RuntimeError("{} failed to encode '{}'".format(type(encoder).__name__, source))
+        part = encoder.get_output(basename, infos, "{}.part".format(target))
+        os.replace(part, encoder.get_output(basename, infos, target))
+    finally:
+        shutil.rmtree(temporary_dir)
+    return source, duration
+
+class Transcoder:
+    """ Transcode the recordings of a directory tree into another one, skipping
+    the ones already up to date """
+    def __init__(self, source_dir, output_dir, encoder_name, quality=None, check="mtime",
+                 raw_format=DEFAULT_FORMAT):
+        """
+        source_dir: Directory walked for recordings
+        output_dir: Directory where the tree of transcoded files is created
+        encoder_name: Name of the target encoder (see ENCODERS)
+        quality: Quality setting of the encoder, its default if None
+        check: How to detect up to date files: 'mtime' (target newer than
+            source), 'hash' (same source content and settings than the last
+            transcoding) or 'none' (always transcode)
+        raw_format: AudioFormat of the raw captures
+        """
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.encoder_name = encoder_name
+        self.quality = quality
+        self.check = check
+        self.raw_format = raw_format
+        self.extension = ENCODERS[encoder_name][0].EXTENSION
+        self.manifest_path = os.path.join(output_dir, MANIFEST)
+        self.manifest = {}
+        self.entries = {} # Manifest entries computed during this run
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def target(self, source):
+        """ Return the target path, without extension, of a relative source path """
+        return os.path.join(self.output_dir, os.path.splitext(source)[0])
+
+    def manifest_entry(self, source):
+        """ Return what identifies a transcoding of source in the manifest """
+        if source not in self.entries:
+            self.entries[source] = {
+                'hash': file_hash(os.path.join(self.source_dir, source)),
+                'encoder': self.encoder_name,
+                'quality': self.quality
+            }
+            if not source.endswith(".flac"):
+                self.entries[source]['raw_format'] = str(self.raw_format)
+        return self.entries[source]
+
+    def is_up_to_date(self, source):
+        """ Has source already been transcoded with the current settings? """
+        target = "{}.{}".format(self.target(source), self.extension)
+        if self.check == "none" or not os.path.exists(target):
+            return False
+        if self.check == "hash":
+            return self.manifest.get(source) == self.manifest_entry(source)
+        return os.path.getmtime(target) >= os.path.getmtime(os.path.join(self.source_dir, source))
+
+    def plan(self):
+        """ Return the sources to transcode and the ones which are up to date """
+        todo, skipped = [], []
+        for source in find_sources(self.source_dir):
+            (skipped if self.is_up_to_date(source) else todo).append(source)
+        return todo, skipped
+
+    def save_manifest(self):
+        """ Write the manifest atomically """
+        os.makedirs(self.output_dir, exist_ok=True)
+        temporary_path = "{}.tmp".format(self.manifest_path)
+        with open(temporary_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+    def run(self, jobs=None):
+        """ Transcode the sources which are not up to date with at most jobs
+        processes, and return a report """
+        todo, skipped = self.plan()
+        logging.info("%d files to transcode, %d up to date", len(todo), len(skipped))
+        report = {'transcoded': 0, 'skipped': len(skipped), 'failed': [], 'audio_seconds': 0.0}
+        start = time.time()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    transcode_file, os.path.join(self.source_dir, source),
+                    self.target(source), self.encoder_name, self.quality,
+                    self.raw_format): source
+                for source in todo
+            }
+            for future in concurrent.futures.as_completed(futures):
+                source = futures[future]
+                try:
+                    _, duration = future.result()
+                except (OSError, RuntimeError, subprocess.CalledProcessError) as error:
+                    logging.error("Unable to transcode '%s': %s", source, error)
+                    report['failed'].append(source)
+                    continue
+                logging.info("'%s' transcoded (%.1f s)", source, duration)
+                report['transcoded'] += 1
+                report['audio_seconds'] += duration
+                if self.check == "hash":
+                    self.manifest[source] = self.manifest_entry(source)
+        if self.check == "hash":
+            self.save_manifest()
+        report['wall_seconds'] = time.time() - start
+        report['speed'] = (report['audio_seconds'] / report['wall_seconds']
+                           if report['wall_seconds'] else None)
+        # In megabytes of CD audio
+        report['throughput_mb_per_second'] = (
+            report['audio_seconds'] * DEFAULT_FORMAT.bytes_per_second /
+            report['wall_seconds'] / 1e6
+            if report['wall_seconds'] else None)
+        return report
+
+def main():
+    """ Parse options, transcode and print the report """
+    arg_parser = argparse.ArgumentParser(
+        description="Transcode existing recordings (raw captures, FLAC files) in parallel")
+    arg_parser.add_argument("source", help="Directory of the recordings")
+    arg_parser.add_argument("output", help="Directory of the transcoded files")
+    arg_parser.add_argument(
+        "--encoder", choices=sorted(ENCODERS), default="mp3",
+        help="Target encoder (default: %(default)s)")
+    arg_parser.add_argument(
+        "--quality", type=int,
+        help="lame VBR quality (0-9), flac compression level (0-8) or opus bitrate (kbit/s)")
+    arg_parser.add_argument(
+        "--check", choices=["mtime", "hash", "none"], default="mtime",
+        help="How to detect files already transcoded (default: %(default)s)")
+    arg_parser.add_argument(
+        "--rate", type=int, default=DEFAULT_FORMAT.rate,
+        help="Sampling rate of the raw captures (default: %(default)s)")
+    arg_parser.add_argument(
+        "--channels", type=int, default=DEFAULT_FORMAT.channels,
+        help="Number of channels of the raw captures (default: %(default)s)")
+    arg_parser.add_argument(
+        "--bits", type=int, choices=[16, 24], default=DEFAULT_FORMAT.bits,
+        help="Bits per sample of the raw captures (default: %(default)s)")
+    arg_parser.add_argument(
+        "--jobs", "-j", type=int,
+        help="Maximal number of simultaneous transcodings (default: number of CPUs)")
+    arg_parser.add_argument(
+        "--debug", "-d",
+        help="Show debug info",
+        action="store_const",
+        default=logging.INFO,
+        const=logging.DEBUG
+    )
+    options = arg_parser.parse_args()
+
+    logging.basicConfig(
+        level=options.debug,
+        format="## %(levelname)s ## %(threadName)s ## %(message)s"
+    )
+
+    transcoder = Transcoder(
+        options.source, options.output, options.encoder, options.quality, options.check,
+        AudioFormat(options.rate, options.channels, options.bits // 8))
+    report = transcoder.run(options.jobs)
+    print(json.dumps(report, indent=2))
+    return 1 if report['failed'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())